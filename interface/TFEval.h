@@ -20,6 +20,10 @@
 
 #include <iostream>
 #include <mutex>
+#include <map>
+#include <memory>
+#include <tuple>
+#include <algorithm>
 
 
 class TFEval
@@ -363,22 +367,121 @@ class TFEval
         };
 
 
+        // graph and session loaded from a .pb file, shared by all TFEval instances using the same file and thread counts
+        struct Model
+        {
+            std::shared_ptr<const tensorflow::GraphDef> graphDef;
+            std::unique_ptr<tensorflow::Session> session;
+        };
+
     private:
+        typedef std::tuple<std::string,int,int> ModelKey;
+
+        static std::map<ModelKey,std::shared_ptr<Model>>& modelRegistry()
+        {
+            static std::map<ModelKey,std::shared_ptr<Model>> registry;
+            return registry;
+        }
+
+        // graphs read from .pb files, also before forking worker processes (see preloadGraph)
+        static std::map<std::string,std::shared_ptr<const tensorflow::GraphDef>>& graphRegistry()
+        {
+            static std::map<std::string,std::shared_ptr<const tensorflow::GraphDef>> registry;
+            return registry;
+        }
+
+        static std::mutex& modelRegistryMutex()
+        {
+            static std::mutex mutex;
+            return mutex;
+        }
+
+        static std::mutex& evaluationMutex()
+        {
+            static std::mutex mutex;
+            return mutex;
+        }
+
+        // must be called with the modelRegistryMutex locked
+        static std::shared_ptr<const tensorflow::GraphDef> readGraph(const std::string& filePath)
+        {
+            auto it = graphRegistry().find(filePath);
+            if (it!=graphRegistry().end())
+            {
+                return it->second;
+            }
+            std::shared_ptr<tensorflow::GraphDef> graphDef(new tensorflow::GraphDef());
+            tensorflow::Status status = ReadBinaryProto(
+                tensorflow::Env::Default(),
+                filePath,
+                graphDef.get()
+            );
+            if (!status.ok())
+            {
+                std::cerr<<"Error while loading graph def: "+status.ToString()<<std::endl;
+                return nullptr;
+            }
+            tensorflow::graph::SetDefaultDevice("/cpu:0", graphDef.get());
+            graphRegistry()[filePath] = graphDef;
+            return graphDef;
+        }
+
+        static std::shared_ptr<Model> loadModel(const std::string& filePath, int intraOpThreads, int interOpThreads)
+        {
+            std::lock_guard<std::mutex> guard(modelRegistryMutex());
+            ModelKey key(filePath,intraOpThreads,interOpThreads);
+            auto it = modelRegistry().find(key);
+            if (it!=modelRegistry().end())
+            {
+                return it->second;
+            }
+
+            std::shared_ptr<Model> model(new Model());
+            tensorflow::Status status;
+
+            // load it, unless it was already read
+            model->graphDef = readGraph(filePath);
+            if (not model->graphDef)
+            {
+                return nullptr;
+            }
+            tensorflow::SessionOptions opts;
+            opts.config.set_intra_op_parallelism_threads(intraOpThreads);
+            opts.config.set_inter_op_parallelism_threads(interOpThreads);
+            tensorflow::Session* session;
+            status = tensorflow::NewSession(opts, &session);
+            if (!status.ok())
+            {
+                std::cerr<<"Error while creating a new session: "+status.ToString()<<std::endl;
+                return nullptr;
+            }
+            model->session.reset(session);
+            status = model->session->Create(*model->graphDef);
+            if (!status.ok())
+            {
+                std::cerr<<"Error while loading graph into session: "+status.ToString()<<std::endl;
+                return nullptr;
+            }
+            modelRegistry()[key] = model;
+            return model;
+        }
+
         std::vector<FeatureGroup*> _featureGroups;
         std::vector<FeatureGroup*> _featureGroupsInModel;
-        std::unique_ptr<tensorflow::Session> _session;
-        tensorflow::GraphDef _graphDef;
+        std::shared_ptr<Model> _model;
         std::vector<std::string> _outputNodeNames;
         bool _doReallocation;
         std::string _graphFilePath;
+        int64_t _nStaged;
 
         std::vector<std::pair<std::string, tensorflow::Tensor>> _inputs;
 
     public:
         TFEval():
-            _session(nullptr),
+            _model(nullptr),
             _doReallocation(true),
-            _graphFilePath("")
+            _graphFilePath(""),
+            _nStaged(0)
         {
         }
         /*
@@ -394,43 +497,55 @@ class TFEval
             _outputNodeNames.push_back(nodeName);
         }
 
-        bool loadGraph(const char* filePath)
+        // the graph and session are loaded once per file and thread counts, and shared with the other TFEval instances;
+        // 0 threads lets TensorFlow choose (number of cores)
+        bool loadGraph(const char* filePath, int intraOpThreads=1, int interOpThreads=1)
         {
-            tensorflow::Status status;
-
-            // load it
-            status = ReadBinaryProto(
-                tensorflow::Env::Default(),
-                std::string(filePath),
-                &_graphDef
-            );
-            tensorflow::graph::SetDefaultDevice("/cpu:0", &_graphDef);
-
-            // check for success
-            if (!status.ok())
+            _model = loadModel(std::string(filePath),intraOpThreads,interOpThreads);
+            if (not _model)
             {
-                std::cerr<<"Error while loading graph def: "+status.ToString()<<std::endl;
                 return false;
             }
-            tensorflow::SessionOptions opts;
-            opts.config.set_intra_op_parallelism_threads(1);
-            opts.config.set_inter_op_parallelism_threads(1);
-            tensorflow::Session* session;
-            status = tensorflow::NewSession(opts, &session);
-            if (!status.ok())
+            _doReallocation = true;
+            _inputs.clear();
+            _graphFilePath = std::string(filePath);
+            return true;
+        }
+
+        // read the graph of a .pb file without creating a session: the sessions own thread pools, which don't
+        // survive a fork, whereas a graph read before forking worker processes is shared by them (copy-on-write)
+        static bool preloadGraph(const char* filePath)
+        {
+            std::lock_guard<std::mutex> guard(modelRegistryMutex());
+            return bool(readGraph(std::string(filePath)));
+        }
+
+        // release the graphs and sessions not used by any TFEval instance anymore
+        static void releaseGraphs()
+        {
+            std::lock_guard<std::mutex> guard(modelRegistryMutex());
+            for (auto it = modelRegistry().begin(); it != modelRegistry().end();)
             {
-                std::cerr<<"Error while creating a new session: "+status.ToString()<<std::endl;
-                return false;
+                if (it->second.use_count()==1)
+                {
+                    it = modelRegistry().erase(it);
+                }
+                else
+                {
+                    ++it;
+                }
             }
-            _session.reset(session);
-            status = _session->Create(_graphDef);
-            if (!status.ok())
+            for (auto it = graphRegistry().begin(); it != graphRegistry().end();)
             {
-                std::cerr<<"Error while loading graph into session: "+status.ToString()<<std::endl;
-                return false;
+                if (it->second.use_count()==1)
+                {
+                    it = graphRegistry().erase(it);
+                }
+                else
+                {
+                    ++it;
+                }
             }
-            _graphFilePath = std::string(filePath);
-            return true;
         }
 
         void addFeatureGroup(FeatureGroup* featureGroup)
@@ -461,12 +576,17 @@ class TFEval
 
                     //check input shapes
                     bool foundNode = false;
-                    for (int inode = 0; inode < _graphDef.node_size(); inode++)
+                    if (not _model)
                     {
-                        if (_graphDef.node(inode).name()==featureGroup->name())
+                        throw std::runtime_error("No graph/session loaded");
+                    }
+                    const tensorflow::GraphDef& graphDef = *_model->graphDef;
+                    for (int inode = 0; inode < graphDef.node_size(); inode++)
+                    {
+                        if (graphDef.node(inode).name()==featureGroup->name())
                         {
                             foundNode = true;
-                            auto tensor_shape = _graphDef.node(inode).attr().at("shape").shape();
+                            auto tensor_shape = graphDef.node(inode).attr().at("shape").shape();
                             auto group_shape = featureGroup->getShape();
                             //check rank
                             if (tensor_shape.dim_size()!=(int64_t)group_shape.size())
@@ -518,8 +638,11 @@ class TFEval
         Result evaluate(int64_t size, int64_t* jetIndex)
         {
             //extra safety mutex but should be single threaded if called from python
-            static std::mutex mutex;
-            std::lock_guard<std::mutex> guard(mutex);
+            std::lock_guard<std::mutex> guard(evaluationMutex());
+            if (_nStaged>0)
+            {
+                throw std::runtime_error("Staged inputs need to be evaluated first (evaluateStaged)");
+            }
             allocateInputs(size);
             for (int64_t i = 0; i < size; ++i)
             {
@@ -527,12 +650,88 @@ class TFEval
             }
             std::vector<tensorflow::Tensor> outputs;
 
-            if (not _session)
+            if (not _model)
+            {
+                throw std::runtime_error("No graph/session loaded");
+            }
+
+            tensorflow::Status status = _model->session->Run(_inputs,_outputNodeNames,{},&outputs);
+            if (!status.ok())
+            {
+                throw std::runtime_error("Error while loading graph into session: "+status.ToString());
+            }
+
+            return Result::fill(_outputNodeNames,outputs);
+        }
+
+        // grow the input tensors to at least batchSize rows, keeping the rows already staged
+        void reserveInputs(int64_t batchSize)
+        {
+            if (_nStaged==0)
+            {
+                allocateInputs(batchSize);
+                return;
+            }
+            if (_doReallocation)
+            {
+                throw std::runtime_error("Feature groups cannot be changed while inputs are staged");
+            }
+            const int64_t capacity = _inputs[0].second.dim_size(0);
+            if (capacity>=batchSize)
+            {
+                return;
+            }
+            const int64_t newCapacity = std::max(batchSize,2*capacity);
+            for (size_t i = 0; i < _inputs.size(); ++i)
+            {
+                tensorflow::Tensor tensor = _featureGroupsInModel[i]->createTensor(newCapacity);
+                const tensorflow::Tensor& staged = _inputs[i].second;
+                const int64_t rowSize = staged.NumElements()/capacity;
+                std::copy(staged.flat<float>().data(),staged.flat<float>().data()+_nStaged*rowSize,tensor.flat<float>().data());
+                _inputs[i].second = tensor;
+            }
+        }
+
+        // fill the inputs of the jets of the current entry after the ones staged before, to run them all
+        // at once with evaluateStaged; returns the index of the first one in its result
+        int64_t stage(int64_t size, int64_t* jetIndex)
+        {
+            std::lock_guard<std::mutex> guard(evaluationMutex());
+            reserveInputs(_nStaged+size);
+            for (int64_t i = 0; i < size; ++i)
+            {
+                fillInputs(jetIndex[i],_nStaged+i);
+            }
+            const int64_t first = _nStaged;
+            _nStaged += size;
+            return first;
+        }
+
+        int64_t staged() const
+        {
+            return _nStaged;
+        }
+
+        Result evaluateStaged()
+        {
+            std::lock_guard<std::mutex> guard(evaluationMutex());
+            if (not _model)
             {
                 throw std::runtime_error("No graph/session loaded");
             }
+            if (_nStaged==0)
+            {
+                throw std::runtime_error("No inputs have been staged");
+            }
+            std::vector<std::pair<std::string, tensorflow::Tensor>> inputs;
+            for (auto& input: _inputs)
+            {
+                inputs.emplace_back(input.first,input.second.Slice(0,_nStaged));
+            }
+            _nStaged = 0;
 
-            tensorflow::Status status = _session->Run(_inputs,_outputNodeNames,{},&outputs);
+            std::vector<tensorflow::Tensor> outputs;
+            tensorflow::Status status = _model->session->Run(inputs,_outputNodeNames,{},&outputs);
             if (!status.ok())
             {
                 throw std::runtime_error("Error while loading graph into session: "+status.ToString());
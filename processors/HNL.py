@@ -24,6 +24,14 @@ parser.add_argument('--input', dest='inputFiles', action='append', default=[])
 parser.add_argument('--noTagger', dest='noTagger', action='store_true', default=False)
 parser.add_argument('--skim', dest='skim', action='store_true', default=False)
 parser.add_argument('--profile', action='store_true', default=False)
+parser.add_argument('--nworkers', dest='nworkers', action='store', type=int, default=1)
+parser.add_argument('--pruneBranches', dest='pruneBranches', action='store', type=int, default=0, help='disable the input branches not read in the first N events of each file (0: off)')
+parser.add_argument('--outputBuffer', dest='outputBuffer', action='store', type=int, default=1000)
+parser.add_argument('--checkpoint', dest='checkpoint', action='store', type=int, default=0)
+parser.add_argument('--resume', dest='resume', action='store_true', default=False)
+parser.add_argument('--tfThreads', dest='tfThreads', action='store', type=int, default=1, help='TensorFlow intra-op threads of the tagger evaluation (0: all cores)')
+parser.add_argument('--deferEvents', dest='deferEvents', action='store', type=int, default=None, help='evaluate the tagger on the jets of this many events at once')
+parser.add_argument('--preselection', dest='preselection', action='store', choices=['draw', 'mt'], default='draw')
 parser.add_argument('output', nargs=1)
 
 args = parser.parse_args()
@@ -422,6 +430,8 @@ if isMC:
             },
             globalOptions=globalOptions,
             evalValues = np.linspace(-1.9,1.9,5*4),
+            intraOpThreads=args.tfThreads,
+            deferEvents=args.deferEvents,
         )
     )
 
@@ -561,6 +571,8 @@ else:
             },
             globalOptions=globalOptions,
             evalValues = np.linspace(-1.9,1.9,5*4),
+            intraOpThreads=args.tfThreads,
+            deferEvents=args.deferEvents,
         )
     )
 
@@ -631,7 +643,10 @@ if not globalOptions["isData"]:
                 lambda tree, event, coupling=coupling: tree.fillBranch('LHEWeights_coupling_%i'%coupling,getattr(event,"LHEWeights_coupling_%i"%coupling)),
             ])
 
-analyzerChain.append(EventInfo(storeVariables=storeVariables))
+analyzerChain.append(EventInfo(
+    storeVariables=storeVariables,
+    inputs=["PV_npvs", "PV_npvsGood", "fixedGridRhoFastjetAll", "Generator_weight", "LHEWeights_coupling_*"]
+))
 taggerTypes = ['TaggerMassReconstruction', 'EventCategorization', 'TaggerEvaluationProfiled']#, 'XGBEvaluation']
 
 if testMode:
@@ -648,7 +663,14 @@ p = PostProcessor(
     cut="(nJet>0)&&((nElectron+nMuon)>0)",
     modules=analyzerChain,
     maxEvents=-1,
-    friend=True
+    friend=True,
+    nworkers=args.nworkers,
+    profile=os.path.join(args.output[0], "profile.json") if args.profile else None,
+    pruneBranches=args.pruneBranches if args.pruneBranches > 0 else None,
+    outputBufferSize=args.outputBuffer if args.outputBuffer > 0 else None,
+    checkpointInterval=args.checkpoint if args.checkpoint > 0 else None,
+    resume=args.resume,
+    preselection=args.preselection
 )
 
 p.run()
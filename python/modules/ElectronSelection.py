@@ -72,6 +72,15 @@ class ElectronSelection(Module):
         if triggerMatch:
             self.trigger_object = lambda event: Collection(event, "TrigObj")
 
+        # input branches read by analyze; the selected electrons are used as four-vectors by the following modules
+        self.inputBranches = ["nElectron", "Electron_pt", "Electron_eta", "Electron_phi", "Electron_mass", "Electron_vidNestedWPBitmap"]
+        self.inputBranches += ["Electron_"+variable for variable in self.storeKinematics]
+        if electronID == "Inv": self.inputBranches += ["Electron_mvaFall17V2Iso_WPL", "Electron_pfRelIso03_all"]
+        elif electronID not in ["None", "Custom"]: self.inputBranches.append("Electron_mvaFall17V2"+electronID)
+        if electronIPCuts: self.inputBranches += ["Electron_dxy", "Electron_dz"]
+        self.inputBranches += ["nMuon", "Muon_eta", "Muon_phi"]
+        if triggerMatch: self.inputBranches += ["nTrigObj", "TrigObj_id", "TrigObj_eta", "TrigObj_phi"]
+
         id_hist_dict = {
                 2016: "2016LegacyReReco_ElectronMVAREPLACE_Fall17V2.root",
                 2017: "2017_ElectronMVAREPLACE.root",
@@ -146,6 +155,7 @@ class ElectronSelection(Module):
 
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         self.out = wrappedOutputTree
+        inputTree.declareInputs(*self.inputBranches)
         self.out.branch("n"+self.outputName, "I")
         if not self.globalOptions["isData"]:
             self.out.branch(self.outputName+"_weight_reco_nominal","F")
@@ -60,6 +60,8 @@ class EventCategorization(Module):
 
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         self.out = wrappedOutputTree
+        if self.globalOptions["isSignal"]:
+            inputTree.declareInputs("njetorigin", *["jetorigin_"+originFlag for originFlags in self.flags.values() for originFlag in originFlags])
         self.out.branch("n"+self.outputName, "I")
         self.out.branch(self.outputName+"_taggerBestOutputValue" , "F", lenVar="n"+self.outputName )
         self.out.branch(self.outputName+"_taggerBestOutputLabel", "F", lenVar="n"+self.outputName )
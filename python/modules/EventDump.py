@@ -53,6 +53,24 @@ class EventDump(Module):
         if self.blockchain_ref:
             print "matched: %i, mismatched: %i, missing: %i"%(self.matched,self.mismatched,self.missing)
         
+    def getState(self):
+        return {"nEvents": self.nEvents, "blockchain": self.blockchain,
+                "matched": self.matched, "missing": self.missing, "mismatched": self.mismatched}
+
+    def setState(self, state):
+        if state != None:
+            self.nEvents = state["nEvents"]
+            self.blockchain = dict(state["blockchain"])
+            self.matched, self.missing, self.mismatched = state["matched"], state["missing"], state["mismatched"]
+
+    def mergeState(self, state):
+        if state != None:
+            self.nEvents += state["nEvents"]
+            self.blockchain.update(state["blockchain"])
+            self.matched += state["matched"]
+            self.missing += state["missing"]
+            self.mismatched += state["mismatched"]
+
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         pass
         
@@ -11,9 +11,12 @@ from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
 class EventInfo(Module):
     def __init__(
         self,
-        storeVariables = []
+        storeVariables = [],
+        inputs = []
     ):
         self.storeVariables = storeVariables
+        # patterns of the input branches read by storeVariables, see InputTree.declareInputs
+        self.inputs = inputs
         
     def beginJob(self):
         pass
@@ -21,6 +24,7 @@ class EventInfo(Module):
         pass
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         self.out = wrappedOutputTree
+        inputTree.declareInputs(*self.inputs)
         for variable in self.storeVariables:
             variable[0](self.out)
         
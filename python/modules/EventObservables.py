@@ -34,6 +34,11 @@ class EventObservables(Module):
 
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         self.out = wrappedOutputTree
+        # the MET object is read from MET or METFixEE2017 (2017) when it isn't made by a previous module
+        inputTree.declareInputs(
+            "nJet", "Jet_pt", "Jet_eta", "Jet_phi", "Jet_mass",
+            "MET_pt", "MET_phi", "METFixEE2017_pt", "METFixEE2017_phi"
+        )
 
         self.out.branch(self.outputName+"_met", "F")
         self.out.branch(self.outputName+"_met_phi", "F")
@@ -223,6 +223,20 @@ class JetMetUncertainties(Module):
 
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         self.out = wrappedOutputTree
+        # the MET object is read from MET or METFixEE2017 (2017)
+        metBranches = ["pt", "phi", "MetUnclustEnUpDeltaX", "MetUnclustEnUpDeltaY"]+self.metKeys
+        inputTree.declareInputs(
+            "run", "luminosityBlock", "event", "fixedGridRhoFastjetAll",
+            "nJet", "Jet_pt", "Jet_eta", "Jet_phi", "Jet_mass", "Jet_neEmEF", "Jet_chEmEF",
+            "nCorrT1METJet", "CorrT1METJet_rawPt", "CorrT1METJet_eta", "CorrT1METJet_phi",
+            "nGenJet", "GenJet_pt", "GenJet_eta", "GenJet_phi", "GenJet_mass",
+            *(["Jet_"+key for key in self.jetKeys]+["MET_"+name for name in metBranches]+["METFixEE2017_"+name for name in metBranches])
+        )
+        if self.propagateJER:
+            inputTree.declareInputs(
+                "nMuon", "Muon_pt", "Muon_eta", "Muon_phi", "Muon_mass",
+                "nElectron", "Electron_pt", "Electron_eta", "Electron_phi", "Electron_mass"
+            )
         
     def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         pass
@@ -4,6 +4,7 @@ import math
 import json
 import ROOT
 import random
+import numpy as np
 
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection
 from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
@@ -61,6 +62,12 @@ class JetSelection(Module):
 
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         self.out = wrappedOutputTree
+        inputTree.declareInputs(
+            "nJet", "Jet_pt", "Jet_eta", "Jet_phi", "Jet_mass", "Jet_jetId",
+            *["Jet_"+variable for variable in self.storeKinematics]
+        )
+        if self.jetMinNConstituents > 0:
+            inputTree.declareInputs("Jet_nConstituents")
         if self.flagDA:
             self.out.branch(self.outputName+"_forDA", "F", lenVar="nJet")
 
@@ -71,6 +78,17 @@ class JetSelection(Module):
     def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         pass
 
+    def preselect(self, jets):
+        """boolean masks of the jets passing the eta and jet id cuts, and of those also passing the constituent cut"""
+        absEta = np.abs(jets.array("eta"))
+        mask = ~(absEta > self.jetMaxEta)
+        if self.jetMinEta > 0.:
+            mask &= ~(absEta < self.jetMinEta)
+        mask &= (jets.array("jetId") & (1 << self.jetId)) != 0
+        if self.jetMinNConstituents > 0:
+            return mask, mask & (jets.array("nConstituents") >= self.jetMinNConstituents)
+        return mask, mask
+
     def analyze(self, event):
         """process event, return True (go to next module) or False (fail, go to next event)"""
 
@@ -85,22 +103,33 @@ class JetSelection(Module):
         if self.flagDA:
             flagsDA = [0.]*event.nJet
 
-        for jet in jets:
-            if math.fabs(jet.eta) > self.jetMaxEta:
-                unselectedJets.append(jet)
-                continue
-                
-            if (self.jetMinEta>0.) and (math.fabs(jet.eta) < self.jetMinEta):
-                unselectedJets.append(jet)
-                continue
-                
-            if (jet.jetId & (1 << self.jetId)) == 0:
-                unselectedJets.append(jet)
-                continue
-                
-            if self.jetMinNConstituents > 0 and jet.nConstituents < self.jetMinNConstituents:
-                unselectedJets.append(jet.nConstituents)
-                continue
+        # apply the cuts on the input branches to all jets at once when reading a collection
+        preselection, constituentSelection = self.preselect(jets) if isinstance(jets, Collection) else (None, None)
+
+        for ijet, jet in enumerate(jets):
+            if preselection is not None:
+                if not preselection[ijet]:
+                    unselectedJets.append(jet)
+                    continue
+                if not constituentSelection[ijet]:
+                    unselectedJets.append(jet.nConstituents)
+                    continue
+            else:
+                if math.fabs(jet.eta) > self.jetMaxEta:
+                    unselectedJets.append(jet)
+                    continue
+                    
+                if (self.jetMinEta>0.) and (math.fabs(jet.eta) < self.jetMinEta):
+                    unselectedJets.append(jet)
+                    continue
+                    
+                if (jet.jetId & (1 << self.jetId)) == 0:
+                    unselectedJets.append(jet)
+                    continue
+                    
+                if self.jetMinNConstituents > 0 and jet.nConstituents < self.jetMinNConstituents:
+                    unselectedJets.append(jet.nConstituents)
+                    continue
 
             minDeltaRSubtraction = 999.
 
@@ -55,6 +55,8 @@ class JetTruthFlags(Module):
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         self.out = wrappedOutputTree
         if not self.globalOptions['isData']:
+            originFlags = [ originFlag for originFlags in self.flags.values() for originFlag in originFlags ]
+            inputTree.declareInputs("njetorigin", *["jetorigin_"+name for name in originFlags+self.latentVariables])
             for latentVariable in self.latentVariables:
                 self.out.branch(self.outputName+"_"+latentVariable, "F",
                                 lenVar="n"+self.outputName)
@@ -176,6 +176,16 @@ class MuonSelection(Module):
             print "Error - invalid year"
             sys.exit(1)
 
+        # input branches read by analyze; the selected muons are used as four-vectors by the following modules
+        self.inputBranches = ["nMuon", "Muon_pt", "Muon_eta", "Muon_phi", "Muon_mass"]
+        self.inputBranches += ["Muon_"+variable for variable in self.storeKinematics]
+        if muonID==MuonSelection.TIGHT: self.inputBranches.append("Muon_tightId")
+        elif muonID==MuonSelection.LOOSE: self.inputBranches.append("Muon_looseId")
+        if muonIso!=MuonSelection.NONE: self.inputBranches.append("Muon_pfRelIso04_all")
+        if self.muonMaxDxy > 0.: self.inputBranches.append("Muon_dxy")
+        if self.muonMaxDz > 0.: self.inputBranches.append("Muon_dz")
+        if triggerMatch: self.inputBranches += ["nTrigObj", "TrigObj_id", "TrigObj_eta", "TrigObj_phi"]
+
         if muonID==MuonSelection.TIGHT:
             self.muonId = lambda muon: muon.tightId==1
             self.muonIdSF = self.idTightSFHist
@@ -240,6 +250,7 @@ class MuonSelection(Module):
         
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         self.out = wrappedOutputTree
+        inputTree.declareInputs(*self.inputBranches)
         self.out.branch("n"+self.outputName, "I")
 
         for variable in self.storeKinematics:
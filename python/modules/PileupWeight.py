@@ -21,6 +21,9 @@ class PileupWeight(Module):
         self.processName = processName
 
     def beginJob(self):
+        self.n, self.sum, self.sum2 = 0, 0, 0
+        # sums of all files, to which endFile or mergeState (when running with several workers) add
+        self.jobSums = {"n": 0, "sum": 0, "sum2": 0}
         if not self.globalOptions["isData"]:
             if self.globalOptions["year"] == 2016:
                 #read in up and down files
@@ -81,7 +84,14 @@ class PileupWeight(Module):
         return w
 
     def endJob(self):
-        pass
+        self.printAverage(self.jobSums["n"], self.jobSums["sum"], self.jobSums["sum2"], "all files")
+
+    def printAverage(self, n, sum, sum2, what):
+        if not self.globalOptions["isData"] and n>0 and (sum2/(1.*n))>(sum**2/(1.*n**2)):
+            avg = 1.*sum/n
+            sig = math.sqrt(sum2/(1.*n)-sum**2/(1.*n**2))
+
+            print "Average pileup weight (%s, %s): %6.3f +- %6.3f"%(self.outputName,what,avg,sig)
 
     def normHist(self,hist):
         #normalization makes weight independent of binning scheme/range of histograms
@@ -120,6 +130,7 @@ class PileupWeight(Module):
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         self.out = wrappedOutputTree
         if not self.globalOptions["isData"]:
+            inputTree.declareInputs("Pileup_nTrueInt")
             self.mcHist = None
             for process in self.mcHistPerProcess.keys():
                 processName = inputFile.GetName()
@@ -143,11 +154,21 @@ class PileupWeight(Module):
             self.n = 0
 
     def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
-        if not self.globalOptions["isData"] and self.n>0 and (self.sum2/(1.*self.n))>(self.sum**2/(1.*self.n**2)):
-            avg = 1.*self.sum/self.n
-            sig = math.sqrt(self.sum2/(1.*self.n)-self.sum**2/(1.*self.n**2))
+        self.printAverage(self.n, self.sum, self.sum2, inputFile.GetName())
+        if not self.globalOptions["isData"]:
+            self.mergeState(self.getState())
+
+    def getState(self):
+        if self.globalOptions["isData"]: return None
+        return {"n": self.n, "sum": self.sum, "sum2": self.sum2}
+
+    def setState(self, state):
+        if state != None:
+            self.n, self.sum, self.sum2 = state["n"], state["sum"], state["sum2"]
 
-            print "Average pileup weight (%s): %6.3f +- %6.3f"%(self.outputName,avg,sig)
+    def mergeState(self, state):
+        if state != None:
+            for k in self.jobSums.keys(): self.jobSums[k] += state[k]
 
     def analyze(self, event):
         if not self.globalOptions["isData"]:
@@ -50,6 +50,8 @@ class SimplifiedEventCategorization(Module):
 
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         self.out = wrappedOutputTree
+        if self.globalOptions["isSignal"]:
+            inputTree.declareInputs("njetorigin", *["jetorigin_"+originFlag for originFlags in self.flags.values() for originFlag in originFlags])
         self.out.branch(self.outputName+"_index", "I")
         self.out.branch("n"+self.outputName+"_Jets", "I")
         self.out.branch("n"+self.outputName+"_lepJets", "I")
@@ -69,6 +69,7 @@ class SingleElectronTriggerSelection(Module):
         
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         self.out = wrappedOutputTree
+        inputTree.declareInputs("HLT_Ele27_WPTight_Gsf", "HLT_Ele32_WPTight_Gsf_L1DoubleEG", "HLT_Ele32_WPTight_Gsf")
         
         self.out.branch(self.outputName+"_flag","I")
         
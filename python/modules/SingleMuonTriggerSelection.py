@@ -67,6 +67,7 @@ class SingleMuonTriggerSelection(Module):
         
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         self.out = wrappedOutputTree
+        inputTree.declareInputs("HLT_IsoMu24", "HLT_IsoTkMu24", "HLT_IsoMu27")
         
         self.out.branch(self.outputName+"_flag","I")
         
@@ -24,8 +24,13 @@ class TaggerEvaluation(Module):
         evalValues = range(-1, 4),
         integrateDisplacementOrder = 2,
         globalOptions = {"isData":False},
+        intraOpThreads = 1,
+        interOpThreads = 1,
     ):
         self.globalOptions = globalOptions
+        # TensorFlow threads of the session, which is shared by all modules loading the same model with the same threads
+        self.intraOpThreads = intraOpThreads
+        self.interOpThreads = interOpThreads
         self.inputCollections = inputCollections
         self.predictionLabels = predictionLabels
         self.evalValues = evalValues
@@ -43,13 +48,22 @@ class TaggerEvaluation(Module):
         self.taggerName = taggerName
 
     def beginJob(self):
-        pass
+        # read the graph before the worker processes are forked, so that they share it; each makes its session
+        if (not ROOT.TFEval.preloadGraph(self.modelPath)):
+            sys.exit(1)
 
     def endJob(self):
-        pass
+        # the graph and session stay loaded for the other files until the end of the job
+        self.tfEvalParametric = None
+        ROOT.TFEval.releaseGraphs()
 
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         self.out = wrappedOutputTree
+        inputBranches = ["nglobal", "global_jetIdx"]
+        for featureCfg in self.featureDict.itervalues():
+            if featureCfg.has_key("max"): inputBranches.append(featureCfg["length"])
+            inputBranches += featureCfg["branches"]
+        inputTree.declareInputs(*inputBranches)
         self.setup(inputTree)
 
 
@@ -58,7 +72,7 @@ class TaggerEvaluation(Module):
         tfEval = ROOT.TFEval()
         print "Succesfully built TFEval object"
 
-        if (not tfEval.loadGraph(modelFile)):
+        if (not tfEval.loadGraph(modelFile, self.intraOpThreads, self.interOpThreads)):
             sys.exit(1)
         tfEval.addOutputNodeName("prediction")
         print "--- Model: ",modelFile," ---"
@@ -9,7 +9,7 @@ import time
 import imp
 
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Collection
-from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module
+from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module, DEFERRED
 
 from utils import getCtauLabel, getAbscissasAndWeights
 
@@ -27,8 +27,18 @@ class TaggerEvaluationProfiled(Module):
                             'LLP_QMU': [ 'LLP_QMU']
                             },
         globalOptions = {"isData":False},
+        intraOpThreads = 1,
+        interOpThreads = 1,
+        deferEvents = None,
     ):
         self.globalOptions = globalOptions
+        # TensorFlow threads of the session, which is shared by all modules loading the same model with the same threads
+        self.intraOpThreads = intraOpThreads
+        self.interOpThreads = interOpThreads
+        # if set, the jets of this many events are evaluated in one session call (see eventloop.DEFERRED)
+        self.deferEvents = deferEvents
+        self._staged = []
+        self._outputs = {}
         self.inputCollections = inputCollections
 
         self.evalValues = list(evalValues)
@@ -59,14 +69,23 @@ class TaggerEvaluationProfiled(Module):
 
 
     def beginJob(self):
-        pass
+        # read the graph before the worker processes are forked, so that they share it; each makes its session
+        if (not ROOT.TFEval.preloadGraph(self.modelPath)):
+            sys.exit(1)
 
 
     def endJob(self):
-        pass
+        # the graph and session stay loaded for the other files until the end of the job
+        self.tfEvalParametric = None
+        ROOT.TFEval.releaseGraphs()
 
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         self.out = wrappedOutputTree
+        inputBranches = ["nglobal", "global_jetIdx"]
+        for featureCfg in self.featureDict.itervalues():
+            if featureCfg.has_key("max"): inputBranches.append(featureCfg["length"])
+            inputBranches += featureCfg["branches"]
+        inputTree.declareInputs(*inputBranches)
         self.setup(inputTree)
 
 
@@ -75,7 +94,7 @@ class TaggerEvaluationProfiled(Module):
         tfEval = ROOT.TFEval()
         print "Succesfully built TFEval object"
 
-        if (not tfEval.loadGraph(modelFile)):
+        if (not tfEval.loadGraph(modelFile, self.intraOpThreads, self.interOpThreads)):
             sys.exit(1)
         tfEval.addOutputNodeName("prediction")
         print "--- Model: ",modelFile," ---"
@@ -154,6 +173,8 @@ class TaggerEvaluationProfiled(Module):
 
 
         if event._tree._ttreereaderversion > self._ttreereaderversion:
+            # the staged inputs were read with the previous readers
+            self.runDeferred()
             self.setup(event._tree)
 
         self.nJets = len(jetglobal)
@@ -174,11 +195,35 @@ class TaggerEvaluationProfiled(Module):
 
         evaluationIndices = np.array(evaluationIndices,np.int64)
 
+        if self.deferEvents:
+            first = self.tfEvalParametric.stage(
+                evaluationIndices.shape[0],
+                evaluationIndices
+            )
+            self._staged.append((event, jetOriginIndices, first))
+            return DEFERRED
+
         result = self.tfEvalParametric.evaluate(
             evaluationIndices.shape[0],
             evaluationIndices
         )
+        self.setOutputs(event, self.profile(result, jetOriginIndices))
+        return True
 
+    def runDeferred(self):
+        if len(self._staged)==0:
+            return
+        result = self.tfEvalParametric.evaluateStaged()
+        for event, jetOriginIndices, first in self._staged:
+            self._outputs[id(event)] = self.profile(result, jetOriginIndices, first)
+        self._staged = []
+
+    def resume(self, event):
+        self.setOutputs(event, self._outputs.pop(id(event)))
+        return True
+
+    def profile(self, result, jetOriginIndices, first=0):
+        """profiled outputs per global jet index from the predictions starting at index first of result"""
         outputPerIndex = {}
 
         for ijet,jetIndex in enumerate(jetOriginIndices):
@@ -197,7 +242,7 @@ class TaggerEvaluationProfiled(Module):
             
 
             for ivalue, value in enumerate(self.evalValues):
-                predictionIndex = ijet*len(self.evalValues)+ivalue
+                predictionIndex = first+ijet*len(self.evalValues)+ivalue
                 predictions = result.get("prediction",predictionIndex)
                 
                 sumSubPrediction = 0.
@@ -239,8 +284,9 @@ class TaggerEvaluationProfiled(Module):
                 outputPerIndex[jetIndex]['avg'][profiledLabelKey] = {
                     'output': avgPrediction[profiledLabelKey], 'parameter': valueAvgPrediction[profiledLabelKey]
                 }
+        return outputPerIndex
 
-
+    def setOutputs(self, event, outputPerIndex):
         for jetCollection in self.inputCollections:
             jets = jetCollection(event)
 
@@ -255,6 +301,3 @@ class TaggerEvaluationProfiled(Module):
                         for profiledLabelKey in self.profiledLabelDict.keys():
                             taggerOutput[k][profiledLabelKey] = {'output': -1., 'parameter': -10}
                     setattr(jet, self.taggerName, taggerOutput)
-        return True
-        
-        
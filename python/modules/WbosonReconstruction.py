@@ -31,6 +31,8 @@ class WbosonReconstruction(Module):
         
     def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         self.out = wrappedOutputTree
+        # the MET object is read from MET or METFixEE2017 (2017) when it isn't made by a previous module
+        inputTree.declareInputs("MET_pt", "MET_phi", "METFixEE2017_pt", "METFixEE2017_phi")
         self.out.branch(self.leptonCollectionName+"_"+self.outputName+"_mtw", "F",lenVar='n'+self.leptonCollectionName)
         self.out.branch(self.leptonCollectionName+"_"+self.outputName+"_deltaPhi", "F",lenVar='n'+self.leptonCollectionName)
             
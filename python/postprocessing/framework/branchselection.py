@@ -1,4 +1,5 @@
 import re
+import fnmatch
 
 class BranchSelection:
     def __init__(self,filename):
@@ -31,3 +32,12 @@ class BranchSelection:
                     if re.match(bre, n): tree.SetBranchStatus(n, stat)
             else:
                 tree.SetBranchStatus(bre, stat)
+    def isSelected(self,branchName):
+        """Return whether branchName would be active after selectBranches (wildcards matched as by SetBranchStatus)"""
+        stat = 1
+        for bre, st in self._ops:
+            if type(bre) == re._pattern_type:
+                if re.match(bre, branchName): stat = st
+            elif fnmatch.fnmatchcase(branchName, bre):
+                stat = st
+        return stat == 1
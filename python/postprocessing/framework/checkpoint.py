@@ -0,0 +1,67 @@
+import os
+import pickle
+
+class Checkpoint:
+    """Saves every interval entries the position in the event loop, the output entries written so far and
+       the state of the modules (see Module.getState), so that the processing of an input file can be
+       resumed from there after the job was killed. task identifies the input file and entry range."""
+    def __init__(self, fileName, task, modules, outputTree, interval):
+        self.fileName = fileName
+        self.task = task
+        self.modules = modules
+        self.outputTree = outputTree
+        self.interval = interval
+        self.startIndex = 0
+        self.done = 0
+        self.accepted = 0
+        self._state = None
+    def load(self):
+        """read the last checkpoint, if any, and return it"""
+        if not os.path.exists(self.fileName): return None
+        with open(self.fileName, "rb") as f:
+            state = pickle.load(f)
+        if state["task"] != self.task:
+            raise RuntimeError("Checkpoint %s was made for %s, not for %s" % (self.fileName, state["task"], self.task))
+        self._state = state
+        self.startIndex = state["index"]
+        self.done = state["done"]
+        self.accepted = state["accepted"]
+        return state
+    def restore(self):
+        """restore the state of the output tree and of the modules, after their beginFile"""
+        if not self._state: return
+        if self.outputTree:
+            if self.outputTree.tree().GetEntries() != self._state["outputEntries"]:
+                raise RuntimeError("The output has %d entries instead of %d at the last checkpoint, remove it and %s to start again" % (
+                    self.outputTree.tree().GetEntries(), self._state["outputEntries"], self.fileName))
+            self.outputTree.setState(self._state["output"])
+        self.restoreModules()
+        print "Resumed from entry %d of the event loop (%d entries already processed)" % (self.startIndex, self.done)
+    def restoreModules(self):
+        if not self._state: return
+        for m, state in zip(self.modules, self._state["modules"]):
+            m.setState(state)
+    def save(self, index, done, accepted):
+        """write the output entries filled so far and the state after the first index entries of the event loop;
+           done and accepted are counted since the last resume"""
+        if self.outputTree: self.outputTree.checkpoint()
+        self._write({
+            "task": self.task,
+            "index": index,
+            "done": self.done+done,
+            "accepted": self.accepted+accepted,
+            "outputEntries": self.outputTree.tree().GetEntries() if self.outputTree else 0,
+            "output": self.outputTree.getState() if self.outputTree else None,
+            "modules": [ m.getState() for m in self.modules ],
+            "finished": False,
+        })
+    def finish(self, done, accepted, entries):
+        """mark the task as done, so that it is skipped when resuming; the modules state is kept,
+           as it is accumulated over the input files"""
+        self._write({ "task": self.task, "index": None, "done": done, "accepted": accepted, "entries": entries,
+                      "modules": [ m.getState() for m in self.modules ], "finished": True })
+    def _write(self, state):
+        tmpName = self.fileName+".tmp"
+        with open(tmpName, "wb") as f:
+            pickle.dump(state, f, 2)
+        os.rename(tmpName, self.fileName)
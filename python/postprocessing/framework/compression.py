@@ -0,0 +1,63 @@
+import time
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+
+# candidates of the automatic choice, from the fastest to the smallest output
+_autoCandidates = [ "LZ4:4", "ZSTD:1", "ZLIB:1", "ZSTD:5", "ZLIB:6", "LZMA:4", "LZMA:9" ]
+
+def compressionAlgorithm(algo):
+    """return the ROOT enum value of the compression algorithm algo (ZLIB, LZMA, LZ4 or ZSTD)"""
+    ROOT.gInterpreter.ProcessLine("#include <Compression.h>")
+    if algo not in ("ZLIB", "LZMA", "LZ4", "ZSTD"): raise RuntimeError("Unsupported compression %s" % algo)
+    ret = getattr(ROOT.ROOT, "k"+algo, None)
+    if ret == None: raise RuntimeError("Compression %s is not supported by this version of ROOT" % algo)
+    return ret
+
+def parseCompression(compression):
+    """return (algorithm, level, settings) for a compression given as (algo):(level)"""
+    (algo, level) = compression.split(":")
+    algorithm = compressionAlgorithm(algo)
+    return algorithm, int(level), ROOT.ROOT.CompressionSettings(algorithm, int(level))
+
+def chooseCompression(tree, target="speed=20", nentries=1000, candidates=_autoCandidates):
+    """Write the first nentries of tree (with the active branches only) with several compression settings,
+       and return the chosen (algo):(level) and the measurements.
+
+       The target is either speed=(MB/s): the smallest output written at least that fast (uncompressed
+       MB per second), or ratio=(x): the fastest setting with at least that compression ratio.
+    """
+    (what, value) = target.split("=")
+    if what not in ("speed", "ratio"): raise RuntimeError("Unknown compression target %s" % target)
+    value = float(value)
+    # keep the sample uncompressed in memory, so that reading it back costs the same for all candidates
+    sampleFile = ROOT.TMemFile("compressionSample.root", "RECREATE", "", 0)
+    sample = tree.CopyTree("1", "", nentries)
+    measurements = []
+    for candidate in candidates:
+        try:
+            (algorithm, level, settings) = parseCompression(candidate)
+        except RuntimeError:
+            continue
+        outFile = ROOT.TMemFile("compressionBenchmark.root", "RECREATE", "", settings)
+        t0 = time.time()
+        out = sample.CopyTree("1")
+        out.FlushBaskets()
+        seconds = max(time.time()-t0, 1e-6)
+        totBytes, zipBytes = out.GetTotBytes(), out.GetZipBytes()
+        measurements.append({
+            "compression": candidate,
+            "seconds": seconds,
+            "bytes": zipBytes,
+            "ratio": totBytes/float(max(zipBytes,1)),
+            "speed": totBytes/1024.**2/seconds,
+        })
+        outFile.Close()
+    sampleFile.Close()
+    if not measurements: raise RuntimeError("No compression algorithm available")
+    if what == "speed":
+        passing = [ m for m in measurements if m["speed"] >= value ]
+        chosen = min(passing, key=lambda m: m["bytes"]) if passing else max(measurements, key=lambda m: m["speed"])
+    else:
+        passing = [ m for m in measurements if m["ratio"] >= value ]
+        chosen = max(passing, key=lambda m: m["speed"]) if passing else max(measurements, key=lambda m: m["ratio"])
+    return chosen["compression"], measurements
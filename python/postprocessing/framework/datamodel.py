@@ -1,7 +1,9 @@
 import ROOT
+import copy
 import math
+import numpy
 ROOT.PyConfig.IgnoreCommandLineOptions = True
-from PhysicsTools.NanoAODTools.postprocessing.framework.treeReaderArrayTools import InputTree 
+from PhysicsTools.NanoAODTools.postprocessing.framework.treeReaderArrayTools import InputTree, readColumn, restorePrunedBranches
 
 class Event:
     """Class that allows seeing an entry of a PyROOT TTree as an Event"""
@@ -29,6 +31,7 @@ class Event:
             warnings.filterwarnings(action='ignore', category=RuntimeWarning, 
                                     message='creating converter for unknown type "const char\*\[\]"$')
         if expr not in self._tree._exprs:
+            restorePrunedBranches(self._tree)
             formula = ROOT.TTreeFormula(expr,expr,self._tree)
             if formula.IsInteger():
                 formula.go = formula.EvalInstance64
@@ -97,12 +100,76 @@ class Collection:
         else:
             self._len = getattr(event,"n"+prefix)
         self._cache = {}
+        self._indices = None
     def __getitem__(self,index):
+        if isinstance(index,(numpy.ndarray,list,slice)): return self._select(index)
+        if index >= len(self): raise IndexError, "Invalid index %r (len is %r) at %s" % (index,len(self),self._prefix)
+        if self._indices is not None: index = int(self._indices[index])
         if type(index) == int and index in self._cache: return self._cache[index]
-        if index >= self._len: raise IndexError, "Invalid index %r (len is %r) at %s" % (index,self._len,self._prefix)
         ret = Object(self._event,self._prefix,index=index)
         if type(index) == int: self._cache[index] = ret
         return ret
     def __len__(self):
-        return self._len
+        return self._len if self._indices is None else len(self._indices)
+    def indices(self):
+        """Return the positions of the objects of this collection in the original branches (their _index)"""
+        return numpy.arange(self._len) if self._indices is None else self._indices
+    def array(self,name):
+        """Return branch prefix_name for all objects of the collection as a NumPy array.
 
+           For a full collection this is a read-only view of the reader's buffer (no copy), valid
+           until the next entry is read; sub-collections return a copy of the selected values.
+        """
+        values = self._event._tree.arrayView(self._prefix+"_"+name)[:self._len]
+        return values if self._indices is None else values[self._indices]
+    def _select(self,selection):
+        """Return a sub-collection with the objects picked by a boolean mask, an array of positions or a slice.
+           Objects are shared with this collection and keep their original _index."""
+        ret = copy.copy(self)
+        if isinstance(selection,list):
+            selection = numpy.asarray(selection) if selection else numpy.zeros(0,dtype=numpy.int64)
+        ret._indices = self.indices()[selection]
+        return ret
+
+
+class JaggedColumn:
+    """Variable-length array branch read for a chunk of entries, as flat content plus per-entry offsets"""
+    def __init__(self,content,counts):
+        self.content = content
+        self.counts = counts
+        self.offsets = numpy.zeros(len(counts)+1,dtype=numpy.int64)
+        numpy.cumsum(counts,out=self.offsets[1:])
+    def __getitem__(self,index):
+        return self.content[self.offsets[index]:self.offsets[index+1]]
+    def __len__(self):
+        return len(self.counts)
+    def parents(self):
+        """Return for each element of the flat content the position of the entry it belongs to"""
+        return numpy.repeat(numpy.arange(len(self.counts)),self.counts)
+
+class Batch:
+    """Class that allows seeing a chunk of consecutive entries of a PyROOT TTree as NumPy columns
+
+       Single-value branches are returned as arrays with one value per entry,
+       variable-length arrays as JaggedColumn. Columns are read on first access and cached.
+    """
+    def __init__(self,tree,first,n):
+        self._tree = tree
+        self._first = first
+        self._n = n
+        self._columns = {}
+    def __getattr__(self,name):
+        if name in self.__dict__: return self.__dict__[name]
+        if name[:2] == "__" and name[-2:] == "__":
+            raise AttributeError
+        if name not in self._columns:
+            values, counts = readColumn(self._tree,name,self._first,self._n,getattr(self._tree,'_entrylist',None))
+            self._columns[name] = values if counts is None else JaggedColumn(values,counts)
+        return self._columns[name]
+    def __getitem__(self,attr):
+        return self.__getattr__(attr)
+    def __len__(self):
+        return self._n
+    def entries(self):
+        """Return the entry numbers covered by this batch"""
+        return numpy.arange(self._first,self._first+self._n)
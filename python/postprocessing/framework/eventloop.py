@@ -1,8 +1,11 @@
-from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Event
+from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import Event, Batch
 from PhysicsTools.NanoAODTools.postprocessing.framework.treeReaderArrayTools import clearExtraBranches
-import sys, time
+import sys, time, itertools
 import ROOT
 
+# returned by Module.analyze to finish the event later, once the module computed the products of several events at once
+DEFERRED = object()
+
 class Module(object):
     def __init__(self):
         self.writeHistFile=False
@@ -30,8 +33,39 @@ class Module(object):
     def endFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
         pass
     def analyze(self, event):
-        """process event, return True (go to next module) or False (fail, go to next event)"""
+        """process event, return True (go to next module) or False (fail, go to next event);
+           modules with deferEvents set may also return DEFERRED, see resume"""
+        pass
+    def runDeferred(self):
+        """compute the products of the events for which analyze returned DEFERRED; called when deferEvents
+           events are waiting, at the end of the file and before checkpoints"""
         pass
+    def resume(self, event):
+        """finish an event deferred by analyze after runDeferred, return True or False as analyze;
+           the following modules are then run on the kept events in entry order, see eventLoop"""
+        return True
+    def analyzeBatch(self, batch):
+        """process a chunk of consecutive events read as columns (see datamodel.Batch) and return a boolean
+           accept mask with one value per event, or None to have analyze called on each event instead"""
+        return None
+    def getState(self):
+        """return what the module accumulated so far, to be saved in checkpoints (must be picklable);
+           by default the objects booked for the histogram file"""
+        if hasattr(self, 'objs') and self.objs != None:
+            return dict((obj.GetName(), obj) for obj in self.objs)
+        return None
+    def setState(self, state):
+        """restore the state returned by getState when resuming from a checkpoint"""
+        if state != None:
+            for obj in self.objs:
+                obj.Reset()
+                obj.Add(state[obj.GetName()])
+    def mergeState(self, state):
+        """add the state returned by getState of a copy of the module that processed other events, e.g. in a
+           worker process (see PostProcessor), before endJob"""
+        if state != None:
+            for obj in self.objs:
+                obj.Add(state[obj.GetName()])
     def addObject(self, obj ):
         setattr( self, obj.GetName(), obj )
         self.objs.append( getattr( self, obj.GetName() ) )
@@ -43,35 +77,169 @@ class Module(object):
             self.objs.append( getattr( self, obj.GetName() + '_' + name ) )
         setattr( self, obj.GetName(), objlist )
 
-def eventLoop(modules, inputFile, outputFile, inputTree, wrappedOutputTree, maxEvents=-1, eventRange=None, progress=(10000,sys.stdout), filterOutput=True): 
+def eventLoop(modules, inputFile, outputFile, inputTree, wrappedOutputTree, maxEvents=-1, eventRange=None, progress=(10000,sys.stdout), filterOutput=True, batchSize=None, profiler=None, checkpoint=None): 
+    if profiler: profiler.attach(inputTree)
     for m in modules: 
-        m.beginFile(inputFile, outputFile, inputTree, wrappedOutputTree)
+        if profiler: profiler.beginFile(m, inputFile, outputFile, inputTree, wrappedOutputTree)
+        else: m.beginFile(inputFile, outputFile, inputTree, wrappedOutputTree)
+    if checkpoint: checkpoint.restore()
+    startIndex = checkpoint.startIndex if checkpoint else 0
 
     t0 = time.time(); tlast = t0; doneEvents = 0; acceptedEvents = 0
     entries = inputTree.entries
     if eventRange: entries = len(eventRange)
     if maxEvents > 0: entries = min(entries, maxEvents)
 
-    for ie,i in enumerate(xrange(entries) if eventRange == None else eventRange):
+    batchStart = 0; batchEnd = 0; masks = None
+    deferred = _DeferredEvents(modules, inputTree, wrappedOutputTree, filterOutput, profiler) if any(getattr(m, 'deferEvents', None) for m in modules) else None
+    # when resuming from a checkpoint, the first startIndex entries were already processed
+    for ie,i in itertools.islice(enumerate(xrange(entries) if eventRange == None else eventRange), startIndex, None):
         if maxEvents > 0 and ie >= maxEvents: break
+        if batchSize and ie >= batchEnd:
+            # the masks of the previous chunk are needed to finish its deferred events
+            if deferred: acceptedEvents += deferred.flush(masks, batchStart)
+            # columns are read before the readers move to the first entry of the chunk
+            batchStart = ie
+            batchEnd = ie + _batchLength(eventRange, ie, i, entries, batchSize)
+            batch = Batch(inputTree, i, batchEnd-batchStart)
+            masks = [profiler.analyzeBatch(m, batch) if profiler else m.analyzeBatch(batch) for m in modules]
         e = Event(inputTree,i)
         clearExtraBranches(inputTree)
         doneEvents += 1
-        ret = True
-        for m in modules: 
-            ret = m.analyze(e) 
-            if not ret: break
-        if ret:
-            acceptedEvents += 1
-        if (ret or not filterOutput) and wrappedOutputTree != None: 
-            wrappedOutputTree.fill()
+        if deferred:
+            # None while the event is kept until the products of the deferred events are computed
+            ret = deferred.analyze(ie, i, e, masks, batchStart)
+            if deferred.ready(): acceptedEvents += deferred.flush(masks, batchStart)
+        else:
+            ret, im = _analyze(modules, 0, e, ie, masks, batchStart, profiler)
+        if ret is not None:
+            if ret:
+                acceptedEvents += 1
+            if (ret or not filterOutput) and wrappedOutputTree != None: 
+                wrappedOutputTree.fill()
+        if checkpoint and checkpoint.interval and (ie+1) % checkpoint.interval == 0:
+            if deferred: acceptedEvents += deferred.flush(masks, batchStart)
+            checkpoint.save(ie+1, doneEvents, acceptedEvents)
         if progress:
             if ie > 0 and ie % progress[0] == 0:
                 t1 = time.time()
                 progress[1].write("Processed %8d/%8d entries, %5.2f%% (elapsed time %7.1fs, curr speed %8.3f kHz, avg speed %8.3f kHz), accepted %8d/%8d events (%5.2f%%)\n" % (
                         ie,entries, ie/float(0.01*entries), t1-t0, (progress[0]/1000.)/(max(t1-tlast,1e-9)), ie/1000./(max(t1-t0,1e-9)), acceptedEvents, doneEvents, acceptedEvents/(0.01*doneEvents) ))
                 tlast = t1
+    if deferred: acceptedEvents += deferred.flush(masks, batchStart)
     for m in modules: 
-        m.endFile(inputFile, outputFile, inputTree, wrappedOutputTree)
+        if profiler: profiler.endFile(m, inputFile, outputFile, inputTree, wrappedOutputTree)
+        else: m.endFile(inputFile, outputFile, inputTree, wrappedOutputTree)
 
+    if inputTree._undeclaredReads:
+        print "%d branches were read without being declared in beginFile (inputTree.declareInputs), the readers were remade %d times: %s" % (
+            len(inputTree._undeclaredReads), inputTree._ttreereaderversion-1,
+            ", ".join("%s (entry %d)" % (name, entry) for name, entry in sorted(inputTree._undeclaredReads.iteritems(), key=lambda x: x[1])))
+    if profiler: profiler.addFile(inputFile.GetName(), doneEvents, acceptedEvents, time.time() - t0)
     return (doneEvents, acceptedEvents, time.time() - t0)
+
+def _batchLength(eventRange, ie, i, entries, batchSize):
+    """number of consecutive entries starting at position ie (entry i) that fit in one batch"""
+    n = 1
+    while n < batchSize and ie+n < entries and (eventRange == None or eventRange[ie+n] == i+n):
+        n += 1
+    return n
+
+def _analyze(modules, start, e, ie, masks, batchStart, profiler, end=None):
+    """run modules[start:end] on e until one rejects or defers it, return (result, index of the last module run)"""
+    ret = True
+    im = start-1
+    for im in xrange(start, len(modules) if end == None else end):
+        m = modules[im]
+        if masks is not None and masks[im] is not None:
+            ret = bool(masks[im][ie-batchStart])
+        elif profiler:
+            ret = profiler.analyze(m, e)
+        else:
+            ret = m.analyze(e)
+        if ret is DEFERRED or not ret: break
+    return ret, im
+
+class _DeferredEvents:
+    """Events deferred by a module (analyze returned DEFERRED) and the events following them, which are kept
+       until the deferred products are computed. A kept event never goes further in the modules than the events
+       before it, and flush runs the modules after a deferring one on all kept events in entry order, once
+       runDeferred was called, so that every module sees the events in the same order as without deferring.
+       The fillBranch calls of the kept events are recorded and replayed when they are filled in the output,
+       so the output is the same too. The values set with fillBranch and attributes set on the event are kept,
+       but modules running after a deferring one should not rely on per-event state kept in a module before it."""
+    def __init__(self, modules, inputTree, outputTree, filterOutput, profiler):
+        self.modules = modules
+        self.inputTree = inputTree
+        self.outputTree = outputTree
+        self.filterOutput = filterOutput
+        self.profiler = profiler
+        # [entry position, entry, event, index of the last module run, its result, fills, extra branches]
+        self.events = []
+        self._waiting = {}
+    def analyze(self, ie, i, e, masks, batchStart):
+        """run the modules on a new event, return their result or None if the event is kept"""
+        if not self.events:
+            # filled in the output as usual, the recorded values are only copied if the event is deferred
+            fills = []
+            self._record(fills, copy=False)
+            ret, im = _analyze(self.modules, 0, e, ie, masks, batchStart, self.profiler)
+            self._record(None)
+            if ret is not DEFERRED: return ret
+            if self.outputTree != None: self.outputTree.copyFills(fills)
+        else:
+            fills = []
+            self._record(fills)
+            ret, im = _analyze(self.modules, 0, e, ie, masks, batchStart, self.profiler, self._end(self.events))
+            self._record(None)
+        self.events.append([ie, i, e, im, ret, fills, self.inputTree._extrabranches])
+        if ret is DEFERRED: self._waiting[im] = self._waiting.get(im, 0) + 1
+        return None
+    def ready(self):
+        """True when a module has deferEvents events waiting"""
+        return any(n >= self.modules[im].deferEvents for im, n in self._waiting.iteritems())
+    def flush(self, masks, batchStart):
+        """finish all events and fill them in the output, return the number of accepted events"""
+        while self._waiting:
+            k = min(self._waiting)
+            if self.profiler: self.profiler.runDeferred(self.modules[k])
+            else: self.modules[k].runDeferred()
+            self._waiting = {}
+            end = len(self.modules)
+            for ev in self.events:
+                ie, i, e, im, ret = ev[:5]
+                if not self._pending(ev): continue
+                if ret is not DEFERRED or im == k:
+                    self.inputTree.gotoEntry(i)
+                    self.inputTree._extrabranches = ev[6]
+                    self._record(ev[5])
+                    start = im+1
+                    if ret is DEFERRED:
+                        m = self.modules[im]
+                        ret = self.profiler.resume(m, e) if self.profiler else m.resume(e)
+                        if ret is DEFERRED: raise RuntimeError("%s.resume cannot defer the event again" % m.__class__.__name__)
+                    # up to the modules where the previous events stopped, they may defer it too
+                    if ret: ret, im = _analyze(self.modules, start, e, ie, masks, batchStart, self.profiler, end)
+                    self._record(None)
+                    ev[3], ev[4], ev[6] = im, ret, self.inputTree._extrabranches
+                if ev[4] is DEFERRED: self._waiting[ev[3]] = self._waiting.get(ev[3], 0) + 1
+                if self._pending(ev): end = min(end, ev[3]+1)
+        accepted = 0
+        for ie, i, e, im, ret, fills, extras in self.events:
+            if ret: accepted += 1
+            if self.outputTree == None: continue
+            # also for rejected events, whose values are repeated in the next entries not filling a branch;
+            # the full output copies the input branches of the current entry
+            self.inputTree.gotoEntry(i)
+            self.outputTree.fillDeferred(fills)
+            if ret or not self.filterOutput: self.outputTree.fill()
+        self.events = []
+        return accepted
+    def _pending(self, ev):
+        """True if the event still has to go through some modules"""
+        return ev[4] is DEFERRED or (ev[4] and ev[3] < len(self.modules)-1)
+    def _end(self, events):
+        """the modules after the last one run on the pending events are not run on the next events yet"""
+        return min([len(self.modules)] + [ev[3]+1 for ev in events if self._pending(ev)])
+    def _record(self, fills, copy=True):
+        if self.outputTree != None: self.outputTree.deferFills(fills, copy)
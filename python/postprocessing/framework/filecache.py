@@ -0,0 +1,197 @@
+import os
+import json
+import time
+import errno
+import fcntl
+import shutil
+import hashlib
+import tempfile
+import threading
+import subprocess
+import numpy
+
+class LRUCache:
+    """Directory of cached files described by a JSON index, evicting the least recently used ones
+       once their total size exceeds maxSize (in bytes). The index is locked, so that several
+       processes can share the same directory."""
+    def __init__(self, cacheDir, maxSize):
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+        self._indexName = os.path.join(cacheDir, "index.json")
+        self._lockName = os.path.join(cacheDir, ".lock")
+        self._threadLock = threading.Lock()
+        self._pinned = set()
+        try:
+            os.makedirs(cacheDir)
+        except OSError, e:
+            if e.errno != errno.EEXIST: raise
+    def path(self, key):
+        return os.path.join(self.cacheDir, key)
+    def lookup(self, key):
+        """return the path of the cached object key and mark it as recently used, or None"""
+        with self._threadLock:
+            lock = self._lock()
+            try:
+                index = self._readIndex()
+                if key not in index["objects"]: return None
+                if not os.path.exists(self.path(key)):
+                    del index["objects"][key]
+                    self._writeIndex(index)
+                    return None
+                index["objects"][key]["atime"] = time.time()
+                self._writeIndex(index)
+                return self.path(key)
+            finally:
+                lock.close()
+    def store(self, key, fileName):
+        """move fileName into the cache as object key, then evict objects above the size limit"""
+        with self._threadLock:
+            lock = self._lock()
+            try:
+                index = self._readIndex()
+                if os.path.exists(self.path(key)):
+                    os.remove(fileName)
+                else:
+                    os.rename(fileName, self.path(key))
+                index["objects"][key] = { "size": os.path.getsize(self.path(key)), "atime": time.time() }
+                self._evict(index, keep=self._pinned | set([key]))
+                self._writeIndex(index)
+                return self.path(key)
+            finally:
+                lock.close()
+    def pin(self, key):
+        """never evict key from this process"""
+        self._pinned.add(key)
+    def unpin(self, key):
+        self._pinned.discard(key)
+    def tempName(self, suffix=""):
+        fd, name = tempfile.mkstemp(suffix=suffix+".part", dir=self.cacheDir)
+        os.close(fd)
+        return name
+    def _evict(self, index, keep):
+        objects = index["objects"]
+        total = sum(o["size"] for o in objects.itervalues())
+        for key in sorted(objects.iterkeys(), key=lambda k: objects[k]["atime"]):
+            if total <= self.maxSize: break
+            if key in keep: continue
+            if os.path.exists(self.path(key)): os.remove(self.path(key))
+            total -= objects[key]["size"]
+            del objects[key]
+    def _lock(self):
+        lock = open(self._lockName, "a")
+        fcntl.lockf(lock, fcntl.LOCK_EX)
+        return lock
+    def _readIndex(self):
+        if not os.path.exists(self._indexName): return { "objects": {} }
+        with open(self._indexName) as f:
+            return json.load(f)
+    def _writeIndex(self, index):
+        tmpName = self._indexName+".tmp"
+        with open(tmpName, "w") as f:
+            json.dump(index, f)
+        os.rename(tmpName, self._indexName)
+
+class InputFileCache(LRUCache):
+    """Local copies of input files, stored under the SHA1 of their content and looked up by URL.
+       Files can be prefetched in a background thread while the previous one is being processed."""
+    def __init__(self, cacheDir=None, maxSize=20*1024**3):
+        self.temporary = cacheDir == None
+        LRUCache.__init__(self, tempfile.mkdtemp(prefix="nanoAODTools-") if self.temporary else cacheDir, maxSize)
+        self._pending = {}
+    def cacheable(self, url):
+        return url.startswith("root://") or "://" not in url
+    def prefetch(self, url):
+        """start copying url into the cache in a background thread"""
+        if url in self._pending or not self.cacheable(url): return
+        thread = threading.Thread(target=self._prefetch, args=(url,))
+        thread.daemon = True
+        self._pending[url] = thread
+        thread.start()
+    def get(self, url):
+        """return a local copy of url, waiting for a prefetch in progress or copying it now;
+           falls back to url itself if it can't be copied"""
+        thread = self._pending.pop(url, None)
+        if thread: thread.join()
+        if not self.cacheable(url): return url
+        try:
+            localName = self.fetch(url)
+        except Exception, e:
+            print "Failed to copy %s to the local cache (%s), reading it remotely" % (url, e)
+            return url
+        self.pin(os.path.basename(localName))
+        return localName
+    def release(self, localName):
+        self.unpin(os.path.basename(localName))
+    def fetch(self, url):
+        key = self._urlKey(url)
+        pointer = self.lookup(key)
+        if pointer:
+            with open(pointer) as f:
+                localName = self.lookup(f.read().strip())
+            if localName: return localName
+        tmpName = self.tempName(".root")
+        t0 = time.time()
+        try:
+            if url.startswith("root://"):
+                subprocess.check_call(["xrdcp", "-f", "-s", url, tmpName])
+            else:
+                shutil.copyfile(url, tmpName)
+            objectKey = self._contentKey(tmpName)+".root"
+            localName = self.store(objectKey, tmpName)
+        finally:
+            if os.path.exists(tmpName): os.remove(tmpName)
+        # small pointer file from the url to the content it had when it was copied
+        tmpName = self.tempName()
+        with open(tmpName, "w") as f:
+            f.write(objectKey)
+        self.store(key, tmpName)
+        print "Copied %s to %s (%.1f MB in %.1f s)" % (url, localName, os.path.getsize(localName)/1024.**2, time.time()-t0)
+        return localName
+    def cleanup(self):
+        """remove the cache directory if it was only meant for this job"""
+        if self.temporary: shutil.rmtree(self.cacheDir, ignore_errors=True)
+    def _prefetch(self, url):
+        try:
+            self.fetch(url)
+        except Exception, e:
+            print "Failed to prefetch %s: %s" % (url, e)
+    def _urlKey(self, url):
+        return "url-"+hashlib.sha1(url).hexdigest()
+    def _contentKey(self, fileName):
+        sha1 = hashlib.sha1()
+        with open(fileName, "rb") as f:
+            for block in iter(lambda: f.read(1024**2), ""):
+                sha1.update(block)
+        return sha1.hexdigest()
+
+class EntryListCache(LRUCache):
+    """Entry numbers selected by the pre-skimming, stored as NumPy arrays under a hash of the identity of the
+       input file (UUID and size, so that a local copy of a file shares its entries), the tree, its friends
+       (their files identified in the same way), the entry range, the cut, the JSON and the pre-selection backend"""
+    def __init__(self, cacheDir, maxSize=1024**3):
+        LRUCache.__init__(self, cacheDir, maxSize)
+    def key(self, tree, cut, jsonHash, firstEntry, maxEntries, backend="draw"):
+        tfile = tree.GetCurrentFile()
+        identity = [ tfile.GetUUID().AsString(), str(tfile.GetSize()), tree.GetName(), str(firstEntry), str(maxEntries), cut or "", jsonHash or "", backend ]
+        # the cut may use branches of the friends
+        friends = tree.GetListOfFriends()
+        if friends:
+            for friend in friends:
+                friendTree = friend.GetTree()
+                friendFile = friendTree.GetCurrentFile() if friendTree else None
+                if not friendFile: raise RuntimeError, "Can't identify the file of the friend tree %s" % friend.GetName()
+                identity += [ friend.GetName(), friendFile.GetUUID().AsString(), str(friendFile.GetSize()) ]
+        return "elist-"+hashlib.sha1("\n".join(identity)).hexdigest()+".npy"
+    def load(self, key):
+        """return the cached entry numbers, or None"""
+        fileName = self.lookup(key)
+        if not fileName: return None
+        try:
+            return numpy.load(fileName)
+        except (IOError, ValueError):
+            return None
+    def save(self, key, entries):
+        tmpName = self.tempName(".npy")
+        with open(tmpName, "wb") as f:
+            numpy.save(f, entries)
+        self.store(key, tmpName)
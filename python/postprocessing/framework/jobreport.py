@@ -56,6 +56,14 @@ class JobReport :
                 run=ET.SubElement(runs,"Run",ID="%s"%r)
                 for l in ls :
                    ET.SubElement(run,"LumiSection",ID="%s"%l)
+
+       def addCompression(self,compression,target,measurements):
+           summary = ET.SubElement(self.performancereport, "PerformanceSummary", Metric="Compression")
+           ET.SubElement(summary, "Metric", Name="chosen", Value=compression)
+           ET.SubElement(summary, "Metric", Name="target", Value=target)
+           for m in measurements:
+               ET.SubElement(summary, "Metric", Name="%s-MBps"%m["compression"], Value="%.2f"%m["speed"])
+               ET.SubElement(summary, "Metric", Name="%s-ratio"%m["compression"], Value="%.3f"%m["ratio"])
 		
        def save(self,filename="FrameworkJobReport.xml"):
 	    tree = ET.ElementTree(self.fjr)
@@ -1,18 +1,30 @@
-from array import array
+import numpy
+import fnmatch
 import ROOT
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 
 from PhysicsTools.NanoAODTools.postprocessing.framework.treeReaderArrayTools import setExtraBranch
 
-_rootBranchType2PythonArray = { 'b':'B', 'B':'b', 'i':'I', 'I':'i', 'F':'f', 'D':'d', 'l':'L', 'L':'l', 'O':'B' }
+# cluster size (autoFlush: entries if > 0, uncompressed bytes if < 0) and basket sizes of the output trees
+outputLayoutPresets = {
+    "default": { "autoFlush": None, "basketSize": None },
+    # few large clusters and baskets, for reading whole branches at once (e.g. uproot's array())
+    "columnar": { "autoFlush": -128*1024**2, "basketSize": 1024**2 },
+}
+
+_rootBranchType2NumpyType = { 'b':'uint8', 'B':'int8', 'i':'uint32', 'I':'int32', 'F':'float32', 'D':'float64', 'l':'uint64', 'L':'int64', 'O':'bool' }
 
 class OutputBranch:
     def __init__(self, tree, name, rootBranchType, n=1, lenVar=None, title=None, limitedPrecision=False):
         n = int(n)
-        self.buff   = array(_rootBranchType2PythonArray[rootBranchType], n*[0. if rootBranchType in 'FD' else 0])
+        self.buff   = numpy.zeros(n, dtype=_rootBranchType2NumpyType[rootBranchType])
         self.lenVar = lenVar
         self.n = n
-        self.precision = ROOT.ReduceMantissaToNbitsRounding(limitedPrecision) if limitedPrecision and rootBranchType=='F' else lambda x : x
+        self.bits = limitedPrecision if limitedPrecision and rootBranchType=='F' else None
+        if tree is None:
+          # values are kept for the other modules, but not written
+          self.branch = None
+          return
         #check if a branch was already there 
         existingBranch = tree.GetBranch(name)
         if (existingBranch):
@@ -28,37 +40,107 @@ class OutputBranch:
         if title: self.branch.SetTitle(title)
 
     def fill(self, val):
+        """copy val (a value, or a sequence or NumPy array for array branches) into the buffer of the branch"""
         if self.lenVar:
-            if len(self.buff) < len(val): # realloc
-                self.buff = array(self.buff.typecode, max(len(val),2*len(self.buff))*[0. if self.buff.typecode in 'fd' else 0])
-                self.branch.SetAddress(self.buff)
-            for i,v in enumerate(val): self.buff[i] = self.precision(v)
+            n = len(val)
+            if len(self.buff) < n: # realloc
+                self.buff = numpy.zeros(max(n,2*len(self.buff)), dtype=self.buff.dtype)
+                if self.branch: self.branch.SetAddress(self.buff)
+            self.buff[:n] = val
+            if self.bits: _reduceMantissa(self.buff[:n], self.bits)
         elif self.n == 1: 
-            self.buff[0] = self.precision(val)
+            self.buff[0] = val
+            if self.bits: _reduceMantissa(self.buff, self.bits)
         else:
-            if len(val) != self.n: raise RuntimeError("Mismatch in filling branch %s of fixed length %d with %d values (%s)" % (self.Branch.GetName(),self.n,len(val),val))
-            for i,v in enumerate(val): self.buff[i] = v
+            if len(val) != self.n: raise RuntimeError("Mismatch in filling branch %s of fixed length %d with %d values (%s)" % (self.branch.GetName(),self.n,len(val),val))
+            self.buff[:] = val
+
+def _reduceMantissa(values, bits):
+    """round the float32 values in place to bits bits of mantissa, as ReduceMantissaToNbitsRounding does;
+       float32 has 23 bits of mantissa, so the values are kept as they are for bits >= 23"""
+    if bits >= 23: return
+    shift = numpy.uint32(23-bits)
+    mask = numpy.uint32((0xFFFFFFFF >> (23-bits)) << (23-bits))
+    test = numpy.uint32(1 << (22-bits))
+    maxn = numpy.uint32((1 << bits)-2)
+    i32 = values.view(numpy.uint32)
+    mantissa = (i32 & numpy.uint32(0x007FFFFF)) >> shift # lowest 23 bits = mantissa
+    numpy.add(mantissa, numpy.uint32(1), out=mantissa, where=mantissa<maxn)
+    rounded = (i32 & numpy.uint32(0xFF800000)) | (mantissa << shift)
+    i32[:] = numpy.where(i32 & test, rounded, i32 & mask)
+
+def _copyValue(val):
+    # the value may be a view of a reader buffer or a list modified later
+    return val if numpy.isscalar(val) else numpy.array(val)
 
 class OutputTree:
-    def __init__(self, tfile, ttree, intree):
+    """autoFlush is passed to TTree::SetAutoFlush, basketSize is either a size in bytes for all branches
+       or a list of (pattern, size) applied in order, with wildcards as in TTree::SetBasketSize"""
+    def __init__(self, tfile, ttree, intree, autoFlush=None, basketSize=None):
         self._file = tfile
         self._tree = ttree
         self._intree = intree
         self._branches = {} 
+        self._basketSizes = [("*", basketSize)] if type(basketSize) in (int, long) else (basketSize or [])
+        self._fillLog = None
+        self._copyFills = True
+        if autoFlush is not None: self._tree.SetAutoFlush(autoFlush)
+        for pattern, size in self._basketSizes:
+            self._tree.SetBasketSize(pattern, size)
     def branch(self, name, rootBranchType, n=1, lenVar=None, title=None,limitedPrecision=False):
         if (lenVar != None) and (lenVar not in self._branches): #and (not self._tree.GetBranch(lenVar)):
             self._branches[lenVar] = OutputBranch(self._tree, lenVar, "i")
+            self._setBasketSize(self._branches[lenVar], lenVar)
         self._branches[name] = OutputBranch(self._tree, name, rootBranchType, n=n, lenVar=lenVar, title=title,limitedPrecision=limitedPrecision)
+        self._setBasketSize(self._branches[name], name)
         return self._branches[name]
+    def _setBasketSize(self, outputBranch, name):
+        for pattern, size in self._basketSizes:
+            if outputBranch.branch and fnmatch.fnmatchcase(name, pattern): outputBranch.branch.SetBasketSize(size)
     def fillBranch(self, name, val):
+        if self._fillLog is not None:
+            if self._copyFills: return self._deferFill(name, val)
+            self._fillLog.append((name, val))
         br = self._branches[name]
         if br.lenVar and (br.lenVar in self._branches):
             self._branches[br.lenVar].buff[0] = len(val)
             setExtraBranch(self._intree,br.lenVar,len(val))
         br.fill(val)
         setExtraBranch(self._intree,name,val)
+    def deferFills(self, log, copy=True):
+        """while log is not None, fillBranch only sets the values seen by the following modules and appends
+           (name, value) to log, the output is filled later with fillDeferred (see eventloop.DEFERRED).
+           Without copy, the values are filled as usual and the log only references them, see copyFills"""
+        self._fillLog = log
+        self._copyFills = copy
+    def copyFills(self, log):
+        """copy the values of a log recorded with copy=False, before the next event changes them"""
+        log[:] = [(name, _copyValue(val)) for name, val in log]
+    def fillDeferred(self, log):
+        for name, val in log:
+            self.fillBranch(name, val)
+    def _deferFill(self, name, val):
+        br = self._branches[name]
+        if br.lenVar and (br.lenVar in self._branches):
+            setExtraBranch(self._intree,br.lenVar,len(val))
+        setExtraBranch(self._intree,name,val)
+        self._fillLog.append((name, _copyValue(val)))
     def tree(self):
         return self._tree
+    def getState(self):
+        """copy of the branch buffers, whose values are written again for entries where a branch is not filled"""
+        return dict((name, numpy.array(br.buff)) for name, br in self._branches.iteritems())
+    def setState(self, state):
+        for name, buff in state.iteritems():
+            br = self._branches.get(name)
+            if br is None: continue
+            if len(br.buff) < len(buff):
+                br.buff = numpy.zeros(len(buff), dtype=br.buff.dtype)
+                if br.branch: br.branch.SetAddress(br.buff)
+            br.buff[:len(buff)] = buff
+    def checkpoint(self):
+        """write the entries filled so far and the tree header, so that the tree can be read back from this point"""
+        self._tree.AutoSave("SaveSelf;FlushBaskets")
     def fill(self):
         self._tree.Fill()
     def write(self):
@@ -77,7 +159,9 @@ class FullOutput(OutputTree):
             maxEntries=None,
             firstEntry=0,
             provenance=False,
-            jsonFilter=None
+            jsonFilter=None,
+            autoFlush=None,
+            basketSize=None
     ):
         outputFile.cd()
 
@@ -85,8 +169,15 @@ class FullOutput(OutputTree):
         self.outputbranchSelection = outputbranchSelection
         self.maxEntries = maxEntries
         self.firstEntry = firstEntry
+        # only the branches kept in the output are active when cloning
+        if outputbranchSelection:
+            outputbranchSelection.selectBranches(inputTree)
         if fullClone:
-            outputTree = inputTree.CopyTree('1', "", maxEntries if maxEntries else ROOT.TVirtualTreePlayer.kMaxEntries, firstEntry)
+            if inputTree.GetEntryList():
+                # the entry list already restricts the entries to the requested range
+                outputTree = inputTree.CopyTree('1')
+            else:
+                outputTree = inputTree.CopyTree('1', "", maxEntries if maxEntries else ROOT.TVirtualTreePlayer.kMaxEntries, firstEntry)
         else:            
             outputTree = inputTree.CloneTree(0)
             
@@ -96,7 +187,9 @@ class FullOutput(OutputTree):
         if branchSelection:
             branchSelection.selectBranches(inputTree)
 
-        OutputTree.__init__(self, outputFile, outputTree, inputTree)
+        # a full clone is already filled, keeping the layout of the input
+        if fullClone: autoFlush, basketSize = None, None
+        OutputTree.__init__(self, outputFile, outputTree, inputTree, autoFlush=autoFlush, basketSize=basketSize)
         self._inputTree = inputTree
         self._otherTrees = {}
         self._otherObjects = {}
@@ -109,24 +202,25 @@ class FullOutput(OutputTree):
             elif kn in ("LuminosityBlocks", "Runs"):
                 if not jsonFilter: self._otherTrees[kn] = inputFile.Get(kn).CopyTree('1' if firstEntry == 0 else '0')
                 elif firstEntry == 0:
-                    _isRun = (kn=="Runs")
-                    _it = inputFile.Get(kn)
-                    _ot = _it.CloneTree(0)
-                    for ev in _it:
-                        if (jsonFilter.filterRunOnly(ev.run) if _isRun else jsonFilter.filterRunLumi(ev.run,ev.luminosityBlock)): _ot.Fill()
-                    self._otherTrees[kn] = _ot
+                    self._otherTrees[kn] = jsonFilter.filterTree(inputFile.Get(kn), byLumi=(kn=="LuminosityBlocks"))
             elif k.GetClassName() == "TTree":
                 print "Not copying unknown tree %s" % kn
             else:
                 self._otherObjects[kn] = inputFile.Get(kn)
+    def branch(self, name, rootBranchType, n=1, lenVar=None, title=None,limitedPrecision=False):
+        if not self.outputbranchSelection or self.outputbranchSelection.isSelected(name):
+            if lenVar in self._branches and self._branches[lenVar].branch is None:
+                del self._branches[lenVar] # the length of a kept branch has to be written too
+            return OutputTree.branch(self, name, rootBranchType, n=n, lenVar=lenVar, title=title, limitedPrecision=limitedPrecision)
+        # dropped from the output: the values are still visible to the following modules
+        if (lenVar != None) and (lenVar not in self._branches):
+            self._branches[lenVar] = OutputBranch(None, lenVar, "i")
+        self._branches[name] = OutputBranch(None, name, rootBranchType, n=n, lenVar=lenVar, title=title, limitedPrecision=limitedPrecision)
+        return self._branches[name]
     def fill(self):
         self._inputTree.readAllBranches()
         self._tree.Fill()
     def write(self):
-        if self.outputbranchSelection:
-            self.outputbranchSelection.selectBranches(self._tree)
-        self._tree = self.tree().CopyTree('1', "", self.maxEntries if self.maxEntries else ROOT.TVirtualTreePlayer.kMaxEntries, self.firstEntry)
-
         OutputTree.write(self)
         for t in self._otherTrees.itervalues():
             t.Write()
@@ -134,8 +228,202 @@ class FullOutput(OutputTree):
             self._file.WriteTObject(ov,on)
 
 class FriendOutput(OutputTree):
-    def __init__(self, inputFile, inputTree, outputFile, treeName="Friends"):
+    """Output tree with only the new branches. If bufferSize is given, the values passed to fillBranch
+       are kept in columns and bufferSize entries at a time are filled into the tree with one C++ call.
+       Branches not filled for an entry keep their previous value, as when filling entry by entry."""
+    def __init__(self, inputFile, inputTree, outputFile, treeName="Friends", bufferSize=None, autoFlush=None, basketSize=None, resume=False):
         outputFile.cd()
-        outputTree = ROOT.TTree(treeName,"Friend tree for "+inputTree.GetName())
-        OutputTree.__init__(self, outputFile, outputTree, inputTree)
+        if resume:
+            # continue filling the tree saved at the last checkpoint
+            outputTree = outputFile.Get(treeName)
+            if not outputTree: raise RuntimeError("No tree %s to resume in %s" % (treeName, outputFile.GetName()))
+        else:
+            outputTree = ROOT.TTree(treeName,"Friend tree for "+inputTree.GetName())
+        OutputTree.__init__(self, outputFile, outputTree, inputTree, autoFlush=autoFlush, basketSize=basketSize)
+        self._bufferSize = bufferSize
+        self._columns = {}
+        self._row = 0
+    def branch(self, name, rootBranchType, n=1, lenVar=None, title=None,limitedPrecision=False):
+        ret = OutputTree.branch(self, name, rootBranchType, n=n, lenVar=lenVar, title=title, limitedPrecision=limitedPrecision)
+        if self._bufferSize:
+            for bn in (lenVar, name):
+                if bn != None and bn not in self._columns:
+                    self._columns[bn] = _ColumnBuffer(self._branches[bn], self._bufferSize)
+        return ret
+    def fillBranch(self, name, val):
+        if not self._bufferSize or (self._fillLog is not None and self._copyFills): return OutputTree.fillBranch(self, name, val)
+        if self._fillLog is not None: self._fillLog.append((name, val))
+        br = self._branches[name]
+        if br.lenVar and (br.lenVar in self._branches):
+            self._columns[br.lenVar].set(self._row, len(val))
+            setExtraBranch(self._intree,br.lenVar,len(val))
+        self._columns[name].set(self._row, val)
+        setExtraBranch(self._intree,name,val)
+    def fill(self):
+        if not self._bufferSize: return OutputTree.fill(self)
+        self._row += 1
+        if self._row == self._bufferSize: self.flush()
+    def flush(self):
+        """fill the buffered entries into the tree"""
+        if not self._row: return
+        nentries, self._row = self._row, 0
+        names = self._columns.keys()
+        columns = dict((bn, self._columns[bn].columns(nentries)) for bn in names)
+        offsets = numpy.zeros((len(names), nentries+1), dtype=numpy.int64)
+        for i, bn in enumerate(names):
+            br = self._branches[bn]
+            content, counts = columns[bn]
+            numpy.cumsum(counts, out=offsets[i,1:])
+            # the buffers must hold as many elements as the lenVar asks for
+            need = counts.max()
+            if br.lenVar and br.lenVar in columns: need = max(need, columns[br.lenVar][0].max())
+            if len(br.buff) < need:
+                br.buff = numpy.zeros(int(need), dtype=br.buff.dtype)
+                br.branch.SetAddress(br.buff)
+        dest = numpy.array([self._branches[bn].buff.ctypes.data for bn in names], dtype=numpy.uint64)
+        src = numpy.array([columns[bn][0].ctypes.data for bn in names], dtype=numpy.uint64)
+        itemSize = numpy.array([columns[bn][0].dtype.itemsize for bn in names], dtype=numpy.int64)
+        _declareFillColumns()
+        ROOT.nanoAODTools.fillColumns(self._tree, nentries, len(names),
+                                      int(dest.ctypes.data), int(src.ctypes.data), int(itemSize.ctypes.data), int(offsets.ctypes.data))
+    def checkpoint(self):
+        self.flush()
+        OutputTree.checkpoint(self)
+    def setState(self, state):
+        OutputTree.setState(self, state)
+        # the restored buffers are the values to repeat in entries where a branch is not filled
+        for name, column in self._columns.iteritems():
+            br = self._branches[name]
+            if column.jagged:
+                column.last = numpy.array(br.buff[:int(self._branches[br.lenVar].buff[0])])
+            else:
+                column.last = numpy.array(br.buff[:br.n]).reshape(1, br.n)
+    def write(self):
+        self.flush()
+        OutputTree.write(self)
+
+class ParquetOutput(FriendOutput):
+    """Writes the branches made by the modules to a Parquet file instead of a friend tree, with one row group
+       per bufferSize entries. Array branches become list columns, their lenVar is kept as a column. Needs pyarrow."""
+    def __init__(self, inputFile, inputTree, outputFile, fileName, bufferSize=10000):
+        try:
+            import pyarrow, pyarrow.parquet
+        except ImportError:
+            raise RuntimeError("Writing Parquet files needs pyarrow")
+        self._pa = pyarrow
+        OutputTree.__init__(self, outputFile, None, inputTree)
+        self._fileName = fileName
+        self._bufferSize = bufferSize
+        self._columns = {}
+        self._row = 0
+        self._names = []
+        self._writer = None
+    def branch(self, name, rootBranchType, n=1, lenVar=None, title=None,limitedPrecision=False):
+        if (lenVar != None) and (lenVar not in self._branches):
+            self._addColumn(lenVar, OutputBranch(None, lenVar, "i"))
+        self._addColumn(name, OutputBranch(None, name, rootBranchType, n=n, lenVar=lenVar, limitedPrecision=limitedPrecision))
+        return self._branches[name]
+    def _addColumn(self, name, outputBranch):
+        if name not in self._branches: self._names.append(name)
+        self._branches[name] = outputBranch
+        self._columns[name] = _ColumnBuffer(outputBranch, self._bufferSize)
+    def flush(self):
+        """write the buffered entries as a row group"""
+        if not self._row: return
+        nentries, self._row = self._row, 0
+        self._writeTable(dict((bn, self._columns[bn].columns(nentries)) for bn in self._names))
+    def write(self):
+        self.flush()
+        if not self._writer:
+            # no entries: write the schema only
+            self._writeTable(dict((bn, (numpy.zeros(0, dtype=self._branches[bn].buff.dtype), numpy.zeros(0, dtype=numpy.int64))) for bn in self._names))
+        self._writer.close()
+    def _writeTable(self, columns):
+        pa = self._pa
+        arrays = []
+        for bn in self._names:
+            content, counts = columns[bn]
+            br = self._branches[bn]
+            if br.lenVar or br.n > 1:
+                offsets = numpy.zeros(len(counts)+1, dtype=numpy.int32)
+                numpy.cumsum(counts, out=offsets[1:])
+                arrays.append(pa.ListArray.from_arrays(pa.array(offsets), pa.array(content)))
+            else:
+                arrays.append(pa.array(content))
+        table = pa.Table.from_arrays(arrays, names=self._names)
+        if not self._writer:
+            import pyarrow.parquet
+            self._writer = pyarrow.parquet.ParquetWriter(self._fileName, table.schema)
+        self._writer.write_table(table)
+
+class _ColumnBuffer:
+    def __init__(self, branch, size):
+        self.dtype = branch.buff.dtype
+        self.bits = branch.bits
+        self.n = branch.n
+        self.jagged = branch.lenVar != None
+        if self.jagged:
+            self.rows = [None]*size
+            self.last = numpy.zeros(0, dtype=self.dtype)
+        else:
+            self.rows = numpy.zeros((size, branch.n), dtype=self.dtype)
+            self.filled = numpy.zeros(size, dtype=bool)
+            self.last = numpy.zeros((1, branch.n), dtype=self.dtype)
+    def set(self, row, val):
+        if self.jagged:
+            self.rows[row] = numpy.array(val, dtype=self.dtype).reshape(-1)
+        else:
+            if self.n > 1 and len(val) != self.n: raise RuntimeError("Mismatch in filling branch of fixed length %d with %d values (%s)" % (self.n,len(val),val))
+            self.rows[row] = val
+            self.filled[row] = True
+    def columns(self, nentries):
+        """return the flat content and the number of elements per entry of the first nentries rows,
+           repeating the previous values in rows that were not filled, and clear the rows"""
+        if self.jagged:
+            rows = []
+            for i in xrange(nentries):
+                if self.rows[i] is not None: self.last = self.rows[i]
+                rows.append(self.last)
+                self.rows[i] = None
+            counts = numpy.array([len(r) for r in rows], dtype=numpy.int64)
+            content = numpy.concatenate(rows)
+        else:
+            index = numpy.where(self.filled[:nentries], numpy.arange(1, nentries+1), 0)
+            numpy.maximum.accumulate(index, out=index)
+            content = numpy.concatenate([self.last, self.rows[:nentries]])[index]
+            self.last = content[-1:].copy()
+            self.filled[:] = False
+            counts = numpy.full(nentries, self.n, dtype=numpy.int64)
+        content = numpy.ascontiguousarray(content.reshape(-1), dtype=self.dtype)
+        if self.bits: _reduceMantissa(content, self.bits)
+        return content, counts
+
+_fillColumnsDeclared = False
+def _declareFillColumns():
+    global _fillColumnsDeclared
+    if _fillColumnsDeclared: return
+    ROOT.gInterpreter.Declare("""
+    #include <cstring>
+    #include "TTree.h"
+    namespace nanoAODTools {
+        // for each entry, copy the elements of each column into the buffer of its branch and fill the tree;
+        // offsets holds nEntries+1 element offsets per column, itemSize the size of an element in bytes
+        Long64_t fillColumns(TTree * tree, Long64_t nEntries, int nColumns, ULong64_t destAddress, ULong64_t srcAddress, ULong64_t itemSizeAddress, ULong64_t offsetsAddress) {
+            char ** dest = reinterpret_cast<char **>(destAddress);
+            const char * const * src = reinterpret_cast<const char * const *>(srcAddress);
+            const Long64_t * itemSize = reinterpret_cast<const Long64_t *>(itemSizeAddress);
+            const Long64_t * offsets = reinterpret_cast<const Long64_t *>(offsetsAddress);
+            Long64_t nbytes = 0;
+            for (Long64_t j = 0; j < nEntries; ++j) {
+                for (int i = 0; i < nColumns; ++i) {
+                    const Long64_t * off = offsets + i*(nEntries+1);
+                    std::memcpy(dest[i], src[i] + off[j]*itemSize[i], (off[j+1]-off[j])*itemSize[i]);
+                }
+                nbytes += tree->Fill();
+            }
+            return nbytes;
+        }
+    }
+    """)
+    _fillColumnsDeclared = True
 
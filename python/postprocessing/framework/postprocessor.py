@@ -1,19 +1,31 @@
 #!/usr/bin/env python
 import os
 import time
+import math
+import cPickle
+import multiprocessing
 import ROOT
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 from PhysicsTools.NanoAODTools.postprocessing.framework.branchselection import BranchSelection
 from PhysicsTools.NanoAODTools.postprocessing.framework.datamodel import InputTree
-from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import eventLoop
-from PhysicsTools.NanoAODTools.postprocessing.framework.output import FriendOutput, FullOutput
+from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import eventLoop, Module
+from PhysicsTools.NanoAODTools.postprocessing.framework.output import FriendOutput, FullOutput, ParquetOutput, outputLayoutPresets
 from PhysicsTools.NanoAODTools.postprocessing.framework.preskimming import preSkim
 from PhysicsTools.NanoAODTools.postprocessing.framework.jobreport import JobReport
+from PhysicsTools.NanoAODTools.postprocessing.framework.filecache import InputFileCache, EntryListCache
+from PhysicsTools.NanoAODTools.postprocessing.framework.profiler import ModuleProfiler, mergeReports, writeReport
+from PhysicsTools.NanoAODTools.postprocessing.framework.compression import parseCompression, chooseCompression
+from PhysicsTools.NanoAODTools.postprocessing.framework.checkpoint import Checkpoint
 
 class PostProcessor :
     def __init__(self,outputDir,inputFiles,cut=None,branchsel=None,modules=[],compression="LZMA:9",friend=False,postfix=None,
 		 jsonInput=None,noOut=False,justcount=False,provenance=False,haddFileName=None,fwkJobReport=False,histFileName=None,histDirName=None, outputbranchsel=None,
-		 maxEvents=-1,treeName="Events"):
+		 maxEvents=-1,treeName="Events",batchSize=None,nworkers=1,
+		 prefetch=False,longTermCache=False,prefetchDir=None,prefetchMaxSize=20*1024**3,maxEntries=None,firstEntry=0,
+		 profile=None,pruneBranches=None,treeCacheSize=50*1024**2,treeCacheLearnEntries=100,asyncPrefetch=False,
+		 outputBufferSize=None,outputLayout="default",autoFlush=None,basketSize=None,
+		 outputFormat="root",checkpointInterval=None,resume=False,preselection="draw",preselectionThreads=0,
+		 preselectionCache=None,preselectionCacheSize=1024**3):
 	self.outputDir=outputDir
 	self.inputFiles=inputFiles
 	self.cut=cut
@@ -31,6 +43,31 @@ class PostProcessor :
 	self.histDirName = None
 	self.maxEvents = maxEvents
 	self.treeName = treeName
+	self.batchSize = batchSize
+	self.nworkers = nworkers
+	self.prefetch = prefetch
+	self.longTermCache = longTermCache
+	self.prefetchDir = prefetchDir
+	self.prefetchMaxSize = prefetchMaxSize
+	self.maxEntries = maxEntries
+	self.firstEntry = firstEntry
+	self.profile = profile
+	self.pruneBranches = pruneBranches
+	self.treeCacheSize = treeCacheSize
+	self.treeCacheLearnEntries = treeCacheLearnEntries
+	self.asyncPrefetch = asyncPrefetch
+	self.outputBufferSize = outputBufferSize
+	self.outputFormat = outputFormat
+	self.checkpointInterval = checkpointInterval
+	self.resume = resume
+	self.preselection = preselection
+	# the worker processes share the cores for their pre-selection
+	self.preselectionThreads = preselectionThreads if preselectionThreads or nworkers <= 1 else max(1, multiprocessing.cpu_count()/nworkers)
+	self.preselectionCache = preselectionCache
+	self.preselectionCacheSize = preselectionCacheSize
+	# explicit cluster and basket sizes override the ones of the layout preset
+	self.autoFlush = autoFlush if autoFlush is not None else outputLayoutPresets[outputLayout]["autoFlush"]
+	self.basketSize = basketSize if basketSize != None else outputLayoutPresets[outputLayout]["basketSize"]
 	if self.jobReport and not self.haddFileName :
 		print "Because you requested a FJR we assume you want the final hadd. No name specified for the output file, will use tree.root"
 		self.haddFileName="tree.root"
@@ -47,32 +84,36 @@ class PostProcessor :
         self.histDirName=histDirName
     def run(self) :
         outpostfix = self.postfix if self.postfix != None else ("_Friend" if self.friend else "_Skim")
-    	if not self.noOut:
-            
+        self._compressionLevel = 0
+        self._compressionSettings = 0
+        if not self.noOut:
+            if self.compression.startswith("auto"):
+                self.compression = self._chooseCompression()
             if self.compression != "none":
-                ROOT.gInterpreter.ProcessLine("#include <Compression.h>")
-                (algo, level) = self.compression.split(":")
-                compressionLevel = int(level)
-                if   algo == "LZMA": compressionAlgo  = ROOT.ROOT.kLZMA
-                elif algo == "ZLIB": compressionAlgo  = ROOT.ROOT.kZLIB
-                else: raise RuntimeError("Unsupported compression %s" % algo)
-            else:
-                compressionLevel = 0 
-	    print "Will write selected trees to "+self.outputDir
+                (self._compressionAlgo, self._compressionLevel, self._compressionSettings) = parseCompression(self.compression)
+            print "Will write selected trees to "+self.outputDir
             if not self.justcount:
                 if not os.path.exists(self.outputDir):
                     os.system("mkdir -p "+self.outputDir)
-        else:
-            compressionLevel = 0
 
-	if self.noOut:
-	    if len(self.modules) == 0: 
-		raise RuntimeError("Running with --noout and no modules does nothing!")
+        if self.noOut:
+            if len(self.modules) == 0: 
+                raise RuntimeError("Running with --noout and no modules does nothing!")
+        if self.outputFormat not in ("root", "parquet"):
+            raise RuntimeError("Unknown output format %s" % self.outputFormat)
+        if self.outputFormat == "parquet" and not self.friend:
+            raise RuntimeError("Parquet output is only possible for friend trees!")
+        if (self.checkpointInterval or self.resume) and not ((self.friend and self.outputFormat == "root") or self.noOut):
+            raise RuntimeError("Checkpoints are only possible for ROOT friend trees or with --noout, as full outputs copy the input branches!")
+        if self.pruneBranches and not (self.friend or self.noOut):
+            raise RuntimeError("Pruning the input branches is only possible for friend trees or with --noout, as full outputs copy all branches!")
 
         # Open histogram file, if desired 
         if (self.histFileName != None and self.histDirName == None) or (self.histFileName == None and self.histDirName != None) :
             raise RuntimeError("Must specify both histogram file and histogram directory!")
         elif self.histFileName != None and self.histDirName != None:
+            if self.nworkers > 1:
+                raise RuntimeError("Histogram files are not supported when running with several workers!")
             self.histFile = ROOT.TFile.Open( self.histFileName, "RECREATE" )
         else :
             self.histFile = None
@@ -84,83 +125,278 @@ class PostProcessor :
             else :
                 m.beginJob()
 
-	fullClone = (len(self.modules) == 0)
-	outFileNames=[]
+        self._fullClone = (len(self.modules) == 0)
+        outFileNames=[]
         t0 = time.time()
-	totEntriesRead=0
-	for friendList in self.inputFiles:
-
-	    fname = friendList[0]
-	    # open input file
-	    inFile = ROOT.TFile.Open(fname)
-
-	    #get input tree
-	    inTree = inFile.Get(self.treeName)
-	    for friend in friendList[1:]:
-	        inTree.AddFriend(self.treeName,friend)
-	    totEntriesRead+=inTree.GetEntries()
-	    # pre-skimming
-	    elist,jsonFilter = preSkim(inTree, self.json, self.cut)
-	    if self.justcount:
-		print 'Would select %d entries from %s'%(elist.GetN() if elist else inTree.GetEntries(), fname)
-		continue
-	    else:
-		print 'Pre-select %d entries out of %s '%(elist.GetN() if elist else inTree.GetEntries(),inTree.GetEntries())
-		
-	    if fullClone:
-		# no need of a reader (no event loop), but set up the elist if available
-		if elist: inTree.SetEntryList(elist)
-	    else:
-		# initialize reader
-		inTree = InputTree(inTree, elist) 
-
-	    # prepare output file
+        totEntriesRead=0
+
+        # split the work into tasks: one per input file, or several cluster-aligned entry ranges per file
+        # if running with several workers
+        nsplit = 1
+        if self.nworkers > 1 and not self.justcount and self.maxEvents <= 0 and self.outputFormat == "root":
+            nsplit = int(math.ceil(float(self.nworkers)/max(1,len(self.inputFiles))))
+        jobs = []
+        tasks = []
+        for friendList in self.inputFiles:
+            outFileName = os.path.join(self.outputDir, os.path.basename(friendList[0]).replace(".root",outpostfix+".root"))
+            ranges = self._splitEntries(friendList[0], nsplit) if nsplit > 1 else [(self.firstEntry, self.maxEntries)]
+            shardFileNames = []
+            for ishard, (firstEntry, maxEntries) in enumerate(ranges):
+                shardFileName = outFileName if len(ranges) == 1 else outFileName.replace(".root", "_shard%d.root" % ishard)
+                shardFileNames.append(shardFileName)
+                tasks.append((friendList, shardFileName, firstEntry, maxEntries))
+            jobs.append((friendList[0], outFileName, shardFileNames))
+
+        # has to be set before opening the input files; otherwise the setting of the user's .rootrc is kept
+        if self.asyncPrefetch: ROOT.gEnv.SetValue("TFile.AsyncPrefetching", 1)
+
+        self._inputCache = None
+        if self.prefetch:
+            cacheDir = None
+            if self.longTermCache:
+                cacheDir = self.prefetchDir if self.prefetchDir else os.path.join("/tmp", os.environ.get("USER", "nobody"), "nanoAODTools-cache")
+            self._inputCache = InputFileCache(cacheDir, self.prefetchMaxSize)
+        self._elistCache = EntryListCache(self.preselectionCache, self.preselectionCacheSize) if self.preselectionCache else None
+
+        if self.nworkers > 1:
+            for m in self.modules:
+                if type(m).getState.im_func is not Module.getState.im_func and type(m).mergeState.im_func is Module.mergeState.im_func:
+                    raise RuntimeError("Module %s can't run with several workers, as it doesn't merge its state (mergeState)" % type(m).__name__)
+            # workers are forked after beginJob, so that they share all state loaded by the modules;
+            # each task starts from the state of the modules after beginJob
+            self._initialStates = [ cPickle.dumps(m.getState(), cPickle.HIGHEST_PROTOCOL) for m in self.modules ]
+            global _workerPostProcessor
+            _workerPostProcessor = self
+            pool = multiprocessing.Pool(self.nworkers)
+            results = pool.map(_processTask, tasks, chunksize=1)
+            pool.close()
+            pool.join()
+            # add what the modules accumulated in the workers
+            for (nshard, nread, profile, states) in results:
+                for m, state in zip(self.modules, states): m.mergeState(state)
+            results = [ result[:3] for result in results ]
+        else:
+            results = []
+            for itask, task in enumerate(tasks):
+                # copy the next input file while this one is being processed
+                if self._inputCache and itask+1 < len(tasks):
+                    self._inputCache.prefetch(tasks[itask+1][0][0])
+                results.append(self._processTask(task))
+
+        if self._inputCache:
+            self._inputCache.cleanup()
+
+        profiles = [profile for (nshard, nread, profile) in results if profile]
+        # the results are in the order of the shards of the jobs
+        shardResults = iter(results)
+        for fname, outFileName, shardFileNames in jobs:
+            nall = 0
+            for shardFileName in shardFileNames:
+                (nshard, nread, profile) = next(shardResults)
+                nall += nshard
+                totEntriesRead += nread
+            if self.justcount:
+                continue
             if not self.noOut:
-                outFileName = os.path.join(self.outputDir, os.path.basename(fname).replace(".root",outpostfix+".root"))
-                outFile = ROOT.TFile.Open(outFileName, "RECREATE", "", compressionLevel)
+                if len(shardFileNames) > 1:
+                    self._mergeShards(shardFileNames, outFileName)
                 outFileNames.append(outFileName)
-                if compressionLevel: 
-                    outFile.SetCompressionAlgorithm(compressionAlgo)
-                # prepare output tree
-                if self.friend:
-                    outTree = FriendOutput(inFile, inTree, outFile)
-                else:
-                    outTree = FullOutput(
-                        inFile,
-                        inTree,
-                        outFile,
-                        branchSelection=self.branchsel,
-                        outputbranchSelection=self.outputbranchsel,
-                        fullClone=fullClone,
-                        jsonFilter=jsonFilter,
-                        provenance=self.provenance)
-            else : 
-                outFile = None
-                outTree = None
-
-	    # process events, if needed
-	    if not fullClone:
-		(nall, npass, timeLoop) = eventLoop(self.modules, inFile, outFile, inTree, outTree,maxEvents=self.maxEvents)
-		print 'Processed %d preselected entries from %s (%s entries). Finally selected %d entries' % (nall, fname, inTree.GetEntries(), npass)
-	    else:
-                nall = inTree.GetEntries()
-		print 'Selected %d entries from %s' % (outTree.tree().GetEntries(), fname)
-
-	    # now write the output
-            if not self.noOut: 
-                outTree.write()
-                outFile.Close()
-                print "Done %s" % outFileName
-	    if self.jobReport:
-		self.jobReport.addInputFile(fname,nall)
-		
-	for m in self.modules: m.endJob()
-	
-	print "Total time %.1f sec. to process %i events. Rate = %.1f Hz." %((time.time()-t0), totEntriesRead, totEntriesRead/(time.time()-t0))
-
-
-	if self.haddFileName :
-		os.system("./haddnano.py %s %s" %(self.haddFileName," ".join(outFileNames))) #FIXME: remove "./" once haddnano.py is distributed with cms releases
-	if self.jobReport :
-		self.jobReport.addOutputFile(self.haddFileName)
-		self.jobReport.save()
+            if self.jobReport:
+                self.jobReport.addInputFile(fname,nall)
+
+        for m in self.modules: m.endJob()
+
+        print "Total time %.1f sec. to process %i events. Rate = %.1f Hz." %((time.time()-t0), totEntriesRead, totEntriesRead/(time.time()-t0))
+        if self.profile and profiles:
+            writeReport(mergeReports(profiles), self.profile)
+
+
+        if self.haddFileName :
+            os.system("./haddnano.py -j %d %s %s" %(self.nworkers,self.haddFileName," ".join(outFileNames))) #FIXME: remove "./" once haddnano.py is distributed with cms releases
+        if self.jobReport :
+            self.jobReport.addOutputFile(self.haddFileName)
+            self.jobReport.save()
+
+    def _processTask(self, task):
+        """process the entry range of one input file, return (processed entries, entries read, profile report)"""
+        friendList, outFileName, firstEntry, maxEntries = task
+        fname = friendList[0]
+        checkpoint = None
+        if self.checkpointInterval or self.resume:
+            checkpoint = Checkpoint(outFileName.replace(".root", ".checkpoint"), (fname, firstEntry, maxEntries),
+                                    self.modules, None, self.checkpointInterval or 0)
+            state = checkpoint.load() if self.resume else None
+            if state and state["finished"]:
+                print "Skipping %s, already done according to %s" % (fname, checkpoint.fileName)
+                checkpoint.restoreModules()
+                return (state["done"], state["entries"], None)
+            if state == None and not os.path.isdir(self.outputDir): os.makedirs(self.outputDir)
+        # open input file, from the local cache if requested
+        localName = self._inputCache.get(fname) if self._inputCache else fname
+        inFile = ROOT.TFile.Open(localName)
+
+        #get input tree
+        inTree = inFile.Get(self.treeName)
+        for friend in friendList[1:]:
+            inTree.AddFriend(self.treeName,friend)
+        inTree.SetCacheSize(self.treeCacheSize)
+        if self.treeCacheSize: ROOT.TTreeCache.SetLearnEntries(self.treeCacheLearnEntries)
+        # the reading and decompression times are only measured when profiling
+        perfStats = ROOT.TTreePerfStats("ioperf", inTree) if self.profile else None
+        nentries = inTree.GetEntries() - firstEntry
+        if maxEntries != None: nentries = min(nentries, maxEntries)
+        # pre-skimming
+        elist,jsonFilter = preSkim(inTree, self.json, self.cut, maxEntries, firstEntry, backend=self.preselection, nthreads=self.preselectionThreads, cache=self._elistCache)
+        if self.justcount:
+            print 'Would select %d entries from %s'%(elist.GetN() if elist else nentries, fname)
+            return (0, nentries, None)
+        else:
+            print 'Pre-select %d entries out of %s '%(elist.GetN() if elist else nentries, nentries)
+
+        # without an entry list the requested range has to be given to the event loop
+        eventRange = None
+        if not elist and nentries != inTree.GetEntries():
+            eventRange = xrange(firstEntry, firstEntry+nentries)
+
+        if self._fullClone:
+            # no need of a reader (no event loop), but set up the elist if available
+            if elist: inTree.SetEntryList(elist)
+        else:
+            # initialize reader
+            inTree = InputTree(inTree, elist) 
+            if self.pruneBranches: inTree.learnBranches(self.pruneBranches)
+
+        # prepare output file
+        if not self.noOut:
+            resume = checkpoint != None and checkpoint.startIndex > 0
+            outFile = ROOT.TFile.Open(outFileName, "UPDATE" if resume else "RECREATE", "", self._compressionLevel)
+            if self._compressionLevel: 
+                outFile.SetCompressionAlgorithm(self._compressionAlgo)
+            # prepare output tree
+            if self.friend and self.outputFormat == "parquet":
+                outTree = ParquetOutput(inFile, inTree, outFile, outFileName.replace(".root", ".parquet"), bufferSize=self.outputBufferSize or 10000)
+            elif self.friend:
+                outTree = FriendOutput(inFile, inTree, outFile, bufferSize=self.outputBufferSize, autoFlush=self.autoFlush, basketSize=self.basketSize, resume=resume)
+            else:
+                outTree = FullOutput(
+                    inFile,
+                    inTree,
+                    outFile,
+                    branchSelection=self.branchsel,
+                    outputbranchSelection=self.outputbranchsel,
+                    fullClone=self._fullClone,
+                    maxEntries=maxEntries,
+                    firstEntry=firstEntry,
+                    jsonFilter=jsonFilter,
+                    provenance=self.provenance,
+                    autoFlush=self.autoFlush,
+                    basketSize=self.basketSize)
+        else : 
+            outFile = None
+            outTree = None
+
+        # process events, if needed
+        if not self._fullClone:
+            profiler = ModuleProfiler(self.modules) if self.profile else None
+            if checkpoint: checkpoint.outputTree = outTree
+            (nall, npass, timeLoop) = eventLoop(self.modules, inFile, outFile, inTree, outTree,maxEvents=self.maxEvents,eventRange=eventRange,batchSize=self.batchSize,profiler=profiler,checkpoint=checkpoint)
+            if checkpoint: nall, npass = nall+checkpoint.done, npass+checkpoint.accepted
+            print 'Processed %d preselected entries from %s (%s entries). Finally selected %d entries' % (nall, fname, nentries, npass)
+        else:
+            profiler = None
+            nall = nentries
+            print 'Selected %d entries from %s' % (outTree.tree().GetEntries(), fname)
+
+        # now write the output
+        if not self.noOut: 
+            outTree.write()
+            if checkpoint: checkpoint.finish(nall, npass, nentries)
+            outFile.Close()
+            print "Done %s" % outFileName
+        elif checkpoint:
+            checkpoint.finish(nall, npass, nentries)
+        self._reportIO(fname, inFile, inTree, perfStats)
+        inFile.Close()
+        if self._inputCache:
+            self._inputCache.release(localName)
+        return (nall, nentries, profiler.report() if profiler else None)
+
+    def _chooseCompression(self):
+        """benchmark the compression settings on the first entries of the first input file, see chooseCompression"""
+        target = self.compression.split(":",1)[1] if ":" in self.compression else "speed=20"
+        inFile = ROOT.TFile.Open(self.inputFiles[0][0])
+        inTree = inFile.Get(self.treeName)
+        if self.outputbranchsel and not self.friend:
+            self.outputbranchsel.selectBranches(inTree)
+        compression, measurements = chooseCompression(inTree, target)
+        inFile.Close()
+        print "Compression benchmark on %s (target %s):" % (self.inputFiles[0][0], target)
+        for m in measurements:
+            print "  %-8s %7.1f MB/s, ratio %5.2f%s" % (m["compression"], m["speed"], m["ratio"], "  <- chosen" if m["compression"] == compression else "")
+        if self.jobReport:
+            self.jobReport.addCompression(compression, target, measurements)
+        return compression
+
+    def _reportIO(self, fname, inFile, inTree, perfStats):
+        """print the bytes and read calls to the input file, the TTreeCache efficiency and, with perfStats, the decompression time"""
+        nbytes = inFile.GetBytesRead()
+        ncalls = inFile.GetReadCalls()
+        cache = inTree.GetReadCache(inFile)
+        if cache:
+            cacheInfo = "TTreeCache of %.1f MB with %.1f%% efficiency, %d reads outside the cache" % (
+                cache.GetBufferSize()/1024.**2, 100.*cache.GetEfficiency(), cache.GetNoCacheReadCalls())
+        else:
+            cacheInfo = "no TTreeCache"
+        timeInfo = ""
+        if perfStats:
+            perfStats.Finish()
+            timeInfo = "; %.1f s reading, %.1f s decompressing" % (perfStats.GetDiskTime(), perfStats.GetUnzipTime())
+        print "Read %.1f MB from %s in %d calls (%.1f kB/call), %s%s" % (
+            nbytes/1024.**2, fname, ncalls, nbytes/1024./max(ncalls,1), cacheInfo, timeInfo)
+
+    def _splitEntries(self, fname, nsplit):
+        """split the requested entries of the input tree into up to nsplit (first, number) ranges starting at cluster boundaries"""
+        inFile = ROOT.TFile.Open(fname)
+        inTree = inFile.Get(self.treeName)
+        last = inTree.GetEntries()
+        if self.maxEntries != None: last = min(last, self.firstEntry+self.maxEntries)
+        clusterStarts = []
+        clusterIter = inTree.GetClusterIterator(self.firstEntry)
+        start = clusterIter.Next()
+        while start < last:
+            if start > self.firstEntry: clusterStarts.append(start)
+            start = clusterIter.Next()
+        inFile.Close()
+        ranges = []
+        first = self.firstEntry
+        for ishard in range(1, nsplit):
+            if not clusterStarts: break
+            target = self.firstEntry + ishard*(last-self.firstEntry)/nsplit
+            boundary = min(clusterStarts, key=lambda s: abs(s-target))
+            if boundary > first:
+                ranges.append((first, boundary-first))
+                first = boundary
+        ranges.append((first, last-first))
+        return ranges
+
+    def _mergeShards(self, shardFileNames, outFileName):
+        """merge the outputs of the entry ranges of one input file, keeping the original entry order"""
+        merger = ROOT.TFileMerger(False, False)
+        merger.SetFastMethod(True)
+        merger.SetPrintLevel(0)
+        for shardFileName in shardFileNames:
+            merger.AddFile(shardFileName, False)
+        merger.OutputFile(outFileName, "RECREATE", self._compressionSettings)
+        if not merger.Merge():
+            raise RuntimeError("Failed to merge %s into %s" % (", ".join(shardFileNames), outFileName))
+        for shardFileName in shardFileNames:
+            os.remove(shardFileName)
+        print "Merged %d parts into %s" % (len(shardFileNames), outFileName)
+
+_workerPostProcessor = None
+def _processTask(task):
+    """process a task in a worker process, return the result of PostProcessor._processTask and the states of the modules"""
+    for m, state in zip(_workerPostProcessor.modules, _workerPostProcessor._initialStates):
+        m.setState(cPickle.loads(state))
+    result = _workerPostProcessor._processTask(task)
+    return result + ([ m.getState() for m in _workerPostProcessor.modules ],)
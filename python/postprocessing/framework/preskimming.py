@@ -1,7 +1,10 @@
 import json
 import re
+import hashlib
+import numpy
 import ROOT
 ROOT.PyConfig.IgnoreCommandLineOptions = True
+from PhysicsTools.NanoAODTools.postprocessing.framework.treeReaderArrayTools import restorePrunedBranches
 class JSONFilter:
     def __init__(self,fname="",runsAndLumis={}):
         self.keep = {}
@@ -15,59 +18,277 @@ class JSONFilter:
             self.keep[run] += lumis
         for run in self.keep.keys():
             if len(self.keep[run])==0: del self.keep[run]
+        # sorted, non-overlapping intervals of (run << 32 | lumi), searched with numpy.searchsorted
+        starts, ends = [], []
+        for l1, l2 in sorted(((run << 32) | long(l1), (run << 32) | long(l2)) for run, lumis in self.keep.iteritems() for (l1, l2) in lumis):
+            if starts and l1 <= ends[-1]+1: ends[-1] = max(ends[-1], l2)
+            else: starts.append(l1); ends.append(l2)
+        self._starts = numpy.array(starts, dtype=numpy.int64)
+        self._ends = numpy.array(ends, dtype=numpy.int64)
+        self._runs = numpy.array(sorted(self.keep.iterkeys()), dtype=numpy.int64)
     def filterRunLumi(self,run,lumi):
-        try:
-            for (l1,l2) in self.keep[run]:
-                if l1 <= lumi and lumi <= l2: return True
-            return False
-        except KeyError:
-            return False
+        return bool(self.filterRunLumis([run], [lumi])[0])
     def filterRunOnly(self,run):
         return (run in self.keep)
+    def filterRunLumis(self, runs, lumis):
+        """boolean mask of the (run, lumi) pairs given as arrays that are in the JSON"""
+        keys = (numpy.asarray(runs, dtype=numpy.int64) << 32) | numpy.asarray(lumis, dtype=numpy.int64)
+        if not len(self._starts): return numpy.zeros(len(keys), dtype=bool)
+        i = numpy.searchsorted(self._starts, keys, side="right") - 1
+        return (i >= 0) & (keys <= self._ends[numpy.maximum(i, 0)])
+    def filterRuns(self, runs):
+        """boolean mask of the runs given as an array that are in the JSON"""
+        return numpy.in1d(numpy.asarray(runs, dtype=numpy.int64), self._runs)
+    def hash(self):
+        """hash of the selected runs and lumi sections, independent of the formatting of the JSON"""
+        return hashlib.sha1(json.dumps(sorted((run, sorted(lumis)) for run, lumis in self.keep.iteritems()))).hexdigest()
     def runCut(self):
         return "%d <= run && run <= %s" % (min(self.keep.iterkeys()), max(self.keep.iterkeys()))
-    def filterEList(self, tree, elist):
-        #FIXME this can be optimized for sure
-        tree.SetBranchStatus("*", 0)
-        tree.SetBranchStatus('run',1)
-        tree.SetBranchStatus('luminosityBlock',1)
+    def filterEList(self, tree, elist, byLumi=True, chunkSize=100000):
+        """return a TEntryList with the entries of tree (or of elist) in the JSON, or only in its runs if not byLumi.
+           run and luminosityBlock are read chunkSize entries at a time with TTree::Draw."""
+        filteredList = ROOT.TEntryList('filteredList','filteredList')
+        nentries = elist.GetN() if elist else tree.GetEntries()
+        varexp = "Entry$:run:luminosityBlock" if byLumi else "Entry$:run"
+        _declareEnterEntries()
+        restorePrunedBranches(tree)
+        estimate = tree.GetEstimate()
+        tree.SetEstimate(chunkSize+1)
+        if elist: tree.SetEntryList(elist)
+        try:
+            for first in xrange(0, nentries, chunkSize):
+                tree.Draw(varexp, "", "goff", chunkSize, first)
+                rows = tree.GetSelectedRows()
+                if rows <= 0: continue
+                entries = _drawnValues(tree.GetV1(), rows)
+                if byLumi: mask = self.filterRunLumis(_drawnValues(tree.GetV2(), rows), _drawnValues(tree.GetV3(), rows))
+                else: mask = self.filterRuns(_drawnValues(tree.GetV2(), rows))
+                selected = numpy.ascontiguousarray(entries[mask], dtype=numpy.int64)
+                ROOT.nanoAODTools.enterEntries(filteredList, len(selected), int(selected.ctypes.data))
+        finally:
+            if elist: tree.SetEntryList(0)
+            tree.SetEstimate(estimate)
+        return filteredList
+    def filterClusters(self, tree, firstEntry=0, lastEntry=None, chunkSize=1000000):
+        """return a TEntryList with the entries of tree in [firstEntry, lastEntry) in the JSON.
+
+           run and luminosityBlock are read for every entry (they are small and compress well), as entries are not
+           necessarily ordered by lumi section (e.g. merged inputs). A cut drawn with this entry list set then
+           doesn't read its branches in the clusters without any entry in the JSON."""
+        if lastEntry == None: lastEntry = tree.GetEntries()
         filteredList = ROOT.TEntryList('filteredList','filteredList')
-        if elist:
-            for i in xrange(elist.GetN()):
-                entry = elist.GetEntry(0) if i == 0 else elist.Next()
-                tree.GetEntry(entry)
-                if self.filterRunLumi(tree.run, tree.luminosityBlock):
-                    filteredList.Enter(entry)
-        else:
-            for entry in xrange(tree.GetEntries()):
-                tree.GetEntry(entry)
-                if self.filterRunLumi(tree.run, tree.luminosityBlock):
-                    filteredList.Enter(entry)
-        tree.SetBranchStatus("*", 1)
+        if lastEntry <= firstEntry: return filteredList
+        starts = [firstEntry]
+        clusterIter = tree.GetClusterIterator(firstEntry)
+        start = clusterIter.Next()
+        while start < lastEntry:
+            if start > firstEntry: starts.append(start)
+            start = clusterIter.Next()
+        keys = numpy.zeros(lastEntry-firstEntry, dtype=numpy.int64)
+        estimate = tree.GetEstimate()
+        tree.SetEstimate(chunkSize+1)
+        try:
+            for first in xrange(firstEntry, lastEntry, chunkSize):
+                n = min(chunkSize, lastEntry-first)
+                tree.Draw("run:luminosityBlock", "", "goff", n, first)
+                rows = tree.GetSelectedRows()
+                if rows != n: raise RuntimeError, "Read %d values of run and luminosityBlock, expected %d" % (rows,n)
+                keys[first-firstEntry:first-firstEntry+n] = (_drawnValues(tree.GetV1(), rows) << 32) | _drawnValues(tree.GetV2(), rows)
+        finally:
+            tree.SetEstimate(estimate)
+        mask = self.filterRunLumis(keys >> 32, keys & 0xFFFFFFFF)
+        selected = numpy.ascontiguousarray(numpy.flatnonzero(mask) + firstEntry, dtype=numpy.int64)
+        _declareEnterEntries()
+        ROOT.nanoAODTools.enterEntries(filteredList, len(selected), int(selected.ctypes.data))
+        emptyClusters = numpy.count_nonzero(numpy.add.reduceat(mask.astype(numpy.int64), numpy.array(starts, dtype=numpy.int64) - firstEntry) == 0)
+        print 'JSON: %d entries selected, %d of %d clusters have none and are skipped by the cut' % (len(selected), emptyClusters, len(starts))
         return filteredList
-                
+    def filterTree(self, tree, byLumi=True):
+        """copy of the entries of tree (e.g. LuminosityBlocks, or Runs if not byLumi) in the JSON"""
+        elist = self.filterEList(tree, None, byLumi=byLumi)
+        tree.SetEntryList(elist)
+        try:
+            return tree.CopyTree('1')
+        finally:
+            tree.SetEntryList(0)
+
+def _drawnValues(buff, rows):
+    buff.SetSize(rows)
+    return numpy.frombuffer(buff, dtype=numpy.float64, count=rows).astype(numpy.int64)
 
-def preSkim(tree, jsonInput = None, cutstring = None, maxEntries = None, firstEntry = 0):
+_enterEntriesDeclared = False
+def _declareEnterEntries():
+    global _enterEntriesDeclared
+    if _enterEntriesDeclared: return
+    ROOT.gInterpreter.Declare("""
+    #include <algorithm>
+    #include <vector>
+    #include "TEntryList.h"
+    namespace nanoAODTools {
+        // add the n entry numbers at entriesAddress to elist
+        void enterEntries(TEntryList * elist, Long64_t n, ULong64_t entriesAddress) {
+            const Long64_t * entries = reinterpret_cast<const Long64_t *>(entriesAddress);
+            for (Long64_t i = 0; i < n; ++i) elist->Enter(entries[i]);
+        }
+        // entry list of the entries (in any order, as collected by several threads) that are also in within, if given
+        TEntryList * sortedEntryList(std::vector<ULong64_t> entries, const TEntryList * within) {
+            std::sort(entries.begin(), entries.end());
+            TEntryList * elist = new TEntryList("elist", "elist");
+            for (ULong64_t entry : entries) {
+                if (!within || const_cast<TEntryList *>(within)->Contains(entry)) elist->Enter(entry);
+            }
+            return elist;
+        }
+        // copy the entry numbers of elist to the GetN() Long64_t at entriesAddress
+        void entryListEntries(TEntryList * elist, ULong64_t entriesAddress) {
+            Long64_t * entries = reinterpret_cast<Long64_t *>(entriesAddress);
+            Long64_t n = elist->GetN();
+            for (Long64_t i = 0; i < n; ++i) entries[i] = elist->GetEntry(i);
+        }
+    }
+    """)
+    _enterEntriesDeclared = True
+
+
+_passingEntriesDeclared = False
+def _declarePassingEntries():
+    global _passingEntriesDeclared
+    if _passingEntriesDeclared: return
+    ROOT.gInterpreter.Declare("""
+    #include <mutex>
+    #include <stdexcept>
+    #include <vector>
+    #include "ROOT/TTreeProcessorMT.hxx"
+    #include "TTreeFormula.h"
+    namespace nanoAODTools {
+        // entries in [first, last) of treeName in fileName passing cut, which is evaluated with a TTreeFormula per task
+        // of ROOT::TTreeProcessorMT in the implicit multithreading pool. The entries are the tree entry numbers
+        // given by TTreeReader::GetCurrentEntry, in the order in which the tasks finish.
+        std::vector<ULong64_t> passingEntriesMT(const char * fileName, const char * treeName, const char * cut, Long64_t first, Long64_t last) {
+            std::vector<ULong64_t> entries;
+            std::mutex mutex;
+            bool valid = true;
+            ROOT::TTreeProcessorMT processor(fileName, treeName);
+            processor.Process([&](TTreeReader & reader) {
+                TTree * tree = reader.GetTree();
+                TTreeFormula formula("cut", cut, tree);
+                if (formula.GetNdim() == 0) {
+                    std::lock_guard<std::mutex> guard(mutex);
+                    valid = false;
+                    return;
+                }
+                Int_t treeNumber = -1;
+                std::vector<ULong64_t> passing;
+                while (reader.Next()) {
+                    const Long64_t entry = reader.GetCurrentEntry();
+                    if (entry < first || entry >= last) continue;
+                    if (tree->GetTreeNumber() != treeNumber) {
+                        treeNumber = tree->GetTreeNumber();
+                        formula.UpdateFormulaLeaves();
+                    }
+                    // as for TTree::Draw(">>elist"), an entry passes if any instance of the cut does
+                    const Int_t n = formula.GetNdata();
+                    for (Int_t i = 0; i < n; ++i) {
+                        if (formula.EvalInstance(i) != 0) {
+                            passing.push_back(entry);
+                            break;
+                        }
+                    }
+                }
+                std::lock_guard<std::mutex> guard(mutex);
+                entries.insert(entries.end(), passing.begin(), passing.end());
+            });
+            if (!valid) throw std::runtime_error(std::string("cannot compile the cut ")+cut);
+            return entries;
+        }
+    }
+    """)
+    _passingEntriesDeclared = True
+
+def parallelEList(tree, cut, firstEntry=0, lastEntry=None, jsonList=None, nthreads=0):
+    """evaluate cut on the entries [firstEntry, lastEntry) of tree with ROOT::TTreeProcessorMT in nthreads threads
+       (0: all cores), and return the sorted TEntryList of the passing entries that are also in jsonList, if given.
+       Returns None if this is not possible, so that TTree::Draw is used instead: TTreeProcessorMT reads the whole
+       tree in the file, without its friends, so this is only done for all entries of a tree on disk without friends
+       and without a JSON entry list (whose clusters TTree::Draw skips)."""
+    if lastEntry == None: lastEntry = tree.GetEntries()
+    inFile = tree.GetCurrentFile()
+    if not inFile: return None
+    reason = None
+    if tree.GetListOfFriends() and tree.GetListOfFriends().GetSize() > 0: reason = "friend trees"
+    elif firstEntry > 0 or lastEntry < tree.GetEntries(): reason = "an entry range"
+    elif jsonList is not None: reason = "a JSON"
+    if reason:
+        print "Evaluating the cut with TTree::Draw instead of several threads because of %s" % reason
+        return None
+    _declareEnterEntries()
+    enableMT = not ROOT.IsImplicitMTEnabled()
+    try:
+        _declarePassingEntries()
+        if enableMT: ROOT.EnableImplicitMT(nthreads)
+        entries = ROOT.nanoAODTools.passingEntriesMT(inFile.GetName(), tree.GetName(), cut, firstEntry, lastEntry)
+        elist = ROOT.nanoAODTools.sortedEntryList(entries, jsonList)
+        ROOT.SetOwnership(elist, True)
+        return elist
+    except Exception, e:
+        print "Could not evaluate the cut %r in several threads (%s), using TTree::Draw" % (cut, e)
+        return None
+    finally:
+        if enableMT: ROOT.DisableImplicitMT()
+
+def preSkim(tree, jsonInput = None, cutstring = None, maxEntries = None, firstEntry = 0, backend = "draw", nthreads = 0, cache = None):
+    """return the entry list of the entries passing the JSON and the cut (None if there is neither) and the JSONFilter;
+       the cut is evaluated with TTree::Draw, or with backend="mt" in several threads when possible.
+       With an EntryListCache, the entry list is looked up there first and stored there once computed."""
     if jsonInput == None and cutstring == None: 
         return None,None
-    cut = None
+    cut = cutstring
     jsonFilter = None
+    if maxEntries is None: maxEntries = ROOT.TVirtualTreePlayer.kMaxEntries
     if jsonInput != None:
 	if type(jsonInput) is dict:
             jsonFilter = JSONFilter(runsAndLumis=jsonInput)
 	else:
             jsonFilter = JSONFilter(jsonInput)
-        cut = jsonFilter.runCut()
-    if cutstring != None: 
-        cut = "(%s) && (%s)" % (cutstring, cut) if cut else cutstring
-    if maxEntries is None: maxEntries = ROOT.TVirtualTreePlayer.kMaxEntries
-    while "AltBranch$" in cut:
+    while cut and "AltBranch$" in cut:
         m = re.search(r"AltBranch\$\(\s*(\w+)\s*,\s*(\w+)\s*\)", cut)
         if not m:
             raise RuntimeError("Error, found AltBranch$ in cut string, but it doesn't comply with the syntax this code can support. The cut is %r" % cut)
         cut = cut.replace(m.group(0), m.group(1) if tree.GetBranch(m.group(1)) else m.group(2))
-    tree.Draw('>>elist',cut,"entrylist", maxEntries, firstEntry)
-    elist = ROOT.gDirectory.Get('elist')
-    if jsonInput:
-        elist = jsonFilter.filterEList(tree,elist)
+    if cache == None:
+        return _preSkim(tree, jsonFilter, cut, maxEntries, firstEntry, backend, nthreads),jsonFilter
+    key = cache.key(tree, " ".join(cut.split()) if cut else None, jsonFilter.hash() if jsonFilter else None, firstEntry, maxEntries, backend)
+    _declareEnterEntries()
+    entries = cache.load(key)
+    if entries is not None:
+        print 'Loaded the pre-selection of %d entries from %s' % (len(entries), cache.path(key))
+        elist = ROOT.TEntryList('elist','elist')
+        ROOT.nanoAODTools.enterEntries(elist, len(entries), int(entries.ctypes.data))
+        return elist,jsonFilter
+    elist = _preSkim(tree, jsonFilter, cut, maxEntries, firstEntry, backend, nthreads)
+    entries = numpy.zeros(elist.GetN(), dtype=numpy.int64)
+    ROOT.nanoAODTools.entryListEntries(elist, int(entries.ctypes.data))
+    cache.save(key, entries)
     return elist,jsonFilter
+
+def _preSkim(tree, jsonFilter, cut, maxEntries, firstEntry, backend, nthreads):
+    restorePrunedBranches(tree)
+    jsonList = None
+    if jsonFilter:
+        # the JSON is applied first, so that the cut is only evaluated in the clusters it keeps
+        jsonList = jsonFilter.filterClusters(tree, firstEntry, min(tree.GetEntries(), firstEntry+maxEntries))
+        if cut == None: return jsonList
+    if backend == "mt":
+        elist = parallelEList(tree, cut, firstEntry, min(tree.GetEntries(), firstEntry+maxEntries), jsonList, nthreads)
+        if elist is not None: return elist
+    elif backend != "draw":
+        raise RuntimeError("Unknown pre-selection backend %s" % backend)
+    if jsonList:
+        tree.SetEntryList(jsonList)
+        try:
+            tree.Draw('>>elist',cut,"entrylist")
+        finally:
+            tree.SetEntryList(0)
+    else:
+        tree.Draw('>>elist',cut,"entrylist", maxEntries, firstEntry)
+    return ROOT.gDirectory.Get('elist')
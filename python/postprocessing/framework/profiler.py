@@ -0,0 +1,121 @@
+import copy
+import json
+import time
+import numpy
+from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import DEFERRED
+
+class ModuleProfiler:
+    """Records wall time, call counts, accept rates and branches read for each module,
+       together with the creation of TTreeReaders, while running the event loop"""
+    def __init__(self, modules=[]):
+        self._labels = {}
+        self._stats = []
+        for m in modules:
+            self._labels[id(m)] = len(self._stats)
+            self._stats.append({
+                "name": "%02d_%s" % (len(self._stats), m.__class__.__name__),
+                "beginFile": {"time": 0., "calls": 0},
+                "endFile": {"time": 0., "calls": 0},
+                "analyze": {"time": 0., "calls": 0, "accepted": 0},
+                "analyzeBatch": {"time": 0., "calls": 0, "events": 0, "accepted": 0},
+                "deferred": {"time": 0., "calls": 0},
+                "branches": set(),
+            })
+        self._current = None
+        self._readers = []
+        self._files = []
+    def attach(self, tree):
+        """start recording branch reads and reader creations of tree"""
+        tree._profiler = self
+        tree._accessLog = None
+    def beginFile(self, m, inputFile, outputFile, inputTree, wrappedOutputTree):
+        self._call(m, "beginFile", inputTree, m.beginFile, inputFile, outputFile, inputTree, wrappedOutputTree)
+    def endFile(self, m, inputFile, outputFile, inputTree, wrappedOutputTree):
+        self._call(m, "endFile", inputTree, m.endFile, inputFile, outputFile, inputTree, wrappedOutputTree)
+    def analyze(self, m, event):
+        ret = self._call(m, "analyze", event._tree, m.analyze, event)
+        if ret and ret is not DEFERRED: self._stats[self._labels[id(m)]]["analyze"]["accepted"] += 1
+        return ret
+    def runDeferred(self, m):
+        self._call(m, "deferred", None, m.runDeferred)
+    def resume(self, m, event):
+        """the time to finish deferred events is accounted apart, their acceptance to analyze"""
+        ret = self._call(m, "deferred", event._tree, m.resume, event)
+        if ret: self._stats[self._labels[id(m)]]["analyze"]["accepted"] += 1
+        return ret
+    def analyzeBatch(self, m, batch):
+        ret = self._call(m, "analyzeBatch", batch._tree, m.analyzeBatch, batch)
+        if ret is not None:
+            stats = self._stats[self._labels[id(m)]]["analyzeBatch"]
+            stats["events"] += len(ret)
+            stats["accepted"] += int(numpy.count_nonzero(ret))
+        return ret
+    def readerCreated(self, tree, branchName, kind):
+        """called by treeReaderArrayTools when a reader is made ('array', 'value') or all readers are remade ('remake')"""
+        self._readers.append({
+            "module": self._current["name"] if self._current else None,
+            "branch": branchName,
+            "kind": kind,
+            "entry": tree.entry,
+        })
+    def addFile(self, fileName, entries, accepted, loopTime):
+        self._files.append({"file": fileName, "entries": entries, "accepted": accepted, "time": loopTime})
+    def report(self):
+        """return the collected information as a JSON-serializable dict"""
+        modules = []
+        for stats in self._stats:
+            stats = dict(stats)
+            stats["branches"] = sorted(stats["branches"])
+            modules.append(stats)
+        return {"files": self._files, "modules": modules, "readers": self._readers}
+    def _call(self, m, method, tree, fct, *args):
+        # branch reads and reader creations during the call are accounted to m
+        self._current = self._stats[self._labels[id(m)]]
+        if tree is not None: tree._accessLog = self._current["branches"]
+        t0 = time.time()
+        try:
+            return fct(*args)
+        finally:
+            self._current[method]["time"] += time.time()-t0
+            self._current[method]["calls"] += 1
+            self._current = None
+            if tree is not None: tree._accessLog = None
+
+def mergeReports(reports):
+    """combine the reports of several files or entry ranges processed with the same modules"""
+    merged = {"files": [], "modules": [], "readers": []}
+    for report in reports:
+        merged["files"].extend(report["files"])
+        merged["readers"].extend(report["readers"])
+        if not merged["modules"]:
+            merged["modules"] = copy.deepcopy(report["modules"])
+            continue
+        for total, stats in zip(merged["modules"], report["modules"]):
+            for method in ("beginFile", "endFile", "analyze", "analyzeBatch", "deferred"):
+                for k, v in stats[method].iteritems():
+                    total[method][k] += v
+            total["branches"] = sorted(set(total["branches"]) | set(stats["branches"]))
+    return merged
+
+def writeReport(report, fileName, ntop=10):
+    """write the report as JSON, adding derived quantities, and print the most expensive modules"""
+    loopTime = sum(f["time"] for f in report["files"])
+    for stats in report["modules"]:
+        analyze = stats["analyze"]
+        analyze["acceptRate"] = analyze["accepted"]/float(analyze["calls"]) if analyze["calls"] else None
+        stats["totalTime"] = sum(stats[method]["time"] for method in ("beginFile", "endFile", "analyze", "analyzeBatch", "deferred"))
+        stats["fraction"] = stats["totalTime"]/loopTime if loopTime > 0 else None
+    report["summary"] = {
+        "loopTime": loopTime,
+        "entries": sum(f["entries"] for f in report["files"]),
+        "readersCreated": len([r for r in report["readers"] if r["kind"] != "remake"]),
+        "readerRemakes": len([r for r in report["readers"] if r["kind"] == "remake"]),
+    }
+    with open(fileName, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print "Wrote profile to %s (%.1f s in the event loop, %d readers created, %d remakes of all readers)" % (
+        fileName, loopTime, report["summary"]["readersCreated"], report["summary"]["readerRemakes"])
+    for stats in sorted(report["modules"], key=lambda s: -s["totalTime"])[:ntop]:
+        print "  %-40s %8.2f s (%5.1f%%), %8d calls, accept rate %s" % (
+            stats["name"], stats["totalTime"], 100.*(stats["fraction"] or 0.), stats["analyze"]["calls"],
+            "%5.1f%%" % (100.*stats["analyze"]["acceptRate"]) if stats["analyze"]["acceptRate"] != None else "-")
@@ -1,4 +1,7 @@
 import types
+import fnmatch
+import ctypes
+import numpy
 import ROOT
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 
@@ -16,14 +19,25 @@ def InputTree(tree,entrylist=None):
     tree.arrayReader = types.MethodType(getArrayReader, tree)
     tree.valueReader = types.MethodType(getValueReader, tree)
     tree.readBranch = types.MethodType(readBranch, tree)
+    tree.declareInputs = types.MethodType(declareInputs, tree)
+    tree.learnBranches = types.MethodType(learnBranches, tree)
+    tree.arrayView = types.MethodType(arrayView, tree)
     tree.gotoEntry = types.MethodType(_gotoEntry, tree)
     tree.readAllBranches = types.MethodType(_readAllBranches, tree)
     tree.entries = tree._ttreereader.GetEntries(False)
     tree._extrabranches={}
+    tree._profiler = None
+    tree._accessLog = None
+    tree._undeclaredReads = {}
+    tree._learnEntries = 0
+    tree._usedBranches = set()
+    tree._prunedBranches = None
     return tree
 
 def getArrayReader(tree, branchName):
     """Make a reader for branch branchName containing a variable-length value array."""
+    if tree._accessLog is not None: tree._accessLog.add(branchName)
+    tree._usedBranches.add(branchName)
     if branchName not in tree._ttras:
        if not tree.GetBranch(branchName): raise RuntimeError, "Can't find branch '%s'" % branchName
        leaf = tree.GetBranch(branchName).GetLeaf(branchName)
@@ -34,6 +48,8 @@ def getArrayReader(tree, branchName):
 
 def getValueReader(tree, branchName):
     """Make a reader for branch branchName containing a single value."""
+    if tree._accessLog is not None: tree._accessLog.add(branchName)
+    tree._usedBranches.add(branchName)
     if branchName not in tree._ttrvs:
        if not tree.GetBranch(branchName): raise RuntimeError, "Can't find branch '%s'" % branchName
        leaf = tree.GetBranch(branchName).GetLeaf(branchName)
@@ -42,6 +58,87 @@ def getValueReader(tree, branchName):
        tree._ttrvs[branchName] = _makeValueReader(tree, typ, branchName)
     return tree._ttrvs[branchName]
 
+def declareInputs(tree, *patterns):
+    """Make the readers of all branches matching the given patterns (wildcards as in fnmatch) at once.
+
+       Modules should call this in beginFile, so that all readers exist before the first entry is read:
+       a reader made later forces all the others to be remade (see _remakeAllReaders).
+       Returns the names of the matching branches.
+    """
+    names = [ name for name in _branchNames(tree) if any(fnmatch.fnmatchcase(name, p) for p in patterns) ]
+    newReaders = []
+    for name in names:
+        if name in tree._ttras or name in tree._ttrvs: continue
+        leaf = tree.GetBranch(name).GetLeaf(name)
+        if not leaf: continue
+        isValue = leaf.GetLen() == 1 and not bool(leaf.GetLeafCount())
+        newReaders.append((name, leaf.GetTypeName(), isValue))
+    if not newReaders: return names
+    if tree._ttreereader._isClean:
+        for name, typ, isValue in newReaders:
+            if isValue: _makeValueReader(tree, typ, name)
+            else: _makeArrayReader(tree, typ, name)
+    else:
+        # declared too late: remake the readers only once for all new branches
+        for name, typ, isValue in newReaders:
+            tree._leafTypes[name] = typ
+            if isValue: tree._ttrvs[name] = None
+            else: tree._ttras[name] = None
+            tree._undeclaredReads[name] = tree.entry
+        _remakeAllReaders(tree)
+        tree.gotoEntry(tree.entry, forceCall=True)
+    return names
+
+def learnBranches(tree, nEntries):
+    """Record the branches read in the next nEntries entries (with readBranch, or through an arrayReader
+       or valueReader), then disable all other branches and size the TTreeCache for the ones that are used.
+       Branches read later are enabled again; readers made by declareInputs alone don't count as reads."""
+    tree._learnEntries = nEntries+1
+
+def restorePrunedBranches(tree):
+    """Enable again the branches disabled by learnBranches, e.g. before a TTree::Draw, a TTreeFormula or
+       a TTree::GetEntry, which would silently read stale values of disabled branches."""
+    if not getattr(tree, '_prunedBranches', None): return
+    print "Enabling the %d disabled input branches again" % len(tree._prunedBranches)
+    ownBranches = set(b.GetName() for b in tree.GetListOfBranches())
+    for name in tree._prunedBranches:
+        tree.SetBranchStatus(name, 1)
+        if name in ownBranches: tree.AddBranchToCache(name, True)
+    tree._prunedBranches = set()
+
+def readColumn(tree, branchName, first=0, n=None, entrylist=None):
+    """Read branch branchName for n consecutive entries starting at first into NumPy arrays.
+
+       Entries are positions in entrylist if one is given (as for gotoEntry on an InputTree).
+       Returns (values, counts): counts is None for single values, otherwise it holds the number
+       of elements of each entry and values is the flat content of all entries, with the type of the branch.
+       The values are copied by a separate TTreeReader, which moves the branches to other entries:
+       call it before gotoEntry, not while an event is being processed.
+    """
+    branch = tree.GetBranch(branchName)
+    if not branch: raise RuntimeError, "Unknown branch %s" % branchName
+    leaf = branch.GetLeaf(branchName)
+    typ = leaf.GetTypeName()
+    if typ not in _rootLeafType2NumpyType: raise RuntimeError, "Can't read branch %s of type %s as a column" % (branchName,typ)
+    # only this branch and its counter are read, see learnBranches
+    if getattr(tree, '_learnEntries', 0): tree._usedBranches.add(branchName)
+    elif getattr(tree, '_prunedBranches', None): _enableBranch(tree, branchName)
+    if n == None: n = (entrylist.GetN() if entrylist else tree.GetEntries()) - first
+    isArray = bool(leaf.GetLeafCount()) or leaf.GetLen() != 1
+    dtype = numpy.dtype(_rootLeafType2NumpyType[typ])
+    if n <= 0: return numpy.zeros(0, dtype=dtype), (numpy.zeros(0, dtype=numpy.int64) if isArray else None)
+    # booleans are stored as bytes, std::vector<bool> being packed
+    values = ROOT.std.vector('UChar_t' if typ == 'Bool_t' else typ)()
+    counts = ROOT.std.vector('Long64_t')()
+    _declareReadColumn()
+    if not getattr(ROOT.nanoAODTools, 'readColumn_'+typ)(tree, entrylist, branchName, isArray, first, n, values, counts):
+        raise RuntimeError, "Can't read entries %d to %d of branch %s" % (first, first+n-1, branchName)
+    values = _vectorToNumpy(values, dtype)
+    if not isArray: return values, None
+    counts = _vectorToNumpy(counts, numpy.dtype(numpy.int64))
+    if len(counts) != n or counts.sum() != len(values): raise RuntimeError, "Read %d values in %d entries for %s, expected %d entries" % (len(values),len(counts),branchName,n)
+    return values, counts
+
 def clearExtraBranches(tree):
     tree._extrabranches = {}
 
@@ -51,9 +148,12 @@ def setExtraBranch(tree,name,val):
 def readBranch(tree, branchName):
     """Return the branch value if the branch is a value, and a TreeReaderArray if the branch is an array"""
     if tree._ttreereader._isClean: raise RuntimeError, "readBranch must not be called before calling gotoEntry"
+    if tree._accessLog is not None: tree._accessLog.add(branchName)
     if branchName in tree._extrabranches:
         return tree._extrabranches[branchName]
-    elif branchName in tree._ttras:
+    if tree._learnEntries: tree._usedBranches.add(branchName)
+    elif tree._prunedBranches and branchName in tree._prunedBranches: _enableBranch(tree, branchName)
+    if branchName in tree._ttras:
         return tree._ttras[branchName]
     elif branchName in tree._ttrvs: 
         ret = tree._ttrvs[branchName].Get()[0]
@@ -73,25 +173,140 @@ def readBranch(tree, branchName):
             tree.gotoEntry(tree.entry,forceCall=True) # force calling SetEntry as a new ArrayReader was created
             return _ar
 
+def arrayView(tree, branchName):
+    """Return the variable-length array branchName at the current entry as a NumPy array.
+
+       The array is a read-only view of the buffer of the TTreeReaderArray (no copy), so it is
+       only valid until the next call to gotoEntry. Values set with setExtraBranch are converted instead.
+    """
+    ret = readBranch(tree, branchName)
+    if branchName in tree._extrabranches: return numpy.asarray(ret)
+    return _arrayView(ret, tree._leafTypes[branchName])
+
 
 
 ####### PRIVATE IMPLEMENTATION PART #######
 
+_rootLeafType2NumpyType = { 'Bool_t':'bool', 'Char_t':'int8', 'UChar_t':'uint8', 'Short_t':'int16', 'UShort_t':'uint16',
+                            'Int_t':'int32', 'UInt_t':'uint32', 'Long64_t':'int64', 'ULong64_t':'uint64',
+                            'Float_t':'float32', 'Double_t':'float64' }
+
+_readColumnDeclared = False
+def _declareReadColumn():
+    global _readColumnDeclared
+    if _readColumnDeclared: return
+    code = """
+    #include <vector>
+    #include "TTree.h"
+    #include "TEntryList.h"
+    #include "TTreeReader.h"
+    #include "TTreeReaderValue.h"
+    #include "TTreeReaderArray.h"
+    namespace nanoAODTools {
+        // append the values of branch name for the entries [first, first+n) of tree (positions in elist if given) to values,
+        // and for arrays the number of values of each entry to counts; false if an entry or the branch can't be read
+        template<typename T, typename S> bool readColumnImpl(TTree * tree, TEntryList * elist, const char * name, bool isArray, Long64_t first, Long64_t n, std::vector<S> & values, std::vector<Long64_t> & counts) {
+            TTreeReader reader(tree, elist);
+            if (isArray) {
+                TTreeReaderArray<T> arr(reader, name);
+                for (Long64_t i = first; i < first+n; ++i) {
+                    if (reader.SetEntry(i) != TTreeReader::kEntryValid || arr.GetSetupStatus() < 0) return false;
+                    const std::size_t size = arr.GetSize();
+                    counts.push_back(size);
+                    for (std::size_t j = 0; j < size; ++j) values.push_back(arr.At(j));
+                }
+            } else {
+                TTreeReaderValue<T> val(reader, name);
+                for (Long64_t i = first; i < first+n; ++i) {
+                    if (reader.SetEntry(i) != TTreeReader::kEntryValid || val.GetSetupStatus() < 0) return false;
+                    values.push_back(*val);
+                }
+            }
+            return true;
+        }
+        template<typename S> Long64_t vectorAddressImpl(std::vector<S> & values) { return reinterpret_cast<Long64_t>(values.data()); }
+    """
+    for typ in sorted(_rootLeafType2NumpyType.iterkeys()):
+        storage = 'UChar_t' if typ == 'Bool_t' else typ
+        code += "    bool readColumn_%s(TTree * tree, TEntryList * elist, const char * name, bool isArray, Long64_t first, Long64_t n, std::vector<%s> & values, std::vector<Long64_t> & counts) { return readColumnImpl<%s>(tree, elist, name, isArray, first, n, values, counts); }\n" % (typ, storage, typ)
+        if typ != 'Bool_t': code += "    Long64_t vectorAddress(std::vector<%s> & values) { return vectorAddressImpl(values); }\n" % typ
+    code += "}\n"
+    ROOT.gInterpreter.Declare(code)
+    _readColumnDeclared = True
+
+def _vectorToNumpy(vec, dtype):
+    """copy of the content of a std::vector as a NumPy array of type dtype (of the same size as the elements)"""
+    n = vec.size()
+    if n == 0: return numpy.zeros(0, dtype=dtype)
+    buff = (ctypes.c_char * (n*dtype.itemsize)).from_address(ROOT.nanoAODTools.vectorAddress(vec))
+    return numpy.frombuffer(buff, dtype=dtype).copy()
+
+_readerArrayAddressDeclared = False
+def _declareReaderArrayAddress():
+    global _readerArrayAddressDeclared
+    if _readerArrayAddressDeclared: return
+    code = """
+    #include "TTreeReaderArray.h"
+    namespace nanoAODTools {
+        // address of the first element, 0 if empty, -1 if the elements are not contiguous in memory
+        template<typename T> Long64_t readerArrayAddressImpl(TTreeReaderArray<T> & arr) {
+            std::size_t n = arr.GetSize();
+            if (n == 0) return 0;
+            if (n > 1 && &arr.At(n-1) != &arr.At(0) + (n-1)) return -1;
+            return reinterpret_cast<Long64_t>(&arr.At(0));
+        }
+    """
+    for typ in sorted(_rootLeafType2NumpyType.iterkeys()):
+        code += "    Long64_t readerArrayAddress(TTreeReaderArray<%s> & arr) { return readerArrayAddressImpl(arr); }\n" % typ
+    code += "}\n"
+    ROOT.gInterpreter.Declare(code)
+    _readerArrayAddressDeclared = True
+
+def _arrayView(ttra, typ):
+    if typ not in _rootLeafType2NumpyType: raise RuntimeError, "Can't view an array of type %s with NumPy" % typ
+    dtype = numpy.dtype(_rootLeafType2NumpyType[typ])
+    _declareReaderArrayAddress()
+    address = ROOT.nanoAODTools.readerArrayAddress(ttra)
+    if address == 0: return numpy.zeros(0, dtype=dtype)
+    n = ttra.GetSize()
+    if address < 0: return numpy.array([ttra[i] for i in xrange(n)], dtype=dtype)
+    buff = (ctypes.c_char * (n*dtype.itemsize)).from_address(address)
+    view = numpy.frombuffer(buff, dtype=dtype)
+    view.flags.writeable = False
+    return view
+
+def _branchNames(tree):
+    names = [ b.GetName() for b in tree.GetListOfBranches() ]
+    friends = tree.GetListOfFriends()
+    if friends:
+        for friend in friends:
+            names += [ b.GetName() for b in friend.GetTree().GetListOfBranches() ]
+    return names
+
 def _makeArrayReader(tree, typ, nam):
-    if not tree._ttreereader._isClean: _remakeAllReaders(tree)
+    if tree._prunedBranches: _enableBranch(tree, nam)
+    if not tree._ttreereader._isClean:
+        tree._undeclaredReads[nam] = tree.entry
+        _remakeAllReaders(tree)
     ttra = ROOT.TTreeReaderArray(typ)(tree._ttreereader, nam)
+    if tree._profiler: tree._profiler.readerCreated(tree, nam, 'array')
     tree._leafTypes[nam] = typ
     tree._ttras[nam] = ttra;
     return tree._ttras[nam]
 
 def _makeValueReader(tree, typ, nam):
-    if not tree._ttreereader._isClean: _remakeAllReaders(tree)
+    if tree._prunedBranches: _enableBranch(tree, nam)
+    if not tree._ttreereader._isClean:
+        tree._undeclaredReads[nam] = tree.entry
+        _remakeAllReaders(tree)
     ttrv = ROOT.TTreeReaderValue(typ)(tree._ttreereader, nam)
+    if tree._profiler: tree._profiler.readerCreated(tree, nam, 'value')
     tree._leafTypes[nam] = typ
     tree._ttrvs[nam] = ttrv
     return tree._ttrvs[nam]
 
 def _remakeAllReaders(tree):
+    if tree._profiler: tree._profiler.readerCreated(tree, None, 'remake')
     _ttreereader = ROOT.TTreeReader(tree, getattr(tree, '_entrylist', None))
     _ttreereader._isClean = True
     _ttrvs = {}
@@ -106,7 +321,43 @@ def _remakeAllReaders(tree):
     tree._ttreereaderversion += 1
 
 
+def _withCountBranch(tree, name):
+    leaf = tree.GetBranch(name).GetLeaf(name)
+    if leaf and bool(leaf.GetLeafCount()): return [name, leaf.GetLeafCount().GetBranch().GetName()]
+    return [name]
+
+def _pruneBranches(tree):
+    used = set()
+    for name in tree._usedBranches:
+        if tree.GetBranch(name): used.update(_withCountBranch(tree, name))
+    # only disable active branches, so that restorePrunedBranches gives back e.g. the input branch selection
+    tree._prunedBranches = set(name for name in _branchNames(tree) if name not in used and tree.GetBranchStatus(name))
+    for name in tree._prunedBranches: tree.SetBranchStatus(name, 0)
+    # cache one cluster of the used branches of this tree (not of its friends)
+    ownBranches = set(b.GetName() for b in tree.GetListOfBranches())
+    cached = [ name for name in used if name in ownBranches ]
+    zipBytes = sum(tree.GetBranch(name).GetZipBytes("*") for name in cached)
+    clusters = tree.GetClusterIterator(_currentTreeEntry(tree))
+    clusters.Next()
+    clusterEntries = max(1, clusters.GetNextEntry()-clusters.GetStartEntry())
+    cacheSize = max(int(1.2*zipBytes*clusterEntries/max(1, tree.GetEntries())), 1024**2)
+    tree.SetCacheSize(cacheSize)
+    for name in cached: tree.AddBranchToCache(name, True)
+    tree.StopCacheLearningPhase()
+    print "Disabled %d unused input branches, reading %d branches with a TTreeCache of %.1f MB" % (
+        len(tree._prunedBranches), len(used), cacheSize/1024.**2)
+
+def _enableBranch(tree, name):
+    if name not in tree._prunedBranches: return
+    print "Branch %s is read after disabling the unused input branches, enabling it again" % name
+    ownBranches = set(b.GetName() for b in tree.GetListOfBranches())
+    for n in _withCountBranch(tree, name):
+        tree._prunedBranches.discard(n)
+        tree.SetBranchStatus(n, 1)
+        if n in ownBranches: tree.AddBranchToCache(n, True)
+
 def _readAllBranches(tree):
+    restorePrunedBranches(tree)
     tree.GetEntry(_currentTreeEntry(tree))
 
 def _currentTreeEntry(tree):
@@ -118,6 +369,9 @@ def _currentTreeEntry(tree):
 def _gotoEntry(tree, entry, forceCall=False):
     tree._ttreereader._isClean = False
     if tree.entry != entry or forceCall:
+        if tree._learnEntries and tree.entry != entry:
+            tree._learnEntries -= 1
+            if tree._learnEntries == 0: _pruneBranches(tree)
         if (tree.entry == entry-1 and entry!=0):
             tree._ttreereader.Next()
         else:
@@ -0,0 +1,63 @@
+#!/usr/bin/env python
+import os, sys, time, shutil, tempfile
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+from PhysicsTools.NanoAODTools.postprocessing.framework.output import outputLayoutPresets
+
+def rewrite(inFileName, outFileName, treeName, layout, maxEntries):
+    """copy the tree with the cluster and basket sizes of layout, keeping the input compression"""
+    inFile = ROOT.TFile.Open(inFileName)
+    inTree = inFile.Get(treeName)
+    outFile = ROOT.TFile.Open(outFileName, "RECREATE", "", inFile.GetCompressionSettings())
+    outTree = inTree.CloneTree(0)
+    if layout["autoFlush"] is not None: outTree.SetAutoFlush(layout["autoFlush"])
+    if layout["basketSize"]: outTree.SetBasketSize("*", layout["basketSize"])
+    outTree.CopyEntries(inTree, maxEntries)
+    outFile.cd()
+    outTree.Write()
+    totBytes = outTree.GetTotBytes()
+    nclusters = 0
+    clusters = outTree.GetClusterIterator(0)
+    while clusters.Next() < outTree.GetEntries(): nclusters += 1
+    outFile.Close()
+    inFile.Close()
+    return totBytes, nclusters
+
+def readThroughput(fileName, treeName, ntimes):
+    """best time to read all branches with uproot"""
+    import uproot
+    best = None
+    for i in range(ntimes):
+        t0 = time.time()
+        uproot.open(fileName)[treeName].arrays()
+        best = min(best, time.time()-t0) if best != None else time.time()-t0
+    return best
+
+if __name__ == "__main__":
+    from optparse import OptionParser
+    parser = OptionParser(usage="%prog [options] inputFile")
+    parser.add_option("-t", "--tree", dest="treeName", type="string", default="Friends", help="Name of the tree (default: Friends)")
+    parser.add_option("-p", "--preset", dest="presets", type="string", default=[], action="append", help="Output layout preset to compare (default: all)")
+    parser.add_option("-N", "--max-entries", dest="maxEntries", type="long", default=-1, help="Number of entries to copy")
+    parser.add_option("-n", "--ntimes", dest="ntimes", type="int", default=3, help="Number of reads of each file, the fastest is kept")
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.print_help()
+        sys.exit(1)
+    try:
+        import uproot
+    except ImportError:
+        print "This benchmark needs uproot to read the files"
+        sys.exit(1)
+
+    presets = options.presets or sorted(outputLayoutPresets.keys())
+    tmpDir = tempfile.mkdtemp(prefix="benchmark_layout-")
+    try:
+        print "%-10s %10s %10s %10s %12s" % ("preset", "clusters", "file MB", "read s", "read MB/s")
+        for preset in presets:
+            outFileName = os.path.join(tmpDir, preset+".root")
+            totBytes, nclusters = rewrite(args[0], outFileName, options.treeName, outputLayoutPresets[preset], options.maxEntries)
+            seconds = readThroughput(outFileName, options.treeName, options.ntimes)
+            print "%-10s %10d %10.1f %10.2f %12.1f" % (preset, nclusters, os.path.getsize(outFileName)/1024.**2, seconds, totBytes/1024.**2/seconds)
+    finally:
+        shutil.rmtree(tmpDir, ignore_errors=True)
@@ -2,58 +2,102 @@ import json
 import ROOT
 import argparse
 import os
-import uproot
+import time
+import numpy
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 parser = argparse.ArgumentParser()
 
 parser.add_argument('--input')
 parser.add_argument('--output')
 parser.add_argument('--file')
+parser.add_argument('--expected', default=None, help='JSON with the expected number of preselected events of each input file')
+parser.add_argument('--nthreads', type=int, default=8)
+parser.add_argument('--timing', default=None, help='JSON file for the per-file results and timings (default: next to the resubmit list)')
+parser.add_argument('--tree', default='Friends')
 
 args = parser.parse_args()
 input_file = args.input
 output_path = args.output
 resubmit_file = args.file
 
+ROOT.gROOT.SetBatch(True)
+ROOT.EnableThreadSafety()
+ROOT.gInterpreter.Declare("""
+#include <memory>
+#include <sstream>
+#include "TFile.h"
+#include "TTree.h"
+#include "TBranch.h"
+#include "TLeaf.h"
+namespace nanoAODTools {
+    // open fileName, check that it was closed properly and that all baskets of treeName decompress;
+    // fills result with (status, entries, bad baskets) and returns the schema of the tree as name/type pairs
+    std::string checkOutputFile(const char * fileName, const char * treeName, ULong64_t resultAddress) {
+        Long64_t * result = reinterpret_cast<Long64_t *>(resultAddress);
+        result[0] = 0; result[1] = 0; result[2] = 0;
+        std::unique_ptr<TFile> f(TFile::Open(fileName));
+        if (!f || f->IsZombie()) { result[0] = 1; return ""; }
+        if (f->TestBit(TFile::kRecovered)) { result[0] = 2; return ""; }
+        TTree * tree = dynamic_cast<TTree *>(f->Get(treeName));
+        if (!tree) { result[0] = 3; return ""; }
+        result[1] = tree->GetEntries();
+        std::ostringstream schema;
+        TIter next(tree->GetListOfBranches());
+        while (TBranch * branch = static_cast<TBranch *>(next())) {
+            TLeaf * leaf = static_cast<TLeaf *>(branch->GetListOfLeaves()->At(0));
+            schema << branch->GetName() << "/" << (leaf ? leaf->GetTypeName() : "?") << ";";
+            for (Int_t i = 0; i < branch->GetWriteBasket(); ++i) {
+                if (!branch->GetBasket(i)) result[2] += 1;
+            }
+            branch->DropBaskets("all");
+        }
+        if (result[2]) result[0] = 4;
+        return schema.str();
+    }
+}
+""")
+
+def release_gil(method):
+    """let the calls of a C++ function run without the GIL, return False if this PyROOT can't"""
+    # __release_gil__ for cppyy, _threaded for the older PyROOT
+    for attribute in ('__release_gil__', '_threaded'):
+        try:
+            setattr(method, attribute, True)
+            return bool(getattr(method, attribute))
+        except (AttributeError, TypeError):
+            pass
+    return False
+
+# the whole check of a file runs in C++ without the GIL, so that files are checked in parallel threads;
+# otherwise the threads would run one at a time, processes are used instead
+use_threads = release_gil(ROOT.nanoAODTools.checkOutputFile)
+
+status_reasons = {1: "cannot be opened", 2: "not closed properly (recovered)", 3: "no {} tree".format(args.tree), 4: "unreadable baskets"}
 
 def check_root_file(f):
-    _f = ROOT.TFile.Open(f)
-    if not(_f):
-        return 1
-    try:
-        status = _f.IsZombie()
-    except:
-        ReferenceError
-        _f.Close()
-        return 1
-    else:
-        if _f.TestBit(ROOT.TFile.kRecovered):
-            _f.Close()
-            return 1
-        if status:
-            _f.Close()
-            return 1
-        tree = _f.Get("Friends")
-        if not tree:
-            _f.Close()
-            return 1
-        _f.Close()
-        return 0
+    """return (reason or None, entries, schema, seconds)"""
+    t0 = time.time()
+    result = numpy.zeros(3, dtype=numpy.int64)
+    schema = str(ROOT.nanoAODTools.checkOutputFile(f, args.tree, int(result.ctypes.data)))
+    reason = status_reasons.get(int(result[0]))
+    if reason == "unreadable baskets":
+        reason = "{} unreadable baskets".format(result[2])
+    return reason, int(result[1]), schema, time.time()-t0
+
+def check_task(task):
+    proc_name, root_file, root_file_output_path = task
+    reason, entries, schema, seconds = check_root_file(root_file_output_path)
+    return {"process": proc_name, "input": root_file, "output": root_file_output_path,
+            "reason": reason, "category": "file" if reason else None, "entries": entries, "schema": schema, "seconds": seconds}
 
-def check_uproot_file(f):
-    try: 
-        _f = uproot.open(f)
-    except ValueError:
-        print("Broken file: {}".format(f))
-        return 1
-    else:
-        if not _f:
-            return 1
-        tree = _f["Friends"]
-        if not tree:
-            return 1
-        return 0
+expected = {}
+if args.expected:
+    with open(args.expected) as f:
+        expected = json.load(f)
 
-bad_files = []
+tasks = []
 with open(input_file) as f:
     for l in f:
         l = l.rstrip()
@@ -64,9 +108,52 @@ with open(input_file) as f:
             for root_file in subf:
                 root_file_friend = root_file.rstrip().split("/")[-1].replace('.root', '_Friend.root')
                 root_file_output_path = os.path.join(output_path_proc, root_file_friend)
-                if check_root_file(root_file_output_path):
-                    bad_files.append(root_file.rstrip())
+                tasks.append((proc_name, root_file.rstrip(), root_file_output_path))
+
+t0 = time.time()
+if use_threads:
+    pool = ThreadPool(args.nthreads)
+else:
+    print("This PyROOT can't release the GIL in checkOutputFile, checking the files in {} processes instead of threads".format(args.nthreads))
+    pool = multiprocessing.Pool(args.nthreads)
+results = pool.map(check_task, tasks, chunksize=1)
+pool.close()
+pool.join()
+wall_time = time.time()-t0
+
+# all outputs of a process should have the branches of the most common schema
+schemas = collections.defaultdict(collections.Counter)
+for r in results:
+    if not r["reason"]: schemas[r["process"]][r["schema"]] += 1
+for r in results:
+    if r["reason"]: continue
+    if r["schema"] != schemas[r["process"]].most_common(1)[0][0]:
+        r["reason"] = "branches differ from the other outputs of {}".format(r["process"])
+        r["category"] = "schema"
+    elif r["input"] in expected and r["entries"] != expected[r["input"]]:
+        r["reason"] = "{} entries instead of {}".format(r["entries"], expected[r["input"]])
+        r["category"] = "entries"
+
+bad_files = [r["input"] for r in results if r["reason"]]
+for r in results:
+    if r["reason"]: print("Bad output {}: {}".format(r["output"], r["reason"]))
 
 with open('batch/resubmit/{}'.format(resubmit_file), 'w') as f:
     for bad_file in bad_files:
-        f.write(bad_file+"\n")
\ No newline at end of file
+        f.write(bad_file+"\n")
+
+seconds = numpy.array([r["seconds"] for r in results]) if results else numpy.zeros(1)
+summary = {
+    "files": len(results),
+    "bad": len(bad_files),
+    "categories": dict(collections.Counter(r["category"] for r in results if r["category"])),
+    "wallTime": wall_time,
+    "fileTime": {"total": seconds.sum(), "mean": seconds.mean(), "max": seconds.max()},
+    "slowest": [{"output": r["output"], "seconds": r["seconds"]} for r in sorted(results, key=lambda r: -r["seconds"])[:10]],
+}
+timing_file = args.timing if args.timing else 'batch/resubmit/{}.timing.json'.format(resubmit_file)
+with open(timing_file, 'w') as f:
+    for r in results: del r["schema"]
+    json.dump({"summary": summary, "results": results}, f, indent=2, sort_keys=True)
+print("Checked {} files in {:.1f} s ({:.1f} s of checks in {} {}), {} to resubmit".format(
+    len(results), wall_time, seconds.sum(), args.nthreads, "threads" if use_threads else "processes", len(bad_files)))
@@ -1,60 +1,127 @@
-import subprocess
-import re
-import time
 import os
-import ROOT
+import time
 import json
+import argparse
+import multiprocessing
+import ROOT
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--input', dest='file_path', default="files_200311/nanoAOD_files_200311/2016", help='directory with one text file of input files per process')
+parser.add_argument('--db', default='eventyields_db.json', help='database of the yields of each input file, only new or changed files are read again')
+parser.add_argument('-j', '--nworkers', type=int, default=multiprocessing.cpu_count())
+parser.add_argument('--retries', type=int, default=3)
+args = parser.parse_args()
+
+NBINS = 101
+
+def fileIdentity(fileName, rootFile=None):
+    """(path, size, modification time) of a local file, or of a remote one from its header"""
+    if "://" not in fileName:
+        st = os.stat(fileName)
+        return [fileName, st.st_size, int(st.st_mtime)]
+    if rootFile == None: return None
+    return [fileName, rootFile.GetSize(), rootFile.GetModificationDate().Convert()]
+
+def readYield(task):
+    """return (fileName, database entry, whether the file was read): its identity, sum of genWeight, pileup profile (with under- and overflow)
+       and number of entries of the profile"""
+    fileName, cached = task
+    # databases written before the number of entries was stored are read again
+    if cached and "entries" not in cached: cached = None
+    if cached and "://" not in fileName and fileIdentity(fileName) == cached["identity"]:
+        return fileName, cached, False
+    rootFile = None
+    for i in range(args.retries):
+        rootFile = ROOT.TFile.Open(fileName)
+        if rootFile: break
+        print "Cannot open file: ",fileName, "-> retry"
+        time.sleep(1)
+    if not rootFile:
+        return fileName, None, False
+    identity = fileIdentity(fileName, rootFile)
+    if cached and identity == cached["identity"]:
+        rootFile.Close()
+        return fileName, cached, False
+    tree = rootFile.Get("Events")
+    if not tree:
+        print "Cannot find tree in file: ",fileName
+        rootFile.Close()
+        return fileName, None, False
+    # TTree::Project fills the histogram of that name in the current directory, the input file
+    rootFile.cd()
+    h = ROOT.TH1F("pu","",NBINS,0,100)
+    tree.Project(h.GetName(),"Pileup_nTrueInt","genWeight")
+    h.SetDirectory(0)
+    entry = {
+        "identity": identity,
+        "sumw": h.Integral(),
+        "pileup": [ h.GetBinContent(i) for i in range(NBINS+2) ],
+        "entries": h.GetEntries(),
+    }
+    rootFile.Close()
+    return fileName, entry, True
+
+if __name__ == "__main__":
+    db = {}
+    if os.path.exists(args.db):
+        with open(args.db) as f:
+            db = json.load(f)
+
+    processFiles = {}
+    for txtFile in sorted(os.listdir(args.file_path)):
+        process = txtFile.split(".")[0]
+        if process.find("SingleMu")>=0:
+            print "skip ",process
+            continue
+        with open(os.path.join(args.file_path, txtFile)) as f:
+            processFiles[process] = [ l.replace("\n","").replace("\r","") for l in f if len(l.strip())>0 ]
+
+    tasks = [ (fileName, db.get(fileName)) for process in sorted(processFiles) for fileName in processFiles[process] ]
+    t0 = time.time()
+    pool = multiprocessing.Pool(max(1, min(args.nworkers, len(tasks))))
+    nread = 0
+    failed = []
+    for fileName, entry, wasRead in pool.imap_unordered(readYield, tasks):
+        if entry == None:
+            failed.append(fileName)
+        elif wasRead:
+            nread += 1
+            db[fileName] = entry
+    pool.close()
+    pool.join()
+    print "Read %d new or changed files out of %d in %.1f s" % (nread, len(tasks), time.time()-t0)
+    if failed:
+        print "Could not read %d files, their previous yields are used if any:\n  %s" % (len(failed), "\n  ".join(failed))
 
+    tmpName = args.db+".tmp"
+    with open(tmpName, 'w') as outfile:
+        json.dump(db, outfile)
+    os.rename(tmpName, args.db)
 
-file_path = "files_200311/nanoAOD_files_200311/2016"
-
-txtFiles = sorted(os.listdir(file_path))
-
-processDict = {}
-pileupHists = {}
-
-for txtFile in txtFiles:
-    process = txtFile.split(".")[0]
-    if process.find("SingleMu")>=0:
-        print "skip ",process
-        continue
-    processDict[process] = 0.
-    pileupHists[process] = ROOT.TH1F(process,"",101,0,100)
-    pileupHists[process].SetDirectory(0)
-    
-    f = open (os.path.join(file_path, txtFile))
-    print "reading ",txtFile, "...",
-    for l in f:
-        if len(l)>0:
-            fileName = l.replace("\n","").replace("\r","")
-            print "opening",fileName
-            rootFile=None
-            while (rootFile==None):
-                rootFile = ROOT.TFile.Open(fileName)
-                if not rootFile:
-                    print "Cannot found file: ",rootFile, "-> retry"
-                    continue
-                break
-            tree = rootFile.Get("Events")
-            if not rootFile or not tree:
-                print "Cannot found tree in file: ",rootFile
-                continue
-            h = ROOT.TH1F("pu","",101,0,100)
-            tree.Project(h.GetName(),"Pileup_nTrueInt","genWeight")
-            pileupHists[process].Add(h)
-            processDict[process] += h.Integral()
-            rootFile.Close()
-            break
-    print processDict[process]
-     
-with open('eventyields.json', 'w') as outfile:
-    json.dump(processDict, outfile,ensure_ascii=True,indent=2,sort_keys=True)    
-
-rootFile = ROOT.TFile("pileup.root","RECREATE")
-for process in pileupHists.keys():
-    pileupHists[process].SetDirectory(rootFile)
-    pileupHists[process].SetName(process)
-    pileupHists[process].Write()
-rootFile.Close()
+    # regenerate the outputs read by DataFlag and PileupWeight from the database
+    processDict = {}
+    pileupHists = {}
+    for process, fileNames in processFiles.iteritems():
+        processDict[process] = 0.
+        pileupHists[process] = ROOT.TH1F(process,"",NBINS,0,100)
+        pileupHists[process].SetDirectory(0)
+        entries = 0.
+        for fileName in fileNames:
+            if fileName not in db: continue
+            processDict[process] += db[fileName]["sumw"]
+            for i, c in enumerate(db[fileName]["pileup"]):
+                pileupHists[process].AddBinContent(i, c)
+            entries += db[fileName].get("entries", 0.)
+        # AddBinContent leaves the number of entries at 0, as if the histogram was empty
+        pileupHists[process].SetEntries(entries)
+        print process, processDict[process]
 
+    with open('eventyields.json', 'w') as outfile:
+        json.dump(processDict, outfile,ensure_ascii=True,indent=2,sort_keys=True)
 
+    rootFile = ROOT.TFile("pileup.root","RECREATE")
+    for process in pileupHists.keys():
+        pileupHists[process].SetDirectory(rootFile)
+        pileupHists[process].SetName(process)
+        pileupHists[process].Write()
+    rootFile.Close()
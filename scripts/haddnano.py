@@ -2,94 +2,140 @@
 import ROOT
 import numpy
 import sys
+import os
+import shutil
+import tempfile
+import multiprocessing
+from optparse import OptionParser
 
-if len(sys.argv) < 3 :
-	print "Syntax: haddnano.py out.root input1.root input2.root ..."
-ofname=sys.argv[1]
-files=sys.argv[2:]
+ROOT.gInterpreter.Declare("""
+#include "TBranch.h"
+namespace nanoAODTools {
+	// fill n entries of the branch from its current buffer, in C++ rather than one Python call per entry
+	void fillBranchEntries(TBranch * branch, Long64_t n) {
+		for (Long64_t i = 0; i < n; ++i) branch->Fill();
+	}
+}
+""")
 
 def zeroFill(tree,brName,brObj,allowNonBool=False) :
 	# typename: (numpy type code, root type code)
 	branch_type_dict = {'Bool_t':('?','O'), 'Float_t':('f4','F'), 'UInt_t':('u4','i'), 'Long64_t':('i8','L'), 'Double_t':('f8','D')}
 	brType = brObj.GetLeaf(brName).GetTypeName()
 	if (not allowNonBool) and (brType != "Bool_t") :
-		print "Did not expect to back fill non-boolean branches",tree,brName,brObj.GetLeaf(br).GetTypeName()
+		print "Did not expect to back fill non-boolean branches",tree,brName,brType
 	else :
 		if brType not in branch_type_dict: raise RuntimeError, 'Impossible to backfill branch of type %s'%brType
 		buff=numpy.zeros(1,dtype=numpy.dtype(branch_type_dict[brType][0]))
 		b=tree.Branch(brName,buff,brName+"/"+branch_type_dict[brType][1])
-	        b.SetBasketSize(tree.GetEntries()*2) #be sure we do not trigger flushing
-		for x in xrange(0,tree.GetEntries()):	
-			b.Fill()
+		b.SetBasketSize(tree.GetEntries()*2) #be sure we do not trigger flushing
+		ROOT.nanoAODTools.fillBranchEntries(b, tree.GetEntries())
 		b.ResetAddress()
-fileHandles=[]
-goFast=True
-for fn in files :
-    print "Adding file",fn
-    fileHandles.append(ROOT.TFile.Open(fn))
-    if fileHandles[-1].GetCompressionSettings() != fileHandles[0].GetCompressionSettings() :
-	goFast=False
-	print "Disabling fast merging as inputs have different compressions"
-of=ROOT.TFile(ofname,"recreate")
-if goFast :
-	of.SetCompressionSettings(fileHandles[0].GetCompressionSettings())
-of.cd()
 
-for e in fileHandles[0].GetListOfKeys() :
-	name=e.GetName()
-	print "Merging" ,name
-	obj=e.ReadObj()
-	cl=ROOT.TClass.GetClass(e.GetClassName())
-	inputs=ROOT.TList()
-	isTree= obj.IsA().InheritsFrom(ROOT.TTree.Class())
-	if isTree:
-		obj=obj.CloneTree(-1,"fast" if goFast else "")
-		branchNames=set([x.GetName() for x in obj.GetListOfBranches()])
-	for fh in fileHandles[1:] :
-		otherObj=fh.GetListOfKeys().FindObject(name).ReadObj()
-		inputs.Add(otherObj)
-		if isTree and obj.GetName()=='Events'  :	
-			otherObj.SetAutoFlush(0)
-			otherBranches=set([ x.GetName() for x in otherObj.GetListOfBranches() ])
-			missingBranches=list(branchNames-otherBranches)
-			additionalBranches=list(otherBranches-branchNames)
-			print "missing:",missingBranches,"\n Additional:",additionalBranches
-			for br in missingBranches :
-				#fill "Other"
-				zeroFill(otherObj,br,obj.GetListOfBranches().FindObject(br))
-			for br in additionalBranches :
-				#fill main
-				branchNames.add(br)
-				zeroFill(obj,br,otherObj.GetListOfBranches().FindObject(br))
-			#merge immediately for trees
-		if isTree and obj.GetName()=='Runs':
-			otherObj.SetAutoFlush(0)
-			otherBranches=set([ x.GetName() for x in otherObj.GetListOfBranches() ])
-			missingBranches=list(branchNames-otherBranches)
-			additionalBranches=list(otherBranches-branchNames)
-			print "missing:",missingBranches,"\n Additional:",additionalBranches
-			for br in missingBranches :
-				#fill "Other"
-				zeroFill(otherObj,br,obj.GetListOfBranches().FindObject(br),allowNonBool=True)
-			for br in additionalBranches :
-				#fill main
-				branchNames.add(br)
-				zeroFill(obj,br,otherObj.GetListOfBranches().FindObject(br),allowNonBool=True)
+def backFill(obj,otherObj,branchNames,allowNonBool) :
+	"""add the branches missing in otherObj or in obj, filled with zeros"""
+	otherObj.SetAutoFlush(0)
+	otherBranches=set([ x.GetName() for x in otherObj.GetListOfBranches() ])
+	missingBranches=list(branchNames-otherBranches)
+	additionalBranches=list(otherBranches-branchNames)
+	print "missing:",missingBranches,"\n Additional:",additionalBranches
+	for br in missingBranches :
+		#fill "Other"
+		zeroFill(otherObj,br,obj.GetListOfBranches().FindObject(br),allowNonBool=allowNonBool)
+	for br in additionalBranches :
+		#fill main
+		branchNames.add(br)
+		zeroFill(obj,br,otherObj.GetListOfBranches().FindObject(br),allowNonBool=allowNonBool)
+
+def mergeFiles(ofname,files) :
+	"""merge files into ofname, all of them being open at the same time"""
+	fileHandles=[]
+	goFast=True
+	for fn in files :
+		print "Adding file",fn
+		fileHandles.append(ROOT.TFile.Open(fn))
+		if fileHandles[-1].GetCompressionSettings() != fileHandles[0].GetCompressionSettings() :
+			goFast=False
+			print "Disabling fast merging as inputs have different compressions"
+	of=ROOT.TFile(ofname,"recreate")
+	if goFast :
+		of.SetCompressionSettings(fileHandles[0].GetCompressionSettings())
+	of.cd()
+
+	for e in fileHandles[0].GetListOfKeys() :
+		name=e.GetName()
+		print "Merging" ,name
+		obj=e.ReadObj()
+		cl=ROOT.TClass.GetClass(e.GetClassName())
+		inputs=ROOT.TList()
+		isTree= obj.IsA().InheritsFrom(ROOT.TTree.Class())
+		if isTree:
+			obj=obj.CloneTree(-1,"fast" if goFast else "")
+			branchNames=set([x.GetName() for x in obj.GetListOfBranches()])
+		for fh in fileHandles[1:] :
+			otherObj=fh.GetListOfKeys().FindObject(name).ReadObj()
+			inputs.Add(otherObj)
+			if isTree and obj.GetName() in ('Events','Runs') :
+				backFill(obj,otherObj,branchNames,allowNonBool=(obj.GetName()=='Runs'))
 			#merge immediately for trees
-                if isTree:
-	        	obj.Merge(inputs,"fast" if goFast else "")
-			inputs.Clear()
-	
-        if isTree  :
-		obj.Write()	
-	elif obj.IsA().InheritsFrom(ROOT.TH1.Class()) :		
-		obj.Merge(inputs)
-		obj.Write()
-	elif obj.IsA().InheritsFrom(ROOT.TObjString.Class()) :	
-		for st in inputs:
-		 	if  st.GetString()!=obj.GetString():
-				print "Strings are not matching"
-		obj.Write()
-	else:
-		print "Cannot handle ", obj.IsA().GetName()
-	
+			if isTree:
+				obj.Merge(inputs,"fast" if goFast else "")
+				inputs.Clear()
+
+		if isTree  :
+			obj.Write()
+		elif obj.IsA().InheritsFrom(ROOT.TH1.Class()) :
+			obj.Merge(inputs)
+			obj.Write()
+		elif obj.IsA().InheritsFrom(ROOT.TObjString.Class()) :
+			for st in inputs:
+				if  st.GetString()!=obj.GetString():
+					print "Strings are not matching"
+			obj.Write()
+		else:
+			print "Cannot handle ", obj.IsA().GetName()
+	of.Close()
+	for fh in fileHandles:
+		fh.Close()
+
+def _mergeGroup(args) :
+	mergeFiles(*args)
+	return args[0]
+
+def haddnano(ofname,files,maxOpenFiles=100,nworkers=1) :
+	"""merge files into ofname with at most maxOpenFiles open files per merge: groups of inputs are merged
+	   into temporary files, in nworkers parallel processes, until a single group is left"""
+	if len(files) <= maxOpenFiles :
+		return mergeFiles(ofname,files)
+	tmpDir=tempfile.mkdtemp(prefix="haddnano-",dir=os.path.dirname(os.path.abspath(ofname)))
+	try:
+		level=0
+		while len(files) > maxOpenFiles :
+			groups=[ (os.path.join(tmpDir,"level%d_%d.root" % (level,i)), files[i*maxOpenFiles:(i+1)*maxOpenFiles])
+				 for i in range((len(files)+maxOpenFiles-1)/maxOpenFiles) ]
+			print "Merging %d files in %d groups" % (len(files),len(groups))
+			if nworkers > 1 :
+				pool=multiprocessing.Pool(min(nworkers,len(groups)))
+				merged=pool.map(_mergeGroup,groups,chunksize=1)
+				pool.close()
+				pool.join()
+			else:
+				merged=map(_mergeGroup,groups)
+			# the intermediate files of the previous level are not needed anymore
+			for fn in files:
+				if fn.startswith(tmpDir): os.remove(fn)
+			files=merged
+			level+=1
+		mergeFiles(ofname,files)
+	finally:
+		shutil.rmtree(tmpDir,ignore_errors=True)
+
+if __name__ == "__main__":
+	parser = OptionParser(usage="%prog [options] out.root input1.root input2.root ...")
+	parser.add_option("-n", "--max-open-files", dest="maxOpenFiles", type="int", default=100, help="Maximum number of input files merged at once, more files are merged in groups through temporary files")
+	parser.add_option("-j", "--nworkers", dest="nworkers", type="int", default=1, help="Number of groups of files merged in parallel")
+	(options, args) = parser.parse_args()
+	if len(args) < 2 :
+		print "Syntax: haddnano.py out.root input1.root input2.root ..."
+		sys.exit(1)
+	haddnano(args[0],args[1:],maxOpenFiles=max(options.maxOpenFiles,2),nworkers=options.nworkers)
@@ -19,11 +19,30 @@ if __name__ == "__main__":
     parser.add_option("--noout",  dest="noOut", action="store_true",  default=False, help="Do not produce output, just run modules")
     parser.add_option("-P", "--prefetch",  dest="prefetch", action="store_true",  default=False, help="Prefetch input files locally instead of accessing them via xrootd")
     parser.add_option("--long-term-cache",  dest="longTermCache", action="store_true",  default=False, help="Keep prefetched files across runs instead of deleting them at the end")
+    parser.add_option("--prefetch-dir",  dest="prefetchDir", type="string",  default=None, help="Directory of the long-term cache of prefetched files (default: /tmp/$USER/nanoAODTools-cache)")
     parser.add_option("-N", "--max-entries", dest="maxEntries", type="long",  default=None, help="Maximum number of entries to process from any single given input tree")
     parser.add_option("--first-entry", dest="firstEntry", type="long",  default=0, help="First entry to process in the three (to be used together with --max-entries)")
+    parser.add_option("--batch-size", dest="batchSize", type="int",  default=None, help="Read entries in chunks of this size as columns and call analyzeBatch on the modules")
+    parser.add_option("-j", "--nworkers", dest="nworkers", type="int",  default=1, help="Number of worker processes; input files are split into cluster-aligned entry ranges processed in parallel")
+    parser.add_option("--cache-size", dest="treeCacheSize", type="float",  default=50, help="Size of the TTreeCache of the input tree in MB (0 to disable it)")
+    parser.add_option("--cache-learn-entries", dest="treeCacheLearnEntries", type="int",  default=100, help="Number of entries used by the TTreeCache to learn which branches are read")
+    parser.add_option("--async-prefetch", dest="asyncPrefetch", action="store_true",  default=False, help="Prefetch the baskets of the input tree in a background thread")
+    parser.add_option("--output-buffer", dest="outputBufferSize", type="int",  default=None, help="Fill the friend tree N entries at a time from column buffers (friend trees only)")
+    parser.add_option("--output-format", dest="outputFormat", type="choice", choices=["root","parquet"], default="root", help="Write friend trees as ROOT files (default) or Parquet files (needs pyarrow)")
+    parser.add_option("--output-layout", dest="outputLayout", type="choice", choices=["default","columnar"], default="default", help="Cluster and basket sizes of the output tree: default (ROOT's) or columnar (large clusters and baskets, for reading whole branches)")
+    parser.add_option("--auto-flush", dest="autoFlush", type="long",  default=None, help="AutoFlush of the output tree: cluster size in entries if > 0, in uncompressed bytes if < 0, 0 to disable auto-flushing")
+    parser.add_option("--basket-size", dest="basketSizes", type="string", default=[], action="append", help="Basket size in bytes of the output branches, or (pattern)=(bytes) for the matching ones (can be repeated)")
+    parser.add_option("--prune-branches", dest="pruneBranches", type="int",  default=None, help="Disable the input branches not read in the first N events of each file (friend trees or --noout only)")
+    parser.add_option("--preselection", dest="preselection", type="choice", choices=["draw","mt"], default="draw", help="Evaluate the cut with TTree::Draw (default) or with ROOT::TTreeProcessorMT in several threads")
+    parser.add_option("--preselection-threads", dest="preselectionThreads", type="int",  default=0, help="Number of threads of the multi-threaded pre-selection (default: all cores, shared by the workers with -j)")
+    parser.add_option("--preselection-cache", dest="preselectionCache", type="string",  default=None, help="Directory where the entry lists of the pre-selection are kept, to be reused when the same files are processed with the same cut and JSON")
+    parser.add_option("--preselection-cache-size", dest="preselectionCacheSize", type="float",  default=1024, help="Maximum size of the pre-selection cache in MB, the least recently used entry lists are removed beyond")
+    parser.add_option("--checkpoint", dest="checkpointInterval", type="int",  default=None, help="Save the output and the state of the modules every N events, to be able to resume the job (friend trees or --noout only)")
+    parser.add_option("--resume", dest="resume", action="store_true",  default=False, help="Continue from the checkpoints of a previous run in the same output directory")
+    parser.add_option("--profile", dest="profile", type="string",  default=None, help="Write the time spent in each module, the branches it reads and the readers it creates to this JSON file")
     parser.add_option("--justcount",   dest="justcount", default=False, action="store_true",  help="Just report the number of selected events") 
     parser.add_option("-I", "--import", dest="imports",  type="string", default=[], action="append", nargs=2, help="Import modules (python package, comma-separated list of ");
-    parser.add_option("-z", "--compression",  dest="compression", type="string", default=("LZMA:9"), help="Compression: none, or (algo):(level) ")
+    parser.add_option("-z", "--compression",  dest="compression", type="string", default=("LZMA:9"), help="Compression: none, (algo):(level) with algo LZMA, ZLIB, LZ4 or ZSTD, or auto[:speed=(MB/s)|:ratio=(x)] to benchmark them on the first input file")
 
     (options, args) = parser.parse_args()
 
@@ -67,8 +86,27 @@ if __name__ == "__main__":
             justcount = options.justcount,
             prefetch = options.prefetch,
             longTermCache = options.longTermCache,
+            prefetchDir = options.prefetchDir,
             maxEntries = options.maxEntries,
             firstEntry = options.firstEntry,
+            batchSize = options.batchSize,
+            nworkers = options.nworkers,
+            profile = options.profile,
+            pruneBranches = options.pruneBranches,
+            treeCacheSize = int(options.treeCacheSize*1024**2),
+            treeCacheLearnEntries = options.treeCacheLearnEntries,
+            asyncPrefetch = options.asyncPrefetch,
+            outputBufferSize = options.outputBufferSize,
+            outputLayout = options.outputLayout,
+            outputFormat = options.outputFormat,
+            checkpointInterval = options.checkpointInterval,
+            resume = options.resume,
+            preselection = options.preselection,
+            preselectionThreads = options.preselectionThreads,
+            preselectionCache = options.preselectionCache,
+            preselectionCacheSize = int(options.preselectionCacheSize*1024**2),
+            autoFlush = options.autoFlush,
+            basketSize = [ (b.split("=")[0], int(b.split("=")[1])) if "=" in b else ("*", int(b)) for b in options.basketSizes ] or None,
             outputbranchsel = options.branchsel_out)
     p.run()
 
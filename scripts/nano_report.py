@@ -2,52 +2,78 @@
 # imported from https://github.com/CERN-PH-CMG/cmg-cmssw/blob/0c11a5a0a15c4c3e1a648c9707b06b08b747b0c0/PhysicsTools/Heppy/scripts/heppy_report.py
 from optparse import OptionParser
 import json
+import numpy
+import multiprocessing
 import ROOT
 ROOT.PyConfig.IgnoreCommandLineOptions = True
 
-def root2map(tree):
-    tree.SetBranchStatus("*",0)
-    tree.SetBranchStatus("run",1)
-    tree.SetBranchStatus("luminosityBlock",1)
-    jsonind = {}
-    for e in xrange(tree.GetEntries()):
-        tree.GetEntry(e)
-        run,lumi = tree.run, tree.luminosityBlock
-        if run not in jsonind:
-            jsonind[run] = [lumi]
-        else:
-            jsonind[run].append(lumi)
-    # remove duplicates
-    for run in jsonind:
-        jsonind[run] =  list(set(jsonind[run]))
+def readRunLumis(tree, chunkSize=1000000):
+    """return the distinct (run << 32 | luminosityBlock) of tree as a sorted NumPy array, reading both columns in chunks"""
+    keys = [ numpy.zeros(0, dtype=numpy.int64) ]
+    estimate = tree.GetEstimate()
+    tree.SetEstimate(chunkSize+1)
+    try:
+        for first in xrange(0, tree.GetEntries(), chunkSize):
+            tree.Draw("run:luminosityBlock", "", "goff", chunkSize, first)
+            rows = tree.GetSelectedRows()
+            if rows <= 0: continue
+            columns = []
+            for buff in (tree.GetV1(), tree.GetV2()):
+                buff.SetSize(rows)
+                columns.append(numpy.frombuffer(buff, dtype=numpy.float64, count=rows).astype(numpy.int64))
+            keys.append(numpy.unique((columns[0] << 32) | columns[1]))
+    finally:
+        tree.SetEstimate(estimate)
+    return numpy.unique(numpy.concatenate(keys))
+
+def fileRunLumis(args):
+    fileName, treeName = args
+    tfile = ROOT.TFile.Open(fileName)
+    if not tfile or tfile.IsZombie(): raise RuntimeError("Could not open %s" % fileName)
+    tree = tfile.Get(treeName)
+    keys = readRunLumis(tree) if tree else numpy.zeros(0, dtype=numpy.int64)
+    tfile.Close()
+    return keys
 
-    nruns = len(jsonind)
-    nlumis = sum(len(v) for v in jsonind.itervalues())
+def keys2map(keys):
+    """compress sorted, distinct (run << 32 | lumi) keys into the ranges of consecutive lumis of each run"""
+    keys = numpy.unique(keys)
+    runs, lumis = keys >> 32, keys & 0xFFFFFFFF
+    # a range starts where the run changes or a lumi is skipped
+    starts = numpy.flatnonzero(numpy.concatenate([[len(keys) > 0], (numpy.diff(runs) != 0) | (numpy.diff(lumis) != 1)]))
+    ends = numpy.append(starts[1:], len(keys)) - 1
     jsonmap = {}
-    for r,lumis in jsonind.iteritems():
-        if len(lumis) == 0: continue # shouldn't happen
-        lumis.sort()
-        ranges = [ [ lumis[0], lumis[0] ] ]
-        for lumi in lumis[1:]:
-            if lumi == ranges[-1][1] + 1:
-                ranges[-1][1] = lumi
-            else:
-                ranges.append([lumi,lumi])
-        jsonmap[r] = ranges
-    return (jsonmap, nruns, nlumis)
+    for i, j in zip(starts, ends):
+        jsonmap.setdefault(int(runs[i]), []).append([ int(lumis[i]), int(lumis[j]) ])
+    return (jsonmap, len(jsonmap), len(keys))
+
+def root2map(tree):
+    return keys2map(readRunLumis(tree))
 
 if __name__ == '__main__':
     parser = OptionParser(usage='%prog [options] nanoAOD-files',
                           description='Check the output of the LuminosityBlocks and produce a json file of the processed runs and lumisections')
     parser.add_option("-t", "--tree", dest="treeName", default="LuminosityBlocks", help="Name of the TTree with the luminosity blocks")
     parser.add_option("-o", "--out", dest="outputFile", default="lumiSummary.json", help="Name of the output file")
+    parser.add_option("-j", "--nworkers", dest="nworkers", type="int", default=multiprocessing.cpu_count(), help="Number of files read in parallel (default: number of cores)")
     (options,args) = parser.parse_args()
     if len(args)==0:
         print 'provide at least one input file in argument. Use -h to display help'
         exit()
+    # TChain.Add expands wildcards in the file names
     chain = ROOT.TChain(options.treeName)
     for a in args: chain.Add(a)
-    summary = root2map(chain)
+    tasks = [ (f.GetTitle(), options.treeName) for f in chain.GetListOfFiles() ]
+    if not tasks:
+        print 'no input file found'
+        exit()
+    if options.nworkers > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(options.nworkers, len(tasks)))
+        keys = pool.map(fileRunLumis, tasks, chunksize=max(1, len(tasks)/(4*options.nworkers)))
+        pool.close()
+    else:
+        keys = map(fileRunLumis, tasks)
+    summary = keys2map(numpy.concatenate(keys))
     if summary:
         jmap, runs, lumis = summary
         json.dump(jmap,open(options.outputFile,'w'))
@@ -11,6 +11,15 @@ function run_test()
     mkdir -p PhysicsTools/NanoAODTools
     rsync -r --stats /scripts/ PhysicsTools/NanoAODTools/. || return 1
     scram b || return 1
+    echo "--- Unit tests ---"
+    python PhysicsTools/NanoAODTools/test/testJSONFilter.py || return 1
+    python PhysicsTools/NanoAODTools/test/testFileCache.py || return 1
+    python PhysicsTools/NanoAODTools/test/testDeferredEvents.py || return 1
+    python PhysicsTools/NanoAODTools/test/testReadColumn.py || return 1
+    python PhysicsTools/NanoAODTools/test/testOutput.py || return 1
+    python PhysicsTools/NanoAODTools/test/testPostProcessor.py || return 1
+    python PhysicsTools/NanoAODTools/test/testNanoReport.py || return 1
+    python PhysicsTools/NanoAODTools/test/testCheckpoint.py || return 1
     echo "--- Test HNL script ---"
     # add data test
     python PhysicsTools/NanoAODTools/processors/HNL.py --year 2016 --testMode --input=https://github.com/LLPDNNX/test-files/raw/master/nanoaod/Moriond17_aug2018_miniAODv3_HNL_nanoAODv3.root . || return 1
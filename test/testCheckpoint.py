@@ -0,0 +1,150 @@
+import os
+import shutil
+import tempfile
+import unittest
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module, eventLoop
+from PhysicsTools.NanoAODTools.postprocessing.framework.checkpoint import Checkpoint
+
+class InputTree:
+    """the parts of an input tree used by the event loop, with one branch x"""
+    def __init__(self, values):
+        self.values = values
+        self.entries = len(values)
+        self.entry = -1
+        self._extrabranches = {}
+        self._undeclaredReads = {}
+        self._ttreereaderversion = 1
+    def gotoEntry(self, i):
+        self.entry = i
+    def readBranch(self, name):
+        if name != "x": raise AttributeError(name)
+        return self.values[self.entry]
+
+class OutputTree:
+    """keeps the filled entries in a list; only the entries filled before the last checkpoint survive a crash"""
+    def __init__(self):
+        self.rows = []
+        self.values = {}
+        self.saved = 0
+    def branch(self, name, rootBranchType, **kwargs):
+        self.values[name] = 0
+    def fillBranch(self, name, val):
+        self.values[name] = val
+    def fill(self):
+        self.rows.append(dict(self.values))
+    def tree(self):
+        return self
+    def GetEntries(self):
+        return len(self.rows)
+    def checkpoint(self):
+        self.saved = len(self.rows)
+    def crash(self):
+        del self.rows[self.saved:]
+        self.values = dict((name, -1) for name in self.values)
+    def getState(self):
+        return dict(self.values)
+    def setState(self, state):
+        self.values = dict(state)
+
+class Killed(Exception):
+    pass
+
+class Sum(Module):
+    """accumulates the values of x, fills the running sum and rejects multiples of 3"""
+    def __init__(self, killAt=None):
+        Module.__init__(self)
+        self.killAt = killAt
+        self.n = 0
+        self.sum = 0
+    def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        self.out = wrappedOutputTree
+        self.out.branch("sum", "I")
+    def analyze(self, event):
+        if event.x == self.killAt: raise Killed()
+        self.n += 1
+        self.sum += event.x
+        self.out.fillBranch("sum", self.sum)
+        return event.x % 3 != 0
+    def getState(self):
+        return { "n": self.n, "sum": self.sum }
+    def setState(self, state):
+        self.n, self.sum = state["n"], state["sum"]
+
+class CheckpointTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.fileName = os.path.join(self.tmpDir, "out.checkpoint")
+        self.task = ("in.root", 0, None)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def testSaveRestore(self):
+        module, out = Sum(), OutputTree()
+        module.n, module.sum = 4, 10
+        out.branch("sum", "I")
+        out.fillBranch("sum", 10)
+        for i in range(3): out.fill()
+        Checkpoint(self.fileName, self.task, [module], out, 4).save(4, 4, 3)
+        module, out = Sum(), OutputTree()
+        out.rows = [{}]*3
+        checkpoint = Checkpoint(self.fileName, self.task, [module], out, 4)
+        state = checkpoint.load()
+        self.assertFalse(state["finished"])
+        self.assertEqual((checkpoint.startIndex, checkpoint.done, checkpoint.accepted), (4, 4, 3))
+        checkpoint.restore()
+        self.assertEqual((module.n, module.sum), (4, 10))
+        self.assertEqual(out.values, {"sum": 10})
+
+    def testMismatch(self):
+        Checkpoint(self.fileName, self.task, [Sum()], OutputTree(), 4).save(4, 4, 3)
+        self.assertRaises(RuntimeError, Checkpoint(self.fileName, ("other.root", 0, None), [Sum()], None, 4).load)
+        # the output has more entries than at the checkpoint
+        out = OutputTree()
+        out.rows = [{}]
+        checkpoint = Checkpoint(self.fileName, self.task, [Sum()], out, 4)
+        checkpoint.load()
+        self.assertRaises(RuntimeError, checkpoint.restore)
+
+    def testNoCheckpoint(self):
+        checkpoint = Checkpoint(self.fileName, self.task, [Sum()], OutputTree(), 4)
+        self.assertEqual(checkpoint.load(), None)
+        self.assertEqual(checkpoint.startIndex, 0)
+        checkpoint.restore()
+
+    def testFinish(self):
+        module = Sum()
+        module.n, module.sum = 20, 190
+        Checkpoint(self.fileName, self.task, [module], None, 4).finish(20, 13, 20)
+        module = Sum()
+        checkpoint = Checkpoint(self.fileName, self.task, [module], None, 4)
+        state = checkpoint.load()
+        self.assertTrue(state["finished"])
+        self.assertEqual((state["done"], state["accepted"], state["entries"]), (20, 13, 20))
+        checkpoint.restoreModules()
+        self.assertEqual((module.n, module.sum), (20, 190))
+
+    def testResumeEventLoop(self):
+        values = range(1, 24)
+        module, out = Sum(), OutputTree()
+        done, accepted, _ = eventLoop([module], None, None, InputTree(values), out, progress=None)
+        expected = (out.rows, module.getState(), done, accepted)
+
+        # killed in the middle of the loop, after the checkpoints of 5 and 10 entries
+        module, out = Sum(killAt=13), OutputTree()
+        checkpoint = Checkpoint(self.fileName, self.task, [module], out, 5)
+        self.assertRaises(Killed, eventLoop, [module], None, None, InputTree(values), out, progress=None, checkpoint=checkpoint)
+        out.crash()
+        self.assertEqual(len(out.rows), 7)
+
+        module = Sum()
+        checkpoint = Checkpoint(self.fileName, self.task, [module], out, 5)
+        checkpoint.load()
+        self.assertEqual(checkpoint.startIndex, 10)
+        done, accepted, _ = eventLoop([module], None, None, InputTree(values), out, progress=None, checkpoint=checkpoint)
+        self.assertEqual((out.rows, module.getState(), checkpoint.done+done, checkpoint.accepted+accepted), expected)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,126 @@
+import unittest
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+from PhysicsTools.NanoAODTools.postprocessing.framework.eventloop import Module, eventLoop, DEFERRED
+from PhysicsTools.NanoAODTools.postprocessing.framework.output import OutputTree
+
+class InputTree:
+    """the parts of an input tree used by the event loop, with one branch x"""
+    def __init__(self, values):
+        self.values = values
+        self.entries = len(values)
+        self.entry = -1
+        self._extrabranches = {}
+        self._undeclaredReads = {}
+        self._ttreereaderversion = 1
+    def gotoEntry(self, i):
+        self.entry = i
+    def readBranch(self, name):
+        if name in self._extrabranches: return self._extrabranches[name]
+        if name != "x": raise AttributeError(name)
+        return self.values[self.entry]
+
+class Step(Module):
+    """fills name_x and name_prev (the previous entry seen), rejects the entries in reject"""
+    def __init__(self, name, calls, reject=()):
+        Module.__init__(self)
+        self.name = name
+        self.calls = calls
+        self.reject = reject
+        self.prev = -1
+    def beginFile(self, inputFile, outputFile, inputTree, wrappedOutputTree):
+        self.out = wrappedOutputTree
+        self.out.branch(self.name+"_x", "I")
+        self.out.branch(self.name+"_prev", "I")
+        self.out.branch(self.name+"_v", "F", lenVar="n"+self.name+"_v")
+    def analyze(self, event):
+        self.calls.append((self.name, event.x))
+        return self.finish(event)
+    def finish(self, event):
+        # reads what the modules before it computed for this event
+        upstream = sum(getattr(event, attr) for attr in sorted(event.__dict__) if attr.startswith("result_"))
+        self.out.fillBranch(self.name+"_x", event.x + upstream)
+        self.out.fillBranch(self.name+"_prev", self.prev)
+        self.out.fillBranch(self.name+"_v", [ event.x*0.5 ]*(event.x % 4))
+        self.prev = event.x
+        setattr(event, "result_"+self.name, 1000*event.x)
+        return event.x not in self.reject
+
+class DeferringStep(Step):
+    """defers the entries in defer when deferEvents is set, finishing them in resume"""
+    def __init__(self, name, calls, deferEvents, defer, reject=()):
+        Step.__init__(self, name, calls, reject)
+        self.deferEvents = deferEvents
+        self.defer = defer
+        self.pending = []
+        self.runs = []
+    def analyze(self, event):
+        self.calls.append((self.name, event.x))
+        if self.deferEvents and event.x in self.defer:
+            self.pending.append(event.x)
+            return DEFERRED
+        return self.finish(event)
+    def runDeferred(self):
+        self.runs.append(self.pending)
+        self.pending = []
+    def resume(self, event):
+        return self.finish(event)
+
+def makeModules(calls, deferEvents):
+    return [
+        Step("first", calls, reject=(3, 17)),
+        DeferringStep("tagger", calls, deferEvents, defer=set(range(0, 40, 2)) | set([5]), reject=(10, 11)),
+        Step("middle", calls, reject=(21,)),
+        DeferringStep("other", calls, deferEvents and 2, defer=set(range(0, 40, 3))),
+        Step("last", calls, reject=(29,)),
+    ]
+
+def readTree(tree, names):
+    rows = []
+    for j in range(tree.GetEntries()):
+        tree.GetEntry(j)
+        row = []
+        for name in names:
+            if name.endswith("_v"):
+                row.append(list(getattr(tree, name))[:getattr(tree, "n"+name)])
+            else:
+                row.append(getattr(tree, name))
+        rows.append(row)
+    return rows
+
+class DeferredEventsTest(unittest.TestCase):
+    def runLoop(self, deferEvents, filterOutput=True, values=range(40)):
+        calls = []
+        modules = makeModules(calls, deferEvents)
+        inputTree = InputTree(values)
+        tree = ROOT.TTree("Friends", "Friends")
+        tree.SetDirectory(0)
+        out = OutputTree(None, tree, inputTree)
+        done, accepted, _ = eventLoop(modules, None, None, inputTree, out, progress=None, filterOutput=filterOutput)
+        # the order in which a deferring module finishes the events is its own
+        names = [ m.name+suffix for m in modules for suffix in ("_x", "_prev", "_v") if not (suffix == "_prev" and hasattr(m, "deferEvents")) ]
+        # the events seen by each module, in order
+        seen = dict((m.name, [ x for name, x in calls if name == m.name ]) for m in modules)
+        return modules, seen, (done, accepted), readTree(tree, names)
+    def checkSameAsSerial(self, filterOutput):
+        modules, seen, counts, rows = self.runLoop(deferEvents=3, filterOutput=filterOutput)
+        serialModules, serialSeen, serialCounts, serialRows = self.runLoop(deferEvents=None, filterOutput=filterOutput)
+        self.assertTrue(len(modules[1].runs) > 1)
+        self.assertTrue(modules[3].runs)
+        self.assertEqual(seen, serialSeen)
+        self.assertEqual(counts, serialCounts)
+        self.assertEqual(rows, serialRows)
+    def testSameAsSerial(self):
+        self.checkSameAsSerial(filterOutput=True)
+    def testSameAsSerialWithoutFilter(self):
+        self.checkSameAsSerial(filterOutput=False)
+    def testDeferredOnlyAtTheEnd(self):
+        # the last events wait until the end of the file
+        modules, seen, counts, rows = self.runLoop(deferEvents=100)
+        serialModules, serialSeen, serialCounts, serialRows = self.runLoop(deferEvents=None)
+        self.assertEqual(len(modules[1].runs), 1)
+        self.assertEqual(seen, serialSeen)
+        self.assertEqual(rows, serialRows)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,128 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+import numpy
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+from PhysicsTools.NanoAODTools.postprocessing.framework.filecache import LRUCache, EntryListCache
+
+def writeTree(fileName, treeName, nEntries):
+    tfile = ROOT.TFile.Open(fileName, "RECREATE")
+    tree = ROOT.TTree(treeName, treeName)
+    x = numpy.zeros(1, dtype=numpy.float32)
+    tree.Branch("x", x, "x/F")
+    for i in range(nEntries):
+        x[0] = i
+        tree.Fill()
+    tree.Write()
+    tfile.Close()
+
+class LRUCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.cache = LRUCache(os.path.join(self.tmpDir, "cache"), 250)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def store(self, key, size=100, cache=None):
+        cache = cache or self.cache
+        fileName = cache.tempName()
+        with open(fileName, "w") as f:
+            f.write("x"*size)
+        # the objects are ordered by their time of use
+        time.sleep(0.01)
+        return cache.store(key, fileName)
+
+    def testStoreLookup(self):
+        self.assertEqual(self.cache.lookup("a"), None)
+        path = self.store("a")
+        self.assertEqual(path, self.cache.path("a"))
+        self.assertEqual(self.cache.lookup("a"), path)
+        with open(path) as f:
+            self.assertEqual(f.read(), "x"*100)
+        # storing the same key again keeps the existing object and removes the new file
+        fileName = self.cache.tempName()
+        self.cache.store("a", fileName)
+        self.assertFalse(os.path.exists(fileName))
+
+    def testEvictLeastRecentlyUsed(self):
+        self.store("a")
+        self.store("b")
+        time.sleep(0.01)
+        self.cache.lookup("a")
+        self.store("c")
+        self.assertEqual(self.cache.lookup("b"), None)
+        self.assertFalse(os.path.exists(self.cache.path("b")))
+        self.assertTrue(self.cache.lookup("a"))
+        self.assertTrue(self.cache.lookup("c"))
+
+    def testKeepNewAndPinned(self):
+        self.store("a")
+        self.cache.pin("a")
+        # above the size limit on its own, but just stored
+        self.store("big", size=300)
+        self.assertTrue(self.cache.lookup("a"))
+        self.assertTrue(self.cache.lookup("big"))
+        self.cache.unpin("a")
+        self.store("b")
+        self.assertEqual(self.cache.lookup("a"), None)
+        self.assertEqual(self.cache.lookup("big"), None)
+        self.assertTrue(self.cache.lookup("b"))
+
+    def testSharedDirectory(self):
+        other = LRUCache(self.cache.cacheDir, 250)
+        self.store("a", cache=other)
+        self.assertEqual(self.cache.lookup("a"), other.path("a"))
+        # objects removed behind the back of the index are forgotten
+        os.remove(other.path("a"))
+        self.assertEqual(self.cache.lookup("a"), None)
+        self.assertEqual(other.lookup("a"), None)
+
+class EntryListCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.cache = EntryListCache(os.path.join(self.tmpDir, "cache"))
+        self.files = []
+        for name, treeName in [("events.root", "Events"), ("friend1.root", "Friends"), ("friend2.root", "Friends")]:
+            writeTree(os.path.join(self.tmpDir, name), treeName, 10)
+
+    def tearDown(self):
+        for tfile in self.files: tfile.Close()
+        shutil.rmtree(self.tmpDir)
+
+    def openTree(self, friend=None):
+        tfile = ROOT.TFile.Open(os.path.join(self.tmpDir, "events.root"))
+        self.files.append(tfile)
+        tree = tfile.Get("Events")
+        if friend: tree.AddFriend("Friends", os.path.join(self.tmpDir, friend))
+        return tree
+
+    def testKey(self):
+        tree = self.openTree()
+        key = self.cache.key(tree, "x > 3", None, 0, None)
+        self.assertEqual(key, self.cache.key(self.openTree(), "x > 3", None, 0, None))
+        self.assertNotEqual(key, self.cache.key(tree, "x > 4", None, 0, None))
+        self.assertNotEqual(key, self.cache.key(tree, "x > 3", "json", 0, None))
+        self.assertNotEqual(key, self.cache.key(tree, "x > 3", None, 2, None))
+        self.assertNotEqual(key, self.cache.key(tree, "x > 3", None, 0, 5))
+        self.assertNotEqual(key, self.cache.key(tree, "x > 3", None, 0, None, backend="mt"))
+
+    def testFriendKey(self):
+        key = self.cache.key(self.openTree(), "Friends.x > 3", None, 0, None)
+        key1 = self.cache.key(self.openTree("friend1.root"), "Friends.x > 3", None, 0, None)
+        key2 = self.cache.key(self.openTree("friend2.root"), "Friends.x > 3", None, 0, None)
+        self.assertNotEqual(key, key1)
+        self.assertNotEqual(key1, key2)
+        self.assertEqual(key1, self.cache.key(self.openTree("friend1.root"), "Friends.x > 3", None, 0, None))
+
+    def testSaveLoad(self):
+        key = self.cache.key(self.openTree(), "x > 3", None, 0, None)
+        self.assertEqual(self.cache.load(key), None)
+        self.cache.save(key, numpy.arange(4, 10, dtype=numpy.int64))
+        self.assertEqual(list(self.cache.load(key)), range(4, 10))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+import numpy
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+from PhysicsTools.NanoAODTools.postprocessing.framework.preskimming import JSONFilter
+
+JSON = {"1": [[3, 10], [20, 40]], "2": [[1, 100]], "3": [[5, 9], [11, 11], [100, 120]]}
+
+def makeTree(runs, lumis, clusterSize):
+    """in-memory tree with run and luminosityBlock branches, flushed every clusterSize entries"""
+    tree = ROOT.TTree("Events", "Events")
+    tree.SetDirectory(0)
+    run = numpy.zeros(1, dtype=numpy.uint32)
+    lumi = numpy.zeros(1, dtype=numpy.uint32)
+    tree.Branch("run", run, "run/i")
+    tree.Branch("luminosityBlock", lumi, "luminosityBlock/i")
+    tree.SetAutoFlush(clusterSize)
+    for r, l in zip(runs, lumis):
+        run[0] = r
+        lumi[0] = l
+        tree.Fill()
+    return tree
+
+def entries(elist):
+    return [ elist.GetEntry(i) for i in range(elist.GetN()) ]
+
+class JSONFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.jsonFilter = JSONFilter(runsAndLumis=JSON)
+
+    def inJSON(self, run, lumi):
+        return any(l1 <= lumi <= l2 for l1, l2 in JSON.get(str(run), []))
+
+    def testFilterRunLumis(self):
+        runs = numpy.repeat([0, 1, 2, 3, 4], 130)
+        lumis = numpy.tile(numpy.arange(130), 5)
+        mask = self.jsonFilter.filterRunLumis(runs, lumis)
+        self.assertEqual(list(mask), [ self.inJSON(r, l) for r, l in zip(runs, lumis) ])
+        self.assertTrue(self.jsonFilter.filterRunLumi(3, 11))
+        self.assertFalse(self.jsonFilter.filterRunLumi(3, 10))
+        self.assertEqual(list(self.jsonFilter.filterRuns([0, 1, 2, 4])), [False, True, True, False])
+
+    def testEmptyJSON(self):
+        self.assertFalse(JSONFilter(runsAndLumis={}).filterRunLumis([1, 2], [3, 4]).any())
+
+    def testFilterClustersUnordered(self):
+        # merged inputs: lumis interleave, so the endpoints of a cluster don't bound its lumis
+        rng = numpy.random.RandomState(3)
+        runs = rng.randint(1, 4, size=2000)
+        lumis = rng.randint(1, 130, size=2000)
+        runs[:100], lumis[:100] = 2, 50
+        runs[50] = 9
+        tree = makeTree(runs, lumis, 100)
+        expected = [ i for i in range(len(runs)) if self.inJSON(runs[i], lumis[i]) ]
+        self.assertEqual(entries(self.jsonFilter.filterClusters(tree)), expected)
+        self.assertEqual(entries(self.jsonFilter.filterClusters(tree, 123, 1777)), [ i for i in expected if 123 <= i < 1777 ])
+        self.assertEqual(entries(self.jsonFilter.filterClusters(tree, 0, 2000, chunkSize=333)), expected)
+
+    def testFilterClustersOrdered(self):
+        runs = numpy.repeat([1, 2, 3], 600)
+        lumis = numpy.tile(numpy.arange(600)//5, 3)
+        tree = makeTree(runs, lumis, 50)
+        expected = [ i for i in range(len(runs)) if self.inJSON(runs[i], lumis[i]) ]
+        self.assertEqual(entries(self.jsonFilter.filterClusters(tree)), expected)
+        self.assertEqual(entries(self.jsonFilter.filterEList(tree, None)), expected)
+
+if __name__ == "__main__":
+    unittest.main()
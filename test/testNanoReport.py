@@ -0,0 +1,50 @@
+import os
+import imp
+import unittest
+import numpy
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+
+nano_report = imp.load_source("nano_report", os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts", "nano_report.py"))
+
+def makeKeys(runLumis):
+    return numpy.array([ (run << 32) | lumi for run, lumi in runLumis ], dtype=numpy.int64)
+
+class Keys2MapTest(unittest.TestCase):
+    def testRanges(self):
+        keys = makeKeys([(1, 1), (1, 2), (1, 3), (1, 5), (2, 4), (2, 5), (3, 7)])
+        self.assertEqual(nano_report.keys2map(keys), ({1: [[1, 3], [5, 5]], 2: [[4, 5]], 3: [[7, 7]]}, 3, 7))
+
+    def testUnsortedDuplicates(self):
+        keys = makeKeys([(2, 5), (1, 2), (2, 4), (1, 1), (1, 2), (2, 5)])
+        self.assertEqual(nano_report.keys2map(keys), ({1: [[1, 2]], 2: [[4, 5]]}, 2, 4))
+
+    def testRunChange(self):
+        # consecutive keys of different runs are not merged, even if the lumis follow each other
+        keys = makeKeys([(1, 1), (2, 2)])
+        self.assertEqual(nano_report.keys2map(keys), ({1: [[1, 1]], 2: [[2, 2]]}, 2, 2))
+
+    def testLargeNumbers(self):
+        keys = makeKeys([(325175, 2**31), (325175, 2**31+1), (325176, 1)])
+        self.assertEqual(nano_report.keys2map(keys), ({325175: [[2**31, 2**31+1]], 325176: [[1, 1]]}, 2, 3))
+
+    def testEmpty(self):
+        self.assertEqual(nano_report.keys2map(numpy.zeros(0, dtype=numpy.int64)), ({}, 0, 0))
+
+    def testTree(self):
+        tree = ROOT.TTree("LuminosityBlocks", "LuminosityBlocks")
+        tree.SetDirectory(0)
+        run = numpy.zeros(1, dtype=numpy.uint32)
+        lumi = numpy.zeros(1, dtype=numpy.uint32)
+        tree.Branch("run", run, "run/i")
+        tree.Branch("luminosityBlock", lumi, "luminosityBlock/i")
+        for r, l in [(1, 3), (1, 1), (1, 2), (2, 10), (1, 2)]:
+            run[0] = r
+            lumi[0] = l
+            tree.Fill()
+        self.assertEqual(nano_report.root2map(tree), ({1: [[1, 3]], 2: [[10, 10]]}, 2, 4))
+        # read in chunks smaller than the tree
+        self.assertEqual(list(nano_report.readRunLumis(tree, chunkSize=2)), list(makeKeys([(1, 1), (1, 2), (1, 3), (2, 10)])))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import unittest
+import numpy
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+from PhysicsTools.NanoAODTools.postprocessing.framework.output import OutputBranch, _ColumnBuffer, _reduceMantissa
+
+def reduced(values, bits):
+    values = numpy.array(values, dtype=numpy.float32)
+    _reduceMantissa(values, bits)
+    return [ float(v) for v in values ]
+
+class ReduceMantissaTest(unittest.TestCase):
+    def testTruncated(self):
+        self.assertEqual(reduced([1.1, 3.14159265, 123456.789], 10), [1.099609375, 3.140625, 123456.])
+    def testRoundedUp(self):
+        self.assertEqual(reduced([-2.71828, 1e-3], 10), [-2.71875, 0.0010004043579101562])
+    def testSaturated(self):
+        # the largest mantissa is not rounded up into the exponent
+        self.assertEqual(reduced([1.999], 10), [1.998046875])
+    def testExact(self):
+        values = [0., 1., -0.5, 1024., 1.5]
+        self.assertEqual(reduced(values, 10), values)
+    def testFullPrecision(self):
+        values = numpy.array([1.1, -2.71828, 1e-3, 1.999], dtype=numpy.float32)
+        for bits in (23, 24):
+            self.assertEqual(reduced(values, bits), [ float(v) for v in values ])
+    def testInPlace(self):
+        buff = numpy.array([1.1, 1.1, 1.1], dtype=numpy.float32)
+        _reduceMantissa(buff[:2], 10)
+        self.assertEqual([ float(v) for v in buff ], [1.099609375, 1.099609375, float(numpy.float32(1.1))])
+
+class ColumnBufferTest(unittest.TestCase):
+    def testValues(self):
+        column = _ColumnBuffer(OutputBranch(None, "x", "I"), 5)
+        column.set(1, 3)
+        column.set(2, 4)
+        column.set(4, -1)
+        content, counts = column.columns(5)
+        self.assertEqual(content.dtype, numpy.int32)
+        # entries not filled repeat the previous value, 0 before the first one
+        self.assertEqual(list(content), [0, 3, 4, 4, -1])
+        self.assertEqual(list(counts), [1]*5)
+        # the last value is kept for the next rows, which were cleared
+        column.set(1, 7)
+        content, counts = column.columns(3)
+        self.assertEqual(list(content), [-1, 7, 7])
+    def testFixedArray(self):
+        column = _ColumnBuffer(OutputBranch(None, "x", "F", n=2), 3)
+        column.set(0, [1., 2.])
+        column.set(2, [5., 6.])
+        content, counts = column.columns(3)
+        self.assertEqual(list(content), [1., 2., 1., 2., 5., 6.])
+        self.assertEqual(list(counts), [2, 2, 2])
+        self.assertRaises(RuntimeError, column.set, 0, [1.])
+    def testJagged(self):
+        column = _ColumnBuffer(OutputBranch(None, "x", "F", lenVar="nx"), 4)
+        column.set(1, [1., 2.])
+        column.set(2, [])
+        content, counts = column.columns(4)
+        self.assertEqual(content.dtype, numpy.float32)
+        self.assertEqual(list(content), [1., 2.])
+        self.assertEqual(list(counts), [0, 2, 0, 0])
+        column.set(0, numpy.array([3., 4., 5.]))
+        content, counts = column.columns(2)
+        self.assertEqual(list(content), [3., 4., 5., 3., 4., 5.])
+        self.assertEqual(list(counts), [3, 3])
+    def testPartial(self):
+        # only the first rows are returned and cleared
+        column = _ColumnBuffer(OutputBranch(None, "x", "I"), 4)
+        column.set(0, 1)
+        column.set(1, 2)
+        content, counts = column.columns(2)
+        self.assertEqual(list(content), [1, 2])
+        column.set(1, 5)
+        content, counts = column.columns(4)
+        self.assertEqual(list(content), [2, 5, 5, 5])
+    def testLimitedPrecision(self):
+        column = _ColumnBuffer(OutputBranch(None, "x", "F", lenVar="nx", limitedPrecision=10), 2)
+        column.set(0, [1.1, 3.14159265])
+        content, counts = column.columns(2)
+        self.assertEqual(list(content), [1.099609375, 3.140625, 1.099609375, 3.140625])
+
+if __name__ == "__main__":
+    unittest.main()
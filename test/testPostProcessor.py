@@ -0,0 +1,65 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+from PhysicsTools.NanoAODTools.postprocessing.framework.postprocessor import PostProcessor
+
+def writeTree(fileName, nEntries, clusterSize):
+    tfile = ROOT.TFile.Open(fileName, "RECREATE")
+    tree = ROOT.TTree("Events", "Events")
+    x = numpy.zeros(1, dtype=numpy.float32)
+    tree.Branch("x", x, "x/F")
+    tree.SetAutoFlush(clusterSize)
+    for i in range(nEntries):
+        x[0] = i
+        tree.Fill()
+    tree.Write()
+    tfile.Close()
+
+class SplitEntriesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.fileName = os.path.join(self.tmpDir, "events.root")
+        writeTree(self.fileName, 100, 10)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def split(self, nsplit, firstEntry=0, maxEntries=None, fileName=None):
+        p = PostProcessor(self.tmpDir, [fileName or self.fileName], friend=True, firstEntry=firstEntry, maxEntries=maxEntries)
+        return p._splitEntries(fileName or self.fileName, nsplit)
+
+    def checkRanges(self, ranges, first, last, nsplit):
+        # contiguous ranges covering the requested entries, starting at cluster boundaries
+        self.assertTrue(1 <= len(ranges) <= nsplit)
+        self.assertEqual(ranges[0][0], first)
+        for (start, n), (nextStart, nextN) in zip(ranges, ranges[1:]):
+            self.assertEqual(start+n, nextStart)
+            self.assertEqual(nextStart % 10, 0)
+        self.assertEqual(ranges[-1][0]+ranges[-1][1], last)
+        self.assertTrue(all(n > 0 for start, n in ranges))
+
+    def testHalves(self):
+        self.assertEqual(self.split(2), [(0, 50), (50, 50)])
+
+    def testClusterBoundaries(self):
+        for nsplit in (3, 4, 7, 10):
+            self.checkRanges(self.split(nsplit), 0, 100, nsplit)
+        self.assertEqual(len(self.split(10)), 10)
+
+    def testRange(self):
+        ranges = self.split(3, firstEntry=15, maxEntries=60)
+        self.checkRanges(ranges, 15, 75, 3)
+        self.assertEqual(ranges, [(15, 15), (30, 20), (50, 25)])
+
+    def testMoreShardsThanClusters(self):
+        self.checkRanges(self.split(20), 0, 100, 10)
+        fileName = os.path.join(self.tmpDir, "onecluster.root")
+        writeTree(fileName, 100, 1000)
+        self.assertEqual(self.split(4, fileName=fileName), [(0, 100)])
+
+if __name__ == "__main__":
+    unittest.main()
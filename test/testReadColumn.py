@@ -0,0 +1,75 @@
+import unittest
+import numpy
+import ROOT
+ROOT.PyConfig.IgnoreCommandLineOptions = True
+from PhysicsTools.NanoAODTools.postprocessing.framework.treeReaderArrayTools import readColumn
+
+BIG = 2**60+1 # not exactly representable as a double
+
+def makeTree(nEntries):
+    """in-memory tree with single values, a fixed-length array and variable-length arrays of several types"""
+    tree = ROOT.TTree("Events", "Events")
+    tree.SetDirectory(0)
+    run = numpy.zeros(1, dtype=numpy.uint32)
+    event = numpy.zeros(1, dtype=numpy.uint64)
+    fixed = numpy.zeros(3, dtype=numpy.int16)
+    nJet = numpy.zeros(1, dtype=numpy.int32)
+    pt = numpy.zeros(10, dtype=numpy.float32)
+    passed = numpy.zeros(10, dtype=numpy.bool_)
+    tree.Branch("run", run, "run/i")
+    tree.Branch("event", event, "event/l")
+    tree.Branch("fixed", fixed, "fixed[3]/S")
+    tree.Branch("nJet", nJet, "nJet/I")
+    tree.Branch("Jet_pt", pt, "Jet_pt[nJet]/F")
+    tree.Branch("Jet_passed", passed, "Jet_passed[nJet]/O")
+    for i in range(nEntries):
+        run[0] = i
+        event[0] = BIG+i
+        fixed[:] = [i, -i, 2*i]
+        nJet[0] = i % 4
+        pt[:nJet[0]] = [ i+0.25*j for j in range(nJet[0]) ]
+        passed[:nJet[0]] = [ (i+j) % 2 == 0 for j in range(nJet[0]) ]
+        tree.Fill()
+    return tree
+
+class ReadColumnTest(unittest.TestCase):
+    def setUp(self):
+        self.tree = makeTree(20)
+    def testValues(self):
+        values, counts = readColumn(self.tree, "run", 5, 4)
+        self.assertEqual(counts, None)
+        self.assertEqual(values.dtype, numpy.uint32)
+        self.assertEqual(list(values), [5, 6, 7, 8])
+    def testLong64(self):
+        values, counts = readColumn(self.tree, "event")
+        self.assertEqual(values.dtype, numpy.uint64)
+        self.assertEqual([ int(v) for v in values ], [ BIG+i for i in range(20) ])
+    def testFixedArray(self):
+        values, counts = readColumn(self.tree, "fixed", 2, 2)
+        self.assertEqual(values.dtype, numpy.int16)
+        self.assertEqual(list(counts), [3, 3])
+        self.assertEqual(list(values), [2, -2, 4, 3, -3, 6])
+    def testJagged(self):
+        values, counts = readColumn(self.tree, "Jet_pt", 1, 4)
+        self.assertEqual(values.dtype, numpy.float32)
+        self.assertEqual(list(counts), [1, 2, 3, 0])
+        self.assertEqual(list(values), [1., 2., 2.25, 3., 3.25, 3.5])
+        passed, counts = readColumn(self.tree, "Jet_passed", 1, 4)
+        self.assertEqual(passed.dtype, numpy.bool_)
+        self.assertEqual(list(passed), [False, True, False, False, True, False])
+    def testEntryList(self):
+        elist = ROOT.TEntryList("elist", "elist", self.tree)
+        for i in (3, 7, 8, 15):
+            elist.Enter(i)
+        values, counts = readColumn(self.tree, "run", 1, 3, elist)
+        self.assertEqual(list(values), [7, 8, 15])
+        values, counts = readColumn(self.tree, "Jet_pt", 0, 2, elist)
+        self.assertEqual(list(counts), [3, 3])
+        self.assertEqual(list(values), [3., 3.25, 3.5, 7., 7.25, 7.5])
+    def testEmpty(self):
+        values, counts = readColumn(self.tree, "Jet_pt", 20)
+        self.assertEqual(len(values), 0)
+        self.assertEqual(len(counts), 0)
+
+if __name__ == "__main__":
+    unittest.main()